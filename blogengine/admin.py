@@ -1,17 +1,51 @@
 import models
+from django import forms
 from django.contrib import admin
 from django.contrib.auth.models import User
+from django.utils.text import slugify
+from blogengine.hosts import current_site_id
 
 class PostAdmin(admin.ModelAdmin):
     prepopulated_fields = {"slug": ("title",)}
     exclude = ('author',)
     
     # When a model is saved, set the author to the user making the
-    # http request.
+    # http request. The markdown is rendered in the background.
     def save_model(self, request, obj, form, change):
         obj.author = request.user
+        obj.save(render=False)
+
+class SiteObjectAdmin(admin.ModelAdmin):
+    exclude = ('site',)
+
+    # With site left out the form doesn't check (site, slug) is unique,
+    # so check the slug, or the one save() makes from the name, here
+    def get_form(self, request, obj=None, **kwargs):
+        form = super(SiteObjectAdmin, self).get_form(request, obj, **kwargs)
+        site_id = obj.site_id if obj is not None else current_site_id(request)
+
+        class SiteObjectForm(form):
+            def clean_slug(self):
+                slug = self.cleaned_data.get('slug')
+                saved_slug = slug or slugify(unicode(self.cleaned_data.get('name', '')))
+                if not saved_slug:
+                    return slug
+                taken = self._meta.model.objects.for_site(site_id).filter(slug=saved_slug)
+                if self.instance.pk is not None:
+                    taken = taken.exclude(pk=self.instance.pk)
+                if taken.exists():
+                    raise forms.ValidationError('A %s with this slug already exists on this site.'
+                                                % self._meta.model._meta.verbose_name)
+                return slug
+
+        return SiteObjectForm
+
+    # Categories and tags belong to the site they are added on
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.site_id = current_site_id(request)
         obj.save()
 
-admin.site.register(models.Category)
-admin.site.register(models.Tag)
+admin.site.register(models.Category, SiteObjectAdmin)
+admin.site.register(models.Tag, SiteObjectAdmin)
 admin.site.register(models.Post, PostAdmin)
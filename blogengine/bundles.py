@@ -0,0 +1,92 @@
+'''
+CSS and JavaScript bundles, built by collectstatic.
+
+Each bundle in BLOGENGINE_BUNDLES is its source files joined into one file
+under blogengine/bundles/, with CSS minified and its relative url()s
+pointed back at the sources, so base.html makes two requests instead of
+eight. Until collectstatic has built them, and with DEBUG on, pages link
+the source files instead.
+'''
+import posixpath
+import re
+
+from django.conf import settings
+
+BUNDLE_DIR = 'blogengine/bundles/'
+
+BOILERPLATE = 'blogengine/bower_components/html5-boilerplate/'
+BOOTSTRAP = 'blogengine/bower_components/bootstrap/dist/'
+
+BUNDLES = {
+    'site.css': [
+        BOILERPLATE + 'css/normalize.css',
+        BOILERPLATE + 'css/main.css',
+        BOOTSTRAP + 'css/bootstrap.min.css',
+        BOOTSTRAP + 'css/bootstrap-theme.min.css',
+        'blogengine/css/custom.css',
+        'blogengine/css/code.css',
+    ],
+    # Modernizr isn't bundled: it has to run in <head>, before the first paint
+    'site.js': [
+        BOILERPLATE + 'js/vendor/jquery-1.10.2.min.js',
+        BOILERPLATE + 'js/plugins.js',
+        BOOTSTRAP + 'js/bootstrap.min.js',
+    ],
+}
+
+STRINGS = r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\''
+# Comments other than /*! licences */, and strings so they're left alone
+CSS_TOKENS = re.compile(r'(%s)|/\*(?!!).*?\*/' % STRINGS, re.S)
+CSS_URL = re.compile(r'url\(\s*(["\']?)(.*?)\1\s*\)')
+
+def get_bundles():
+    return getattr(settings, 'BLOGENGINE_BUNDLES', BUNDLES)
+
+def bundle_path(name):
+    return BUNDLE_DIR + name
+
+def minify_css(css):
+    '''Drop comments and whitespace CSS doesn't need'''
+    css = CSS_TOKENS.sub(lambda match: match.group(1) or '', css)
+    parts = re.split('(%s)' % STRINGS, css)
+    for i in range(0, len(parts), 2):
+        part = re.sub(r'\s+', ' ', parts[i])
+        part = re.sub(r' ?([{};,>]) ?', r'\1', part)
+        part = part.replace(': ', ':')
+        parts[i] = part.replace(';}', '}')
+    return ''.join(parts).strip()
+
+def rewrite_css_urls(css, source, target):
+    '''Make the relative url()s of a stylesheet moved from source to target work'''
+    def rewrite(match):
+        quote, url = match.groups()
+        if url.startswith(('#', '/', 'data:', 'http:', 'https:')):
+            return match.group(0)
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(source), url))
+        url = posixpath.relpath(path, posixpath.dirname(target))
+        return 'url(%s%s%s)' % (quote, url, quote)
+    return CSS_URL.sub(rewrite, css)
+
+def build_bundle(name, sources, open_file):
+    '''The contents of a bundle, reading the sources with open_file'''
+    contents = []
+    for source in sources:
+        f = open_file(source)
+        try:
+            content = f.read()
+        finally:
+            f.close()
+        if name.endswith('.css'):
+            content = minify_css(rewrite_css_urls(content, source, bundle_path(name)))
+        else:
+            # Scripts may leave off the last semicolon
+            content = content.strip() + ';'
+        contents.append(content)
+    return '\n'.join(contents) + '\n'
+
+def bundle_urls(name, storage):
+    '''URLs to link for a bundle: itself once built, otherwise its sources'''
+    manifest = getattr(storage, 'cache', None)
+    if not settings.DEBUG and hasattr(manifest, 'exists') and manifest.get(bundle_path(name)):
+        return [storage.url(bundle_path(name))]
+    return [storage.url(source) for source in get_bundles()[name]]
@@ -0,0 +1,210 @@
+'''
+Two-tier cache backend: a small in-process LRU in front of another cache.
+
+The hottest keys (the index, the newest posts, the feed and the dependency
+versions every page checks) are then answered without a round trip to
+memcached. Configure it over an existing alias:
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'blogengine.cache_backends.TwoTierCache',
+            'LOCATION': 'memcached',
+            'OPTIONS': {'MAX_BYTES': 16 * 1024 * 1024, 'LOCAL_TIMEOUT': 10,
+                        'GENERATION_INTERVAL': 1},
+        },
+        'memcached': {...},
+    }
+
+Local entries live for at most LOCAL_TIMEOUT seconds. incr(), decr() and
+clear(), which dependency invalidation uses, also bump a generation counter
+kept in the shared cache; every worker polls it at most once every
+GENERATION_INTERVAL seconds and empties its local tier when it moved, so
+invalidations reach all workers within that interval. Plain set() and
+delete() are only seen by other workers once their local copy times out.
+'''
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.core.cache import get_cache
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+GENERATION_KEY = 'blogengine:l1:generation'
+
+
+class TwoTierCache(BaseCache):
+    def __init__(self, location, params):
+        super(TwoTierCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self.remote_alias = location
+        self.max_bytes = int(options.get('MAX_BYTES', 16 * 1024 * 1024))
+        self.local_timeout = float(options.get('LOCAL_TIMEOUT', 10))
+        self.generation_interval = float(options.get('GENERATION_INTERVAL', 1))
+        self._remote = None
+        self._local = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._generation = None
+        self._polled = 0
+        self.hits = self.misses = 0
+
+    @property
+    def remote(self):
+        if self._remote is None:
+            self._remote = get_cache(self.remote_alias)
+        return self._remote
+
+    # Local tier
+
+    def _check_generation(self):
+        '''Empty the local tier if another worker invalidated since the last poll'''
+        now = time.time()
+        if now - self._polled < self.generation_interval:
+            return
+        self._polled = now
+        generation = self.remote.get(GENERATION_KEY)
+        if generation != self._generation:
+            with self._lock:
+                self._local.clear()
+                self._bytes = 0
+            self._generation = generation
+
+    def _bump_generation(self, previous=None):
+        try:
+            self._generation = self.remote.incr(GENERATION_KEY)
+        except ValueError:
+            # Time based so it won't match what workers saw before it was lost
+            self._generation = max(int(time.time() * 1000), (previous or 0) + 1)
+            self.remote.set(GENERATION_KEY, self._generation, None)
+        with self._lock:
+            self._local.clear()
+            self._bytes = 0
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            pickled, expires = entry
+            if expires <= time.time():
+                self._local_delete(key)
+                return None
+            # Most recently used go last
+            del self._local[key]
+            self._local[key] = entry
+        return pickle.loads(pickled)
+
+    def _local_set(self, key, value, timeout):
+        if timeout is None:
+            timeout = self.local_timeout
+        elif timeout == DEFAULT_TIMEOUT:
+            timeout = min(self.default_timeout, self.local_timeout)
+        else:
+            timeout = min(timeout, self.local_timeout)
+        if timeout <= 0:
+            return
+        try:
+            pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PickleError, TypeError):
+            return
+        if len(pickled) > self.max_bytes:
+            return
+        with self._lock:
+            self._local_delete(key)
+            self._local[key] = (pickled, time.time() + timeout)
+            self._bytes += len(pickled)
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._local))
+                self._local_delete(oldest)
+
+    def _local_delete(self, key):
+        with self._lock:
+            entry = self._local.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry[0])
+
+    # Cache API
+
+    def get(self, key, default=None, version=None):
+        self._check_generation()
+        local_key = self.make_key(key, version)
+        value = self._local_get(local_key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = self.remote.get(key, version=version)
+        if value is None:
+            return default
+        self._local_set(local_key, value, self.local_timeout)
+        return value
+
+    def get_many(self, keys, version=None):
+        self._check_generation()
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._local_get(self.make_key(key, version))
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        self.hits += len(found)
+        self.misses += len(missing)
+        if missing:
+            remote = self.remote.get_many(missing, version=version)
+            for key, value in remote.items():
+                self._local_set(self.make_key(key, version), value, self.local_timeout)
+            found.update(remote)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.remote.set(key, value, timeout, version=version)
+        self._local_set(self.make_key(key, version), value, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        self.remote.set_many(data, timeout, version=version)
+        for key, value in data.items():
+            self._local_set(self.make_key(key, version), value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # Locks are taken with add(), so always ask the shared cache
+        added = self.remote.add(key, value, timeout, version=version)
+        if added:
+            self._local_delete(self.make_key(key, version))
+        return added
+
+    def delete(self, key, version=None):
+        self._local_delete(self.make_key(key, version))
+        self.remote.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._local_delete(self.make_key(key, version))
+        self.remote.delete_many(keys, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, version=version) is not None
+
+    def incr(self, key, delta=1, version=None):
+        value = self.remote.incr(key, delta, version=version)
+        self._bump_generation()
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        value = self.remote.decr(key, delta, version=version)
+        self._bump_generation()
+        return value
+
+    def clear(self):
+        previous = self.remote.get(GENERATION_KEY)
+        self.remote.clear()
+        self._bump_generation(previous)
+
+    def close(self, **kwargs):
+        self.remote.close(**kwargs)
@@ -0,0 +1,155 @@
+'''
+Dependency tracked caching.
+
+Cached entries record the dependencies they were built from (a post, a
+category, the list of posts, ...) together with the version each dependency
+had at the time. Saving or deleting a model bumps the versions of its
+dependencies, so entries built from an older version read as misses while
+everything else in the cache is left alone.
+
+Dependencies on what a whole site shows (its posts, its flat pages) carry
+the site id, so changes on one site never expire the pages of another.
+'''
+import time
+
+from django.core.cache import cache
+from blogengine import instrumentation
+
+VERSION_KEY_PREFIX = 'blogengine:dep:'
+
+# Every page renders the flatpages navigation of its site. Like the
+# fallback, these are kinds, see site_dependencies()
+DEFAULT_DEPENDENCIES = ('flatpages',)
+
+# Used for pages that don't declare what they were built from
+FALLBACK_DEPENDENCIES = ('posts', 'flatpages')
+
+def dependency(kind, pk=None):
+    '''Name of a dependency, e.g. dependency('post', 1) -> 'post:1' '''
+    if pk is None:
+        return kind
+    return '%s:%s' % (kind, pk)
+
+def site_dependencies(kinds, site_id):
+    '''Dependencies of each kind on one site, e.g. ['posts:1', 'flatpages:1']'''
+    return [dependency(kind, site_id) for kind in kinds]
+
+def post_dependencies(post):
+    '''Dependencies of a page showing a single post'''
+    deps = [dependency('post', post.pk)]
+    if post.category_id:
+        deps.append(dependency('category', post.category_id))
+    deps.extend(dependency('tag', tag.pk) for tag in post.tags.all())
+    return deps
+
+def add_dependencies(request, *deps):
+    '''
+    Record what the page being built for request depends on, with the
+    version each dependency has before the page reads it
+    '''
+    if not hasattr(request, 'cache_dependencies'):
+        request.cache_dependencies = set()
+    if not hasattr(request, 'cache_versions'):
+        request.cache_versions = {}
+    request.cache_versions.update(
+        get_versions([dep for dep in deps if dep not in request.cache_versions]))
+    request.cache_dependencies.update(deps)
+
+def _initial_version():
+    # Time based so a version key evicted from the cache never comes back
+    # with a value an old entry was stored with
+    return int(time.time() * 1000)
+
+def get_versions(deps, backend=None):
+    '''Current version of each dependency, as a dict'''
+    backend = backend or cache
+    keys = dict((VERSION_KEY_PREFIX + dep, dep) for dep in deps)
+    found = backend.get_many(keys.keys())
+    versions = {}
+    for key, dep in keys.items():
+        if key not in found:
+            backend.add(key, _initial_version(), None)
+            found[key] = backend.get(key)
+        versions[dep] = found[key]
+    return versions
+
+def invalidate(*deps, **kwargs):
+    '''Bump the version of each dependency, expiring entries built from it'''
+    backend = kwargs.get('backend') or cache
+    for dep in deps:
+        key = VERSION_KEY_PREFIX + dep
+        try:
+            backend.incr(key)
+        except ValueError:
+            backend.set(key, _initial_version(), None)
+
+def fetch(key, default=None, backend=None):
+    '''Fetch a value stored with store(), unless a dependency changed since'''
+    backend = backend or cache
+    entry = backend.get(key)
+    if entry is None:
+        instrumentation.add('cache_misses')
+        return default
+    value, versions = entry
+    if versions and get_versions(versions.keys(), backend) != versions:
+        instrumentation.add('cache_misses')
+        return default
+    instrumentation.add('cache_hits')
+    return value
+
+def store(key, value, deps, timeout=None, backend=None, versions=None):
+    '''
+    Store a value along with the versions of its dependencies. Pass the
+    versions read before the value was built: read afterwards, a change
+    made meanwhile would be stored as seen.
+    '''
+    backend = backend or cache
+    if versions is None:
+        versions = get_versions(deps, backend)
+    if timeout is None:
+        backend.set(key, (value, versions))
+    else:
+        backend.set(key, (value, versions), timeout)
+
+
+# key -> (dependency versions, value) of memoize()
+_memoized = {}
+
+def memoize(key, deps, build):
+    '''
+    build(), kept in this process and in the cache until one of deps
+    changes. Warm processes only check the dependency versions.
+    '''
+    versions = get_versions(deps)
+    local = _memoized.get(key)
+    if local is not None and local[0] == versions:
+        return local[1]
+    value = fetch(key)
+    if value is None:
+        value = build()
+        store(key, value, deps, versions=versions)
+    _memoized[key] = (versions, value)
+    return value
+
+
+class DependencyCache(object):
+    '''
+    Wraps a cache backend so values stored through it are checked against
+    their dependencies on the way out. Values may carry their dependencies
+    in a cache_dependencies attribute, and the versions those had before
+    the value was built in cache_versions; the cache middleware sets both
+    on responses.
+    '''
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, key, default=None):
+        return fetch(key, default, backend=self.backend)
+
+    def set(self, key, value, timeout=None):
+        deps = getattr(value, 'cache_dependencies', ())
+        store(key, value, deps, timeout, backend=self.backend,
+              versions=getattr(value, 'cache_versions', None))
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
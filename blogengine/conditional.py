@@ -0,0 +1,59 @@
+'''
+ETag and Last-Modified for blog pages, worked out before the view renders.
+
+A post page's Last-Modified is the newest updated_at of the post, its
+category and its tags. Lists and feeds only send an ETag built from the
+dependency versions the cache uses: deleting a post, moving it to another
+category or taking a tag off it doesn't move any updated_at, so a date
+would answer 304 for a list that changed.
+Either way a 304 is answered before any template or markdown is rendered.
+'''
+import hashlib
+
+from django.conf import settings
+from django.views.decorators.http import condition
+from blogengine import caching
+from blogengine.rendering import renderer_version
+
+def latest(*dates):
+    '''The newest of some datetimes, ignoring None'''
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+def make_etag(*parts, **kwargs):
+    '''
+    ETag changing with each of parts and with the version of each
+    dependency given as deps. The flatpages navigation of the site, given
+    as site_id, is on every page.
+    '''
+    site_id = kwargs.get('site_id', settings.SITE_ID)
+    deps = list(kwargs.get('deps', ())) + caching.site_dependencies(caching.DEFAULT_DEPENDENCIES, site_id)
+    versions = sorted(caching.get_versions(deps).items())
+    # Pages show markdown, which changes with the renderer
+    return hashlib.md5(repr((parts, versions, renderer_version()))).hexdigest()
+
+
+class ConditionalGetMixin(object):
+    '''
+    For class based views: sends the ETag and Last-Modified of
+    get_etag() and get_last_modified(), and answers 304 when the client
+    already has them.
+    '''
+    def get_etag(self):
+        return None
+
+    def get_last_modified(self):
+        return None
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super(ConditionalGetMixin, self).dispatch(request, *args, **kwargs)
+        etag = self.get_etag()
+        last_modified = self.get_last_modified()
+
+        @condition(etag_func=lambda request, *args, **kwargs: etag,
+                   last_modified_func=lambda request, *args, **kwargs: last_modified)
+        def view(request, *args, **kwargs):
+            return super(ConditionalGetMixin, self).dispatch(request, *args, **kwargs)
+
+        return view(request, *args, **kwargs)
@@ -0,0 +1,113 @@
+'''
+Feeds that are bounded, answer conditional GETs and stream their XML.
+
+Feed readers poll constantly, so a feed only renders its newest
+item_limit posts, sends an ETag that changes whenever a post does, and
+answers 304 Not Modified when the reader already has the current version. Links point at the host the feed was requested
+on, so each site's feed links to its own pages.
+'''
+import hashlib
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.sites.models import get_current_site
+from django.contrib.syndication.views import Feed
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, StreamingHttpResponse
+from django.utils import feedgenerator
+from django.utils.xmlutils import SimplerXMLGenerator
+from django.views.decorators.http import condition
+from blogengine import caching
+
+def _drain(buf):
+    value = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return value
+
+
+class StreamingRss201rev2Feed(feedgenerator.Rss201rev2Feed):
+    '''RSS 2.0 feed that can be written out an item at a time'''
+    def stream(self, encoding):
+        buf = StringIO()
+        handler = SimplerXMLGenerator(buf, encoding)
+        handler.startDocument()
+        handler.startElement('rss', self.rss_attributes())
+        handler.startElement('channel', self.root_attributes())
+        self.add_root_elements(handler)
+        yield _drain(buf)
+        for item in self.items:
+            handler.startElement('item', self.item_attributes(item))
+            self.add_item_elements(handler, item)
+            handler.endElement('item')
+            yield _drain(buf)
+        self.endChannelElement(handler)
+        handler.endElement('rss')
+        yield _drain(buf)
+
+
+class StreamingFeed(Feed):
+    feed_type = StreamingRss201rev2Feed
+
+    # Number of posts in the feed, BLOGENGINE_FEED_ITEMS when None
+    item_limit = None
+
+    def __init__(self, item_limit=None):
+        if item_limit is not None:
+            self.item_limit = item_limit
+
+    def get_item_limit(self):
+        if self.item_limit is not None:
+            return self.item_limit
+        return getattr(settings, 'BLOGENGINE_FEED_ITEMS', 20)
+
+    def get_dependencies(self, obj):
+        '''What the feed is built from: the posts of SITE_ID unless overridden'''
+        return [caching.dependency('posts', settings.SITE_ID)]
+
+    def get_etag(self, obj):
+        '''Changes whenever a post does, so unchanged polls get a 304'''
+        versions = caching.get_versions(self.get_dependencies(obj))
+        return hashlib.md5('%s:%s' % (versions, self.get_item_limit())).hexdigest()
+
+    def get_last_modified(self, obj):
+        '''When the newest item changed, None if unknown'''
+        return None
+
+    def get_feed(self, obj, request):
+        # Django puts the domain of SITE_ID on every link
+        feed = super(StreamingFeed, self).get_feed(obj, request)
+        protocol = 'https' if request.is_secure() else 'http'
+        default = '%s://%s' % (protocol, get_current_site(request).domain)
+        host = '%s://%s' % (protocol, request.get_host())
+        if default == host:
+            return feed
+
+        def on_host(url):
+            if url and (url == default or url.startswith(default + '/')):
+                return host + url[len(default):]
+            return url
+
+        feed.feed['link'] = on_host(feed.feed['link'])
+        feed.feed['feed_url'] = on_host(feed.feed['feed_url'])
+        for item in feed.items:
+            item['link'] = on_host(item['link'])
+            item['unique_id'] = on_host(item['unique_id'])
+        return feed
+
+    def __call__(self, request, *args, **kwargs):
+        try:
+            obj = self.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404('Feed object does not exist.')
+        etag = self.get_etag(obj)
+        last_modified = self.get_last_modified(obj)
+
+        @condition(etag_func=lambda request, *args, **kwargs: etag,
+                   last_modified_func=lambda request, *args, **kwargs: last_modified)
+        def render(request, *args, **kwargs):
+            feedgen = self.get_feed(obj, request)
+            return StreamingHttpResponse(feedgen.stream('utf-8'),
+                                         content_type=feedgen.mime_type)
+
+        return render(request, *args, **kwargs)
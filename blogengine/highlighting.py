@@ -0,0 +1,75 @@
+'''
+Cache of Pygments output for the code blocks of posts.
+
+Highlighting is the slowest part of rendering a code heavy post, and the
+same snippets come back every time a post or its listing is rendered again.
+The highlighted HTML is kept per process under a hash of the language, the
+code and the formatter options, least recently used first out once the
+entries add up to BLOGENGINE_HIGHLIGHT_CACHE_BYTES (0 disables the cache).
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+
+
+class HighlightCache(object):
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return getattr(settings, 'BLOGENGINE_HIGHLIGHT_CACHE_BYTES', 4 * 1024 * 1024)
+
+    def key(self, codeblock, lexer, formatter_opts):
+        lexer_id = (type(lexer).__name__, sorted(lexer.options.items()))
+        return hashlib.sha1(smart_str(repr((lexer_id, sorted(formatter_opts.items()))))
+                            + '\0' + smart_str(codeblock)).hexdigest()
+
+    def highlight(self, codeblock, lexer, formatter_opts, highlight):
+        '''rendering highlight hook: highlight() unless the result is cached'''
+        max_bytes = self.max_bytes
+        if not max_bytes:
+            return highlight(codeblock, lexer, **formatter_opts)
+        key = self.key(codeblock, lexer, formatter_opts)
+        with self._lock:
+            html = self._entries.pop(key, None)
+            if html is not None:
+                # Most recently used go last
+                self._entries[key] = html
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = highlight(codeblock, lexer, **formatter_opts)
+        size = len(html)
+        if size > max_bytes:
+            return html
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = html
+                self._bytes += size
+            while self._bytes > max_bytes:
+                oldest, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'bytes': self._bytes}
+
+cache = HighlightCache()
@@ -0,0 +1,34 @@
+'''
+Which site a request is for, from its Host header.
+
+Several blogs can be served from one deployment, one Site each. The
+domains of every site are kept in each process and in the cache under the
+'sites' dependency, which saving or deleting a site bumps, so resolving a
+host doesn't query. Hosts no site claims get SITE_ID.
+'''
+from django.conf import settings
+from django.contrib.sites.models import Site
+from blogengine import caching
+
+def site_ids_by_domain():
+    '''Site id of each domain, lower case'''
+    def build():
+        return dict((domain.lower(), pk) for pk, domain in
+                    Site.objects.values_list('pk', 'domain'))
+    return caching.memoize('blogengine:sites', ['sites'], build)
+
+def site_id_for_host(host):
+    '''Id of the site serving host, which may carry a port'''
+    host = host.lower()
+    domains = site_ids_by_domain()
+    if host in domains:
+        return domains[host]
+    return domains.get(host.rsplit(':', 1)[0], settings.SITE_ID)
+
+def current_site_id(request=None):
+    '''Id of the site request is for, as SiteMiddleware found it'''
+    if request is None:
+        return settings.SITE_ID
+    if not hasattr(request, 'site_id'):
+        request.site_id = site_id_for_host(request.get_host())
+    return request.site_id
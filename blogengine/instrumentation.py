@@ -0,0 +1,165 @@
+'''
+Lightweight per-view performance counters.
+
+PerformanceMiddleware records, for each request to a blogengine URL, the
+number and time of database queries, template and markdown render time and
+page cache hits and misses, and adds them to histograms kept per URL name
+in this process. performance_stats() returns them as a dict, which the
+staff-only performance view serves as JSON and the middleware can log
+every BLOGENGINE_PERFORMANCE_LOG_INTERVAL seconds.
+'''
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db.backends.util import CursorWrapper
+from django.template.base import Template
+
+# Upper bounds of the histogram buckets, in milliseconds or counts
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+METRICS = ('total_ms', 'queries', 'query_ms', 'template_ms', 'markdown_ms',
+           'cache_hits', 'cache_misses')
+
+_local = threading.local()
+_lock = threading.Lock()
+_views = {}
+_started = time.time()
+
+
+class Histogram(object):
+    '''Counts of observed values per bucket, with their count, sum and max'''
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            index = len(BUCKETS)
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        '''Upper bound of the bucket holding the given fraction of values'''
+        if not self.count:
+            return 0
+        seen = 0
+        for index, number in enumerate(self.buckets):
+            seen += number
+            if seen >= fraction * self.count:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'max': round(self.max, 3),
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['inf'], self.buckets)),
+        }
+
+
+def start_request():
+    '''Start collecting metrics for the request on this thread'''
+    _local.metrics = dict((metric, 0) for metric in METRICS)
+    _local.depth = 0
+
+def finish_request():
+    '''Stop collecting and return the metrics of this thread's request'''
+    metrics = getattr(_local, 'metrics', None)
+    _local.metrics = None
+    return metrics
+
+def add(metric, value=1):
+    '''Add to a metric of the current request, if one is being recorded'''
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics[metric] += value
+
+@contextmanager
+def timed(metric):
+    '''Add the time spent in the block to a metric, in milliseconds'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        add(metric, (time.time() - start) * 1000)
+
+def observe(name, metrics):
+    '''Add the metrics of a request to the histograms of its URL name'''
+    with _lock:
+        histograms = _views.setdefault(name, dict((metric, Histogram()) for metric in METRICS))
+        for metric, value in metrics.items():
+            histograms[metric].observe(value)
+
+def performance_stats():
+    '''Histograms of every URL name seen so far, as a dict'''
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'since': int(_started),
+            'views': dict((name, dict((metric, histogram.as_dict())
+                                      for metric, histogram in histograms.items()))
+                          for name, histograms in _views.items()),
+        }
+
+def reset():
+    global _started
+    with _lock:
+        _views.clear()
+        _started = time.time()
+
+
+_installed = False
+
+def install():
+    '''
+    Count and time queries and time template rendering; markdown and
+    cache lookups report themselves
+    '''
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    render = Template._render
+
+    def _render(self, context):
+        # Only time the outermost template, includes are part of it
+        depth = getattr(_local, 'depth', 0)
+        _local.depth = depth + 1
+        try:
+            if depth:
+                return render(self, context)
+            with timed('template_ms'):
+                return render(self, context)
+        finally:
+            _local.depth = depth
+
+    Template._render = _render
+
+    # Only counters, unlike the debug cursor which keeps every query's SQL.
+    # The debug cursor calls these too, so queries are counted once.
+    execute, executemany = CursorWrapper.execute, CursorWrapper.executemany
+
+    def timed_execute(self, sql, params=None):
+        add('queries')
+        with timed('query_ms'):
+            return execute(self, sql, params)
+
+    def timed_executemany(self, sql, param_list):
+        add('queries')
+        with timed('query_ms'):
+            return executemany(self, sql, param_list)
+
+    CursorWrapper.execute = timed_execute
+    CursorWrapper.executemany = timed_executemany
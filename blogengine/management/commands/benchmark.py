@@ -0,0 +1,297 @@
+import gc
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from optparse import make_option
+
+import django
+import django.core.cache
+from django.core.cache import get_cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import (CaptureQueriesContext, override_settings, setup_test_environment,
+                               teardown_test_environment)
+from django.utils import timezone
+from blogengine import caching
+from blogengine.caching import dependency, invalidate
+from blogengine.models import (Category, Post, Tag, denormalize_taxonomy, rebuild_counts,
+                               refresh_taxonomies)
+from blogengine.search import get_backend as get_search_backend, search_posts
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+WORDS = ('python django blog post cache query index template markdown feed '
+         'sitemap search database server request response latency view model '
+         'the a of and to in is it that for on with as this was').split()
+
+def percentile(values, fraction):
+    '''Nearest-rank percentile of a list of numbers'''
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+@contextmanager
+def private_cache():
+    '''
+    Swap the configured caches for a locmem cache of this process, so the
+    benchmark neither flushes nor fills the cache the live site uses
+    '''
+    caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                          'LOCATION': 'blogengine-benchmark'}}
+    with override_settings(CACHES=caches, CACHE_MIDDLEWARE_ALIAS='default'):
+        shared = django.core.cache.cache
+        private = get_cache('default')
+        # Modules that imported django.core.cache.cache hold it themselves
+        modules = [module for module in sys.modules.values()
+                   if getattr(module, 'cache', None) is shared]
+        for module in modules:
+            module.cache = private
+        caching._memoized.clear()
+        try:
+            yield private
+        finally:
+            for module in modules:
+                module.cache = shared
+            caching._memoized.clear()
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks every blog view, feed, search and sitemap against '
+            'generated posts in a throwaway test database, and writes the '
+            'latency, query and allocation figures as JSON.')
+    option_list = BaseCommand.option_list + (
+        make_option('--posts', dest='posts', default='1000,10000,100000',
+                    help='Comma separated corpus sizes to benchmark'),
+        make_option('--requests', type='int', dest='requests', default=20,
+                    help='Number of requests per URL'),
+        make_option('--warm-cache', action='store_true', dest='warm_cache', default=False,
+                    help="Keep the cache between requests instead of clearing it"),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Seed for the generated posts'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write the JSON results to'),
+        make_option('--compare', dest='compare', default=None,
+                    help='Earlier JSON results to compare p50 latencies with'),
+    )
+
+    def paragraph(self, rng):
+        words = [rng.choice(WORDS) for i in range(rng.randint(20, 80))]
+        return ' '.join(words).capitalize() + '.'
+
+    def markdown(self, rng):
+        '''Post text with the markdown a real post uses'''
+        blocks = []
+        for i in range(rng.randint(2, 8)):
+            kind = rng.random()
+            if kind < 0.1:
+                blocks.append('## ' + self.paragraph(rng)[:40])
+            elif kind < 0.2:
+                blocks.append('\n'.join('* ' + self.paragraph(rng)[:60] for j in range(3)))
+            elif kind < 0.3:
+                blocks.append("```python\ndef %s():\n    return %r\n```" % (
+                    rng.choice(WORDS), rng.choice(WORDS)))
+            else:
+                blocks.append(self.paragraph(rng).replace(
+                    ' cache ', ' [cache](http://example.com/) ').replace(' query ', ' *query* '))
+        return '\n\n'.join(blocks)
+
+    def generate_corpus(self, size, rng):
+        '''Add posts until there are size of them'''
+        from blogengine.tests import (AuthorFactory, CategoryFactory, PostFactory,
+                                      SiteFactory, TagFactory)
+        author = AuthorFactory()
+        site = SiteFactory()
+        categories = [CategoryFactory(name='category %d' % i, slug='category-%d' % i,
+                                      description='Category %d' % i) for i in range(10)]
+        tags = [TagFactory(name='tag %d' % i, slug='tag-%d' % i,
+                           description='Tag %d' % i) for i in range(50)]
+        # A few tags are on many posts, most on few
+        weights = [1.0 / (rank + 1) for rank in range(len(tags))]
+        start = timezone.now() - timedelta(days=size)
+
+        number = Post.objects.count()
+        while number < size:
+            batch = []
+            for i in range(number, min(number + 1000, size)):
+                post = PostFactory.build(
+                    title='Post %d %s' % (i, rng.choice(WORDS)), slug='post-%d' % i,
+                    text=self.markdown(rng), pub_date=start + timedelta(days=i, seconds=rng.randint(0, 86399)),
+                    author=author, site=site, category=rng.choice(categories))
+                post.render_text()
+                batch.append(post)
+            # Bulk inserts skip the per-post signals, which are redone once below
+            Post.objects.bulk_create(batch)
+            pks = Post.objects.filter(slug__in=[post.slug for post in batch]).values_list('slug', 'pk')
+            through = []
+            for slug, pk in pks:
+                chosen = set()
+                for j in range(min(int(rng.expovariate(0.5)), 8)):
+                    chosen.add(self.weighted_choice(rng, tags, weights))
+                through.extend(Post.tags.through(post_id=pk, tag_id=tag.pk) for tag in chosen)
+            Post.tags.through.objects.bulk_create(through)
+            if denormalize_taxonomy():
+                refresh_taxonomies(pk for slug, pk in pks)
+            number += len(batch)
+
+        rebuild_counts()
+        get_search_backend().rebuild()
+        invalidate(dependency('posts', site.pk))
+
+    def weighted_choice(self, rng, items, weights):
+        point = rng.random() * sum(weights)
+        for item, weight in zip(items, weights):
+            point -= weight
+            if point <= 0:
+                return item
+        return items[-1]
+
+    def get_urls(self, rng):
+        '''Name and URL of every kind of page, with samples of posts'''
+        posts = Post.objects.count()
+        category = Category.objects.order_by('pk')[0]
+        tag = Tag.objects.order_by('pk')[0]
+        urls = [
+            ('index', '/'),
+            ('index_last_page', '/%d/' % ((posts - 1) // 5 + 1)),
+            ('category', category.get_absolute_url()),
+            ('tag', tag.get_absolute_url()),
+            ('feed', '/feeds/posts/'),
+            ('category_feed', '/feeds/posts/category/%s/' % category.slug),
+            ('tag_feed', '/feeds/posts/tag/%s/' % tag.slug),
+            ('search', '/search?q=django+cache'),
+            ('sitemap', '/sitemap.xml'),
+            ('sitemap_posts', '/sitemap-posts.xml'),
+            ('sitemap_pages', '/sitemap-pages.xml'),
+        ]
+        # Second pages, where the corpus is large enough to have them
+        if posts > 5:
+            urls.append(('index_page_2', '/2/'))
+        if category.post_set.count() > 5:
+            urls.append(('category_page_2', category.get_absolute_url() + '?page=2'))
+        if len(search_posts('python')) > 5:
+            urls.append(('search_page_2', '/search?q=python&page=2'))
+        sample = Post.objects.filter(pk__in=[rng.randint(1, posts) for i in range(3)])
+        for number, post in enumerate(sample):
+            urls.append(('post_%d' % (number + 1), post.get_absolute_url()))
+        return urls
+
+    def measure(self, url, requests, warm_cache=False):
+        '''Latency, queries and allocations of requesting url'''
+        client = Client()
+        timings, queries, allocations = [], [], []
+        for i in range(requests):
+            if not warm_cache:
+                self.cache.clear()
+                caching._memoized.clear()
+            context = CaptureQueriesContext(connection)
+            if tracemalloc:
+                tracemalloc.start()
+            else:
+                gc.collect()
+                gc.disable()
+                before = gc.get_count()[0]
+            with context:
+                start = time.time()
+                response = client.get(url)
+                if response.streaming:
+                    ''.join(response.streaming_content)
+                timings.append((time.time() - start) * 1000)
+            if tracemalloc:
+                allocations.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            else:
+                allocations.append(gc.get_count()[0] - before)
+                gc.enable()
+            queries.append(len(context))
+            if response.status_code != 200:
+                raise CommandError('%s answered %d' % (url, response.status_code))
+        return {
+            'url': url,
+            'p50_ms': round(percentile(timings, 0.5), 3),
+            'p99_ms': round(percentile(timings, 0.99), 3),
+            'mean_ms': round(sum(timings) / len(timings), 3),
+            'queries': max(queries),
+            'allocations': max(allocations),
+        }
+
+    def benchmark(self, sizes, requests, warm_cache, seed):
+        rng = random.Random(seed)
+        results = {}
+        with private_cache() as self.cache:
+            for size in sorted(sizes):
+                start = time.time()
+                self.generate_corpus(size, rng)
+                corpus = {'setup_seconds': round(time.time() - start, 1), 'urls': {}}
+                self.stdout.write('%d posts (generated in %.1fs)' % (size, corpus['setup_seconds']))
+                for name, url in self.get_urls(random.Random(seed)):
+                    stats = self.measure(url, requests, warm_cache)
+                    corpus['urls'][name] = stats
+                    self.stdout.write('  %-20s p50 %8.2fms  p99 %8.2fms  %3d queries  %8d allocations' % (
+                        name, stats['p50_ms'], stats['p99_ms'], stats['queries'], stats['allocations']))
+                results[str(size)] = corpus
+        return results
+
+    def compare(self, results, path):
+        with open(path) as f:
+            previous = json.load(f)['corpora']
+        self.stdout.write('Compared with %s:' % path)
+        for size, corpus in sorted(results.items()):
+            for name, stats in sorted(corpus['urls'].items()):
+                try:
+                    before = previous[size]['urls'][name]['p50_ms']
+                except KeyError:
+                    continue
+                if before:
+                    self.stdout.write('  %6s %-20s %+6.0f%%' % (
+                        size, name, (stats['p50_ms'] / before - 1) * 100))
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['posts'].split(',')]
+        except ValueError:
+            raise CommandError('--posts takes numbers separated by commas')
+
+        # Use a fresh, migrated test database so real posts are left alone
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            results = self.benchmark(sizes, options['requests'],
+                                     options['warm_cache'], options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'requests': options['requests'],
+            'warm_cache': options['warm_cache'],
+            'allocations': 'peak bytes' if tracemalloc else 'net gc objects',
+            'corpora': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        if options['compare']:
+            self.compare(results, options['compare'])
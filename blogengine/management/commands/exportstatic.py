@@ -0,0 +1,193 @@
+import hashlib
+import json
+import multiprocessing
+import os
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import override_settings
+from blogengine.models import Category, Post, Tag
+
+MANIFEST = '.manifest.json'
+
+# As paginate_by in urls.py
+POSTS_PER_PAGE = 5
+
+# Left out while rendering: a page cached before its rows changed would
+# be written out under the new fingerprint
+CACHE_MIDDLEWARE = (
+    'blogengine.middleware.UpdateCacheMiddleware',
+    'blogengine.middleware.FetchFromCacheMiddleware',
+    'django.middleware.cache.UpdateCacheMiddleware',
+    'django.middleware.cache.FetchFromCacheMiddleware',
+    'django.middleware.cache.CacheMiddleware',
+)
+
+def _fingerprint(*parts):
+    return hashlib.md5(repr(parts)).hexdigest()
+
+def _output_path(url, extension='html'):
+    '''File a URL is written to: directories get an index file'''
+    path = url.lstrip('/')
+    if not path or path.endswith('/'):
+        path += 'index.' + extension
+    return path
+
+def _render_page(args):
+    '''Fetch one URL through the Django stack, past the page cache, and write it out'''
+    url, path, output, host = args
+    middleware = [name for name in settings.MIDDLEWARE_CLASSES if name not in CACHE_MIDDLEWARE]
+    with override_settings(MIDDLEWARE_CLASSES=middleware):
+        response = Client(HTTP_HOST=host).get(url)
+    if response.status_code != 200:
+        return url, response.status_code
+    if response.streaming:
+        content = ''.join(response.streaming_content)
+    else:
+        content = response.content
+    filename = os.path.join(output, path)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'wb') as f:
+        f.write(content)
+    return url, response.status_code
+
+
+class Command(BaseCommand):
+    help = ('Renders the blog to static HTML and XML files for a CDN or Cling to '
+            'serve. Pages whose posts, categories, tags and flat pages are '
+            'unchanged since the last export are skipped. Pages after the '
+            'first of categories, tags and sitemap sections are linked with a '
+            'query string and not exported.')
+    args = '<output directory>'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes',
+                    default=multiprocessing.cpu_count(),
+                    help='Number of processes rendering pages'),
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help='Render every page, even if unchanged'),
+    )
+
+    def get_pages(self):
+        '''
+        (url, output path, fingerprint) of every page of the blog. The
+        fingerprint is a hash of the rows the page is rendered from. Only
+        the site of SITE_ID is exported, as its domain is fetched.
+        '''
+        site_id = settings.SITE_ID
+        flatpages = list(FlatPage.objects.filter(sites=site_id).order_by('pk')
+                         .values_list('pk', 'url', 'title', 'content'))
+        # Every page shows the flat pages in its navigation
+        nav = _fingerprint([page[:3] for page in flatpages])
+
+        categories = dict((row[0], row) for row in
+                          Category.objects.for_site(site_id).values_list('pk', 'name', 'slug'))
+        tags = dict((row[0], row) for row in
+                    Tag.objects.for_site(site_id).values_list('pk', 'name', 'slug'))
+        post_tags = {}
+        for post_pk, tag_pk in (Post.tags.through.objects.filter(post__site=site_id)
+                                .order_by('pk').values_list('post_id', 'tag_id')):
+            post_tags.setdefault(post_pk, []).append(tags[tag_pk])
+        posts = list(Post.objects.for_site(site_id).order_by('pk').values_list(
+            'pk', 'title', 'slug', 'pub_date', 'text_hash', 'renderer_version', 'category_id'))
+
+        # Listings, feeds and sitemaps change whenever anything does
+        everything = _fingerprint(nav, posts, sorted(categories.items()),
+                                  sorted(post_tags.items()), flatpages)
+
+        pages = [('/', everything)]
+        num_pages = (len(posts) - 1) // POSTS_PER_PAGE + 1
+        pages.extend(('/%d/' % number, everything) for number in range(2, num_pages + 1))
+
+        # A post page only changes with the post, its category and tags
+        for row in posts:
+            post = Post(pk=row[0], slug=row[2], pub_date=row[3])
+            pages.append((post.get_absolute_url(), _fingerprint(
+                nav, row, categories.get(row[6]), post_tags.get(row[0]))))
+
+        # Only the first page of each category and tag: later ones are
+        # linked with ?page= and left to Django
+        for pk, name, slug in categories.values():
+            pages.append((Category(slug=slug).get_absolute_url(), everything))
+        for pk, name, slug in tags.values():
+            pages.append((Tag(slug=slug).get_absolute_url(), everything))
+
+        # The same for the year, month and day archives, which are in UTC
+        # as the dates from the database are
+        days = set((row[3].year, row[3].month, row[3].day) for row in posts)
+        archives = set()
+        for date in days:
+            archives.update((date[:1], date[:2], date))
+        for parts in sorted(archives):
+            pages.append(('/archive/%s/' % '/'.join(str(part) for part in parts), everything))
+
+        for page in flatpages:
+            pages.append((page[1], _fingerprint(nav, page)))
+
+        pages = [(url, _output_path(url), fingerprint) for url, fingerprint in pages]
+
+        # Feeds and sitemaps are XML. Only the first page of each sitemap
+        # section: the index links the others with ?p=
+        xml = ['/feeds/posts/', reverse('blogengine:django.contrib.sitemaps.views.index')]
+        xml.extend('/feeds/posts/category/%s/' % slug for pk, name, slug in categories.values())
+        xml.extend('/feeds/posts/tag/%s/' % slug for pk, name, slug in tags.values())
+        for section in ('posts', 'pages'):
+            xml.append(reverse('blogengine:django.contrib.sitemaps.views.sitemap',
+                               kwargs={'section': section}))
+        pages.extend((url, _output_path(url, 'xml'), everything) for url in xml)
+        return pages
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the directory to export to')
+        output = os.path.abspath(args[0])
+        manifest_path = os.path.join(output, MANIFEST)
+        manifest = {}
+        if not options['full'] and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        pages = self.get_pages()
+        todo = [(url, path) for url, path, fingerprint in pages
+                if manifest.get(url) != [path, fingerprint] or
+                not os.path.exists(os.path.join(output, path))]
+
+        # Render the changed pages, in parallel if asked to
+        host = Site.objects.get_current().domain
+        jobs = [(url, path, output, host) for url, path in todo]
+        if options['processes'] > 1 and len(jobs) > 1:
+            # Each process opens its own database connection
+            connection.close()
+            pool = multiprocessing.Pool(options['processes'])
+            try:
+                results = pool.map(_render_page, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_render_page(job) for job in jobs]
+
+        failed = set(url for url, status in results if status != 200)
+        for url in sorted(failed):
+            self.stderr.write('Could not render %s' % url)
+
+        # Remove pages that no longer exist, e.g. deleted posts
+        current = set(url for url, path, fingerprint in pages)
+        for url in set(manifest) - current:
+            filename = os.path.join(output, manifest[url][0])
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        manifest = dict((url, [path, fingerprint]) for url, path, fingerprint in pages
+                        if url not in failed)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+        self.stdout.write('Rendered %d of %d pages to %s' % (
+            len(todo) - len(failed), len(pages), output))
@@ -0,0 +1,298 @@
+import codecs
+import json
+import os
+import re
+import time
+from datetime import date, datetime
+from optparse import make_option
+
+import yaml
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.text import slugify
+from blogengine.caching import dependency, invalidate
+from blogengine.models import (Category, Post, Tag, denormalize_taxonomy, rebuild_counts,
+                               taxonomy_json, update_posts)
+from blogengine.rendering import render_many, renderer_version, source_hash
+from blogengine.search import get_backend as get_search_backend
+
+# As the post URL matches it, within the 40 characters of Post.slug
+SLUG = re.compile(r'^[a-zA-Z0-9-]{1,40}$')
+FRONT_MATTER = re.compile(r'\A---[ \t]*\r?\n(.*?)\r?\n---[ \t]*(?:\r?\n|\Z)(.*)\Z', re.DOTALL)
+MARKDOWN_EXTENSIONS = ('.md', '.markdown')
+
+def read_markdown(path):
+    '''A post from a Markdown file starting with YAML front matter'''
+    with codecs.open(path, encoding='utf-8') as f:
+        content = f.read()
+    match = FRONT_MATTER.match(content)
+    if match is None:
+        raise ValueError('no front matter')
+    record = yaml.safe_load(match.group(1)) or {}
+    if not isinstance(record, dict):
+        raise ValueError('front matter is not a mapping')
+    record.setdefault('text', match.group(2).strip('\n'))
+    return record
+
+def read_records(source):
+    '''(where, record) of each post in a directory or a JSON Lines file, in a stable order'''
+    if os.path.isdir(source):
+        for directory, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(MARKDOWN_EXTENSIONS):
+                    path = os.path.join(directory, filename)
+                    try:
+                        yield path, read_markdown(path)
+                    except (ValueError, yaml.YAMLError) as e:
+                        raise CommandError('%s: %s' % (path, e))
+    else:
+        with codecs.open(source, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                where = '%s:%d' % (source, number)
+                try:
+                    yield where, json.loads(line)
+                except ValueError as e:
+                    raise CommandError('%s: %s' % (where, e))
+
+def parse_pub_date(value):
+    '''A datetime from a YAML or JSON date, naive ones in the current time zone'''
+    if isinstance(value, basestring):
+        value = parse_datetime(value) or parse_date(value)
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if not isinstance(value, datetime):
+        raise ValueError('no valid pub_date')
+    if settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value
+
+def parse_tags(value):
+    '''Tag names from a list or a comma separated string'''
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return [unicode(name).strip() for name in value if unicode(name).strip()]
+
+def label_slug(name):
+    '''Slug of a category or tag name, raising ValueError if its URL wouldn't work'''
+    slug = slugify(name)[:40]
+    if not SLUG.match(slug):
+        raise ValueError('no slug of letters, digits and hyphens can be made from %r' % name)
+    return slug
+
+def clean_record(record):
+    '''The fields of a post from an imported record, raising ValueError if invalid'''
+    if not isinstance(record, dict):
+        raise ValueError('not an object')
+    title = record.get('title')
+    if not title:
+        raise ValueError('no title')
+    slug = unicode(record.get('slug') or slugify(unicode(title))[:40])
+    if not SLUG.match(slug):
+        raise ValueError('slug %r is not up to 40 letters, digits and hyphens' % slug)
+    category = record.get('category') and unicode(record['category']).strip()
+    tags = parse_tags(record.get('tags'))
+    # Else labels without a slug would all be merged into one
+    for name in ([category] if category else []) + tags:
+        label_slug(name)
+    return {
+        'title': unicode(title),
+        'slug': slug,
+        'pub_date': parse_pub_date(record.get('pub_date') or record.get('date')),
+        'text': unicode(record.get('text') or ''),
+        'author': record.get('author'),
+        'category': category,
+        'tags': tags,
+    }
+
+
+class Command(BaseCommand):
+    args = '<directory or .jsonl file>'
+    help = ('Imports posts from a directory of Markdown files with YAML front '
+            'matter (title, slug, date, category, tags, author) or from a JSON '
+            'Lines file with the same keys and a text. Posts whose slug exists '
+            'are updated. Rows are written in batches without per-post signals, '
+            'and progress is checkpointed so an interrupted import resumes.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='Number of posts to write per transaction'),
+        make_option('--site', type='int', dest='site', default=None,
+                    help='Id of the site to import into, SITE_ID by default'),
+        make_option('--author', dest='author', default=None,
+                    help='Username of posts without an author, the first superuser by default'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File recording progress, <source>.checkpoint by default'),
+        make_option('--restart', action='store_true', dest='restart', default=False,
+                    help='Ignore the checkpoint and import from the start'),
+    )
+
+    def get_author(self, username):
+        if username not in self.authors:
+            try:
+                self.authors[username] = User.objects.get(username=username).pk
+            except User.DoesNotExist:
+                raise CommandError('No user %r' % username)
+        return self.authors[username]
+
+    def get_labels(self, model, names):
+        '''Categories or tags of the site by name, created if missing'''
+        by_slug = dict((label_slug(name), name) for name in names)
+        found = dict((label.slug, label) for label in
+                     model.objects.for_site(self.site).filter(slug__in=by_slug.keys()))
+        missing = [model(site=self.site, name=name, slug=slug, description='')
+                   for slug, name in by_slug.items() if slug not in found]
+        if missing:
+            # No signals: rebuild_counts() counts their posts at the end
+            model.objects.bulk_create(missing)
+            found.update((label.slug, label) for label in model.objects.for_site(self.site).filter(
+                slug__in=[label.slug for label in missing]))
+        return dict((name, found[label_slug(name)]) for name in names)
+
+    def import_batch(self, records):
+        '''Insert or update a batch of cleaned records: (number of posts, pks of updated ones)'''
+        # A slug given twice is imported as its last version
+        records = dict((record['slug'], record) for record in records).values()
+        slugs = [record['slug'] for record in records]
+        existing = dict(Post.objects.for_site(self.site).filter(slug__in=slugs).values_list('slug', 'pk'))
+        categories = self.get_labels(Category, set(record['category'] for record in records
+                                                   if record['category']))
+        tags = self.get_labels(Tag, set(name for record in records for name in record['tags']))
+
+        # One call so the render pool, if any, works on the batch in parallel
+        html = render_many([record['text'] for record in records])
+        version = renderer_version()
+        now = timezone.now()
+        created = []
+        updated = {}
+        post_tags = {}
+        for record, rendered_text in zip(records, html):
+            category = categories.get(record['category'])
+            # Names differing only in case or punctuation are the same tag
+            post_tags[record['slug']] = dict((tags[name].pk, tags[name])
+                                             for name in record['tags']).values()
+            fields = {
+                'title': record['title'],
+                'text': record['text'],
+                'pub_date': record['pub_date'],
+                'author_id': self.get_author(record['author']) if record['author'] else self.author,
+                'category_id': category and category.pk,
+                'rendered_text': rendered_text,
+                'text_hash': source_hash(record['text']),
+                'renderer_version': version,
+            }
+            if denormalize_taxonomy():
+                fields['taxonomy'] = taxonomy_json(
+                    category and (category.slug, category.name),
+                    [(tag.slug, tag.name) for tag in post_tags[record['slug']]])
+            if record['slug'] in existing:
+                # update() takes foreign keys by field name
+                fields['author'] = fields.pop('author_id')
+                fields['category'] = fields.pop('category_id')
+                fields['updated_at'] = now
+                updated[existing[record['slug']]] = fields
+            else:
+                created.append(Post(site=self.site, slug=record['slug'], **fields))
+        update_posts(updated)
+        Post.objects.bulk_create(created)
+
+        pks = dict(Post.objects.for_site(self.site).filter(slug__in=slugs).values_list('slug', 'pk'))
+        through = Post.tags.through
+        through.objects.filter(post_id__in=existing.values()).delete()
+        through.objects.bulk_create([
+            through(post_id=pks[slug], tag_id=tag.pk)
+            for slug in slugs for tag in post_tags[slug]])
+
+        backend = get_search_backend()
+        for record in records:
+            backend.index_post(Post(pk=pks[record['slug']], title=record['title'], text=record['text']))
+        return len(records), existing.values()
+
+    def read_checkpoint(self, path):
+        if not os.path.exists(path):
+            return {'done': 0, 'updated': []}
+        with open(path) as f:
+            return json.load(f)
+
+    def write_checkpoint(self, path, checkpoint):
+        # Renamed into place so an interruption never leaves half a file
+        with open(path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.rename(path + '.tmp', path)
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the directory or JSON Lines file to import')
+        source = os.path.abspath(args[0])
+        if not os.path.exists(source):
+            raise CommandError('%s does not exist' % source)
+        batch_size = options['batch_size']
+        checkpoint_path = options['checkpoint'] or source.rstrip(os.sep) + '.checkpoint'
+
+        try:
+            self.site = Site.objects.get(pk=options['site'] or settings.SITE_ID)
+        except Site.DoesNotExist:
+            raise CommandError('No site %s' % (options['site'] or settings.SITE_ID))
+        self.authors = {}
+        if options['author']:
+            self.author = self.get_author(options['author'])
+        else:
+            superusers = User.objects.filter(is_superuser=True).order_by('pk')[:1]
+            if not superusers:
+                raise CommandError('Give the --author of the posts')
+            self.author = superusers[0].pk
+
+        checkpoint = {'done': 0, 'updated': []}
+        if not options['restart']:
+            checkpoint = self.read_checkpoint(checkpoint_path)
+            if checkpoint['done']:
+                self.stdout.write('Resuming after %d posts' % checkpoint['done'])
+
+        started = time.time()
+        imported = updated = 0
+        batch = []
+        for position, (where, record) in enumerate(read_records(source), 1):
+            if position <= checkpoint['done']:
+                continue
+            try:
+                batch.append(clean_record(record))
+            except ValueError as e:
+                raise CommandError('%s: %s' % (where, e))
+            if len(batch) < batch_size:
+                continue
+            written, updated_pks = self.import_batch_atomically(batch)
+            imported += written
+            updated += len(updated_pks)
+            batch = []
+            checkpoint = {'done': position, 'updated': checkpoint['updated'] + updated_pks}
+            self.write_checkpoint(checkpoint_path, checkpoint)
+            self.stdout.write('%d posts imported, %.0f posts/s' % (
+                imported, imported / max(time.time() - started, 1e-6)))
+        if batch:
+            written, updated_pks = self.import_batch_atomically(batch)
+            imported += written
+            updated += len(updated_pks)
+            checkpoint['updated'] += updated_pks
+
+        # Once for the whole import, including runs that were interrupted
+        rebuild_counts()
+        invalidate(dependency('posts', self.site.pk),
+                   *[dependency('post', pk) for pk in set(checkpoint['updated'])])
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        elapsed = time.time() - started
+        self.stdout.write('Imported %d posts (%d new, %d updated) in %.1fs, %.0f posts/s' % (
+            imported, imported - updated, updated, elapsed, imported / max(elapsed, 1e-6)))
+
+    def import_batch_atomically(self, batch):
+        with transaction.atomic():
+            return self.import_batch(batch)
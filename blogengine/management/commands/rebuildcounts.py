@@ -0,0 +1,15 @@
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+from blogengine.caching import dependency, invalidate
+from blogengine.models import ArchiveMonth, rebuild_counts
+
+class Command(BaseCommand):
+    help = ('Recounts the posts of every tag, category and month, which signals '
+            'otherwise keep up to date, e.g. after bulk inserts')
+
+    def handle(self, *args, **options):
+        rebuild_counts()
+        # The tag cloud and archive widgets are cached under the posts of each site
+        invalidate(*[dependency('posts', pk) for pk in Site.objects.values_list('pk', flat=True)])
+        self.stdout.write('Recounted posts of every tag and category, and %d months' %
+                          ArchiveMonth.objects.count())
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from blogengine.search import get_backend
+
+class Command(BaseCommand):
+    help = 'Reindexes every post in the search backend'
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        backend.rebuild()
+        self.stdout.write('Rebuilt search index with %s' % backend.__class__.__name__)
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from blogengine.models import Post, batches_by_pk, build_taxonomies, update_posts
+
+class Command(BaseCommand):
+    help = ('Stores the category and tags of every post on the post, for '
+            'BLOGENGINE_DENORMALIZE_TAXONOMY, or with --check reports the posts '
+            'where they drifted')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='Number of posts to load per query'),
+        make_option('--check', action='store_true', dest='check', default=False,
+                    help="Only report posts whose stored category and tags are wrong"),
+    )
+
+    def handle(self, *args, **options):
+        checked = 0
+        drifted = []
+        for batch in batches_by_pk(Post.objects.values_list('pk', 'taxonomy'), options['batch_size']):
+            checked += len(batch)
+            built = build_taxonomies([pk for pk, taxonomy in batch])
+            changed = dict((pk, {'taxonomy': built[pk]}) for pk, taxonomy in batch
+                           if built[pk] != taxonomy)
+            drifted.extend(sorted(changed))
+            if not options['check']:
+                update_posts(changed)
+
+        if options['check']:
+            if drifted:
+                raise CommandError('%d of %d posts have a stale category or tags: %s' % (
+                    len(drifted), checked, ', '.join(str(pk) for pk in drifted)))
+            self.stdout.write('All %d posts are up to date' % checked)
+        else:
+            self.stdout.write('Updated %d of %d posts' % (len(drifted), checked))
@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from blogengine.models import Post, batches_by_pk, update_posts
+from blogengine.rendering import render_many, renderer_version, source_hash
+
+class Command(BaseCommand):
+    help = 'Renders the markdown of every post whose stored HTML is stale'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Number of posts to load per query'),
+        make_option('--force', action='store_true', dest='force', default=False,
+                    help='Re-render every post, even if up to date'),
+    )
+
+    def handle(self, *args, **options):
+        force = options['force']
+        checked = rendered = 0
+        for batch in batches_by_pk(Post.objects.all(), options['batch_size']):
+            checked += len(batch)
+            stale = [post for post in batch if force or post.is_render_stale()]
+            # One call so the render pool, if any, works on the batch in parallel
+            update_posts(dict((post.pk, {
+                'rendered_text': html,
+                'text_hash': source_hash(post.text),
+                'renderer_version': renderer_version(),
+                'updated_at': timezone.now(),
+            }) for post, html in zip(stale, render_many([post.text for post in stale]))))
+            rendered += len(stale)
+
+        self.stdout.write('Rendered %d of %d posts' % (rendered, checked))
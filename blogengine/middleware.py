@@ -0,0 +1,347 @@
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.urlresolvers import resolve
+from django.http import Http404
+from django.http.response import HttpResponseBase
+from django.middleware import cache as cache_middleware
+from django.utils.cache import get_cache_key, get_max_age, has_vary_header, learn_cache_key, patch_response_headers
+from blogengine import caching, instrumentation
+from blogengine.hosts import current_site_id
+
+logger = logging.getLogger('blogengine.performance')
+cache_logger = logging.getLogger('blogengine.cache')
+
+def should_refresh_early(expires, delta, beta, now=None, rand=None):
+    '''
+    Probabilistic early expiry: the closer an entry is to expiring and the
+    longer it took to build, the likelier a request rebuilds it early, so
+    one request usually does it before the entry expires for everyone.
+    '''
+    if not beta or not delta:
+        return False
+    now = time.time() if now is None else now
+    rand = random.random() if rand is None else rand
+    return now - delta * beta * math.log(rand or 1e-12) >= expires
+
+
+class PageCache(caching.DependencyCache):
+    '''
+    Stores pages for BLOGENGINE_CACHE_STALE_SECONDS longer than their
+    timeout, with when they expire and how long they took to build, so
+    an expired or invalidated page can still be served while one request
+    builds the new one.
+    '''
+    def set(self, key, value, timeout=None):
+        if not isinstance(value, HttpResponseBase):
+            return super(PageCache, self).set(key, value, timeout)
+        timeout = self.backend.default_timeout if timeout is None else timeout
+        versions = getattr(value, 'cache_versions', None)
+        if versions is None:
+            versions = caching.get_versions(getattr(value, 'cache_dependencies', ()), self.backend)
+        entry = (value, versions, time.time() + timeout, getattr(value, 'cache_build_time', 0))
+        stale = getattr(settings, 'BLOGENGINE_CACHE_STALE_SECONDS', 60)
+        self.backend.set(key, entry, timeout + stale)
+
+    def get_page(self, key):
+        '''The page stored under key and whether it is current, expired or missing'''
+        entry = self.backend.get(key)
+        if entry is None or len(entry) != 4:
+            # Missing, or stored by the plain dependency cache
+            return None, 'missing'
+        response, versions, expires, build_time = entry
+        if versions and caching.get_versions(versions.keys(), self.backend) != versions:
+            return response, 'stale'
+        if time.time() >= expires:
+            return response, 'stale'
+        beta = getattr(settings, 'BLOGENGINE_CACHE_EARLY_EXPIRY_BETA', 1.0)
+        if should_refresh_early(expires, build_time, beta):
+            return response, 'stale'
+        return response, 'current'
+
+
+def site_key_prefix(key_prefix, request):
+    '''Cache key prefix of the site request is for, so sites never share pages'''
+    return '%s.site%s' % (key_prefix, current_site_id(request))
+
+def lock_key(cache_key):
+    return 'blogengine:lock:%s' % cache_key
+
+def url_key(request, key_prefix):
+    '''What to lock a page on before it has a cache key, from its URL like Django's keys'''
+    return '%s.url.%s' % (key_prefix, hashlib.md5(request.build_absolute_uri()).hexdigest())
+
+def uncached_key(url_key):
+    '''Set while the page at a URL is known not to be cached, e.g. a feed'''
+    return 'blogengine:uncached:%s' % url_key
+
+_handler = None
+
+def refresh_in_background(request, cache_key):
+    '''Build the page again on a thread, through the whole middleware stack'''
+    global _handler
+    if _handler is None:
+        from django.core.handlers.wsgi import WSGIHandler
+        _handler = WSGIHandler()
+    environ = dict(request.environ)
+    environ['blogengine.cache_refresh'] = cache_key
+
+    def refresh():
+        try:
+            response = _handler(environ, lambda status, headers, exc_info=None: None)
+            # Fires request_finished, which closes the thread's connections
+            response.close()
+        except Exception:
+            cache_logger.exception('Refreshing %s failed', request.path)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+
+class UpdateCacheMiddleware(cache_middleware.UpdateCacheMiddleware):
+    '''
+    Per-site cache that stores each page with the dependencies the view
+    recorded through caching.add_dependencies(), so saving a post only
+    expires the pages built from it instead of clearing the whole cache.
+    Pages of each of the sites served are kept under their own keys.
+    '''
+    def __init__(self):
+        super(UpdateCacheMiddleware, self).__init__()
+        self.cache = PageCache(self.cache)
+
+    def release_lock(self, request):
+        if getattr(request, '_cache_lock_key', None):
+            self.cache.delete(request._cache_lock_key)
+            request._cache_lock_key = None
+
+    def get_versions(self, request, deps):
+        '''
+        Versions of deps from before the page was built, so a change made
+        while it was leaves the stored page stale instead of current
+        '''
+        snapshot = getattr(request, 'cache_versions', {})
+        versions = caching.get_versions([dep for dep in deps if dep not in snapshot],
+                                        self.cache.backend)
+        versions.update((dep, snapshot[dep]) for dep in deps if dep in snapshot)
+        # A post page records its post once loaded; if the site's posts
+        # changed since the request started, keep their old version too
+        if snapshot and caching.get_versions(snapshot.keys(), self.cache.backend) != snapshot:
+            versions.update(snapshot)
+        return versions
+
+    def store(self, request, response):
+        '''Django's UpdateCacheMiddleware, with the key prefix of the site'''
+        if not self._should_update_cache(request, response):
+            return response
+        if response.streaming or response.status_code != 200:
+            return response
+        # Don't cache responses that set a user-specific (and maybe security
+        # sensitive) cookie in response to a cookie-less request.
+        if not request.COOKIES and response.cookies and has_vary_header(response, 'Cookie'):
+            return response
+        timeout = get_max_age(response)
+        if timeout is None:
+            timeout = self.cache_timeout
+        elif timeout == 0:
+            return response
+        dated = response.has_header('Last-Modified')
+        patch_response_headers(response, timeout)
+        if not dated:
+            # Django dates the page when it is cached, but lists and feeds
+            # leave the date out on purpose, see blogengine.conditional
+            del response['Last-Modified']
+        if timeout:
+            # The key must outlive the page, which is kept stale for a while
+            # after it expires, or expired pages would be rebuilt unlocked
+            stale = getattr(settings, 'BLOGENGINE_CACHE_STALE_SECONDS', 60)
+            cache_key = learn_cache_key(request, response, timeout + stale,
+                                        site_key_prefix(self.key_prefix, request), cache=self.cache)
+            if hasattr(response, 'render') and callable(response.render):
+                response.add_post_render_callback(
+                    lambda r: self.cache.set(cache_key, r, timeout))
+            else:
+                self.cache.set(cache_key, response, timeout)
+            request._cache_stored = True
+        return response
+
+    def process_response(self, request, response):
+        site_id = current_site_id(request)
+        deps = set(getattr(request, 'cache_dependencies', None) or
+                   caching.site_dependencies(caching.FALLBACK_DEPENDENCIES, site_id))
+        deps.update(caching.site_dependencies(caching.DEFAULT_DEPENDENCIES, site_id))
+        response.cache_dependencies = deps
+        response.cache_versions = self.get_versions(request, deps)
+        if hasattr(request, '_cache_started'):
+            response.cache_build_time = time.time() - request._cache_started
+        response = self.store(request, response)
+        if getattr(request, '_cache_url_key', None) and not getattr(request, '_cache_stored', False):
+            # Streamed, not found, not modified or never_cache: later
+            # requests for the URL needn't lock on it, there is nothing to wait for
+            self.cache.backend.set(uncached_key(request._cache_url_key), 1, self.cache_timeout)
+        # Let waiting requests in once the new page is stored
+        if hasattr(response, 'render') and not getattr(response, 'is_rendered', True):
+            response.add_post_render_callback(lambda r: self.release_lock(request))
+        else:
+            self.release_lock(request)
+        return response
+
+
+class FetchFromCacheMiddleware(cache_middleware.FetchFromCacheMiddleware):
+    '''
+    Serves pages stored by UpdateCacheMiddleware while still current.
+
+    When a page has expired, been invalidated or is chosen for early
+    expiry, only the request taking its lock builds it again; the others
+    are served the old page meanwhile, or with BLOGENGINE_CACHE_BACKGROUND_REFRESH
+    every request is and the page is rebuilt on a thread. When there is
+    no page at all, requests wait up to BLOGENGINE_CACHE_LOCK_WAIT seconds
+    for the lock holder to store it instead of all building it at once.
+    '''
+    def __init__(self):
+        super(FetchFromCacheMiddleware, self).__init__()
+        self.cache = PageCache(self.cache)
+
+    def acquire_lock(self, cache_key):
+        timeout = getattr(settings, 'BLOGENGINE_CACHE_LOCK_SECONDS', 10)
+        return self.cache.add(lock_key(cache_key), 1, timeout)
+
+    def rebuild(self, request, cache_key):
+        request._cache_update_cache = True
+        request._cache_started = time.time()
+        # What any page of the site may show, before the view reads it
+        kinds = caching.FALLBACK_DEPENDENCIES + caching.DEFAULT_DEPENDENCIES
+        request.cache_versions = caching.get_versions(
+            set(caching.site_dependencies(kinds, current_site_id(request))), self.cache.backend)
+        return None
+
+    def get_page_key(self, request, key_prefix):
+        '''Cache key of the page, None until it has been cached'''
+        cache_key = get_cache_key(request, key_prefix, 'GET', cache=self.cache)
+        if cache_key is None and request.method == 'HEAD':
+            cache_key = get_cache_key(request, key_prefix, 'HEAD', cache=self.cache)
+        return cache_key
+
+    def wait_for_page(self, request, key_prefix, locked):
+        '''
+        The page the holder of the lock on locked stores within
+        BLOGENGINE_CACHE_LOCK_WAIT seconds, None if it released the lock
+        without storing one
+        '''
+        deadline = time.time() + getattr(settings, 'BLOGENGINE_CACHE_LOCK_WAIT', 2.0)
+        while time.time() < deadline:
+            time.sleep(0.05)
+            # Checked first, so a page stored just before the release is found
+            released = self.cache.backend.get(lock_key(locked)) is None
+            cache_key = self.get_page_key(request, key_prefix)
+            if cache_key is not None:
+                response, state = self.cache.get_page(cache_key)
+                if response is not None:
+                    return response
+            if released:
+                return None
+        return None
+
+    def process_request(self, request):
+        if not request.method in ('GET', 'HEAD'):
+            request._cache_update_cache = False
+            return None
+
+        refreshing = request.META.get('blogengine.cache_refresh')
+        if refreshing:
+            # Background refresh, which already holds the lock
+            request._cache_lock_key = lock_key(refreshing)
+            return self.rebuild(request, refreshing)
+
+        key_prefix = site_key_prefix(self.key_prefix, request)
+        cache_key = self.get_page_key(request, key_prefix)
+        response = None
+        if cache_key is not None:
+            response, state = self.cache.get_page(cache_key)
+            if state == 'current':
+                instrumentation.add('cache_hits')
+                request._cache_update_cache = False
+                return response
+        instrumentation.add('cache_misses')
+
+        # Lock on the page, or on its URL if it was never cached, so only
+        # one request builds it
+        locked = cache_key or url_key(request, key_prefix)
+        if cache_key is None and self.cache.backend.get(uncached_key(locked)):
+            # Last built without being cached: nothing to wait for
+            return self.rebuild(request, cache_key)
+        if self.acquire_lock(locked):
+            if response is not None and getattr(settings, 'BLOGENGINE_CACHE_BACKGROUND_REFRESH', False):
+                # The refresh releases the lock when done
+                refresh_in_background(request, cache_key)
+                request._cache_update_cache = False
+                return response
+            request._cache_lock_key = lock_key(locked)
+            if cache_key is None:
+                request._cache_url_key = locked
+            return self.rebuild(request, cache_key)
+
+        if response is None:
+            # Nothing to serve: wait for the lock holder's page
+            response = self.wait_for_page(request, key_prefix, locked)
+            if response is None:
+                return self.rebuild(request, cache_key)
+        # Someone else is building the new page
+        request._cache_update_cache = False
+        return response
+
+
+class SiteMiddleware(object):
+    '''Sets request.site_id to the site whose domain the request is for'''
+    def process_request(self, request):
+        request.site_id = current_site_id(request)
+
+
+class PerformanceMiddleware(object):
+    '''
+    Records query count and time, template and markdown render time and
+    cache hits and misses of each blogengine request in the histograms of
+    blogengine.instrumentation. Goes first so cached responses are counted.
+    '''
+    def __init__(self):
+        instrumentation.install()
+        self.last_logged = time.time()
+
+    def process_request(self, request):
+        request._performance_start = time.time()
+        instrumentation.start_request()
+
+    def get_url_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            # Answered from the cache before the URL was resolved
+            try:
+                match = resolve(request.path_info)
+            except Http404:
+                return None
+        if match.namespace != 'blogengine' or match.url_name == 'performance':
+            return None
+        return match.url_name
+
+    def process_response(self, request, response):
+        metrics = instrumentation.finish_request()
+        if metrics is None or not hasattr(request, '_performance_start'):
+            return response
+        name = self.get_url_name(request)
+        if name is None:
+            return response
+
+        metrics['total_ms'] = (time.time() - request._performance_start) * 1000
+        instrumentation.observe(name, metrics)
+
+        interval = getattr(settings, 'BLOGENGINE_PERFORMANCE_LOG_INTERVAL', None)
+        if interval and time.time() - self.last_logged >= interval:
+            self.last_logged = time.time()
+            logger.info(json.dumps(instrumentation.performance_stats(), sort_keys=True))
+        return response
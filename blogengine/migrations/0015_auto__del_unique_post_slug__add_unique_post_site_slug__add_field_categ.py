@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Removing unique constraint on 'Tag', fields ['slug']
+        db.delete_unique(u'blogengine_tag', ['slug'])
+
+        # Removing unique constraint on 'Category', fields ['slug']
+        db.delete_unique(u'blogengine_category', ['slug'])
+
+        # Removing unique constraint on 'Post', fields ['slug']
+        db.delete_unique(u'blogengine_post', ['slug'])
+
+        # Adding unique constraint on 'Post', fields ['site', 'slug']
+        db.create_unique(u'blogengine_post', ['site_id', 'slug'])
+
+        # Adding field 'Category.site'
+        db.add_column(u'blogengine_category', 'site',
+                      self.gf('django.db.models.fields.related.ForeignKey')(default=1, to=orm['sites.Site']),
+                      keep_default=False)
+
+        # Adding field 'Tag.site'
+        db.add_column(u'blogengine_tag', 'site',
+                      self.gf('django.db.models.fields.related.ForeignKey')(default=1, to=orm['sites.Site']),
+                      keep_default=False)
+
+        # Categories and tags already in use belong to the site of their
+        # posts. One used on several sites goes to the lowest of them here,
+        # and 0016 copies it to the others
+        if not db.dry_run:
+            db.execute('UPDATE blogengine_category SET site_id = COALESCE((SELECT MIN(site_id) '
+                       'FROM blogengine_post WHERE blogengine_post.category_id = blogengine_category.id), '
+                       'site_id)')
+            db.execute('UPDATE blogengine_tag SET site_id = COALESCE((SELECT MIN(blogengine_post.site_id) '
+                       'FROM blogengine_post JOIN blogengine_post_tags '
+                       'ON blogengine_post_tags.post_id = blogengine_post.id '
+                       'WHERE blogengine_post_tags.tag_id = blogengine_tag.id), site_id)')
+
+        # Adding unique constraint on 'Category', fields ['site', 'slug']
+        db.create_unique(u'blogengine_category', ['site_id', 'slug'])
+
+        # Adding unique constraint on 'Tag', fields ['site', 'slug']
+        db.create_unique(u'blogengine_tag', ['site_id', 'slug'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'Tag', fields ['site', 'slug']
+        db.delete_unique(u'blogengine_tag', ['site_id', 'slug'])
+
+        # Removing unique constraint on 'Category', fields ['site', 'slug']
+        db.delete_unique(u'blogengine_category', ['site_id', 'slug'])
+
+        # Removing unique constraint on 'Post', fields ['site', 'slug']
+        db.delete_unique(u'blogengine_post', ['site_id', 'slug'])
+
+        # Adding unique constraint on 'Post', fields ['slug']
+        db.create_unique(u'blogengine_post', ['slug'])
+
+        # Deleting field 'Category.site'
+        db.delete_column(u'blogengine_category', 'site_id')
+
+        # Adding unique constraint on 'Category', fields ['slug']
+        db.create_unique(u'blogengine_category', ['slug'])
+
+        # Deleting field 'Tag.site'
+        db.delete_column(u'blogengine_tag', 'site_id')
+
+        # Adding unique constraint on 'Tag', fields ['slug']
+        db.create_unique(u'blogengine_tag', ['slug'])
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Group']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Permission']"}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'blogengine.archivemonth': {
+            'Meta': {'ordering': "['-year', '-month']", 'unique_together': "(('site', 'year', 'month'),)", 'object_name': 'ArchiveMonth'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'month': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'post_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['sites.Site']"}),
+            'year': ('django.db.models.fields.PositiveIntegerField', [], {})
+        },
+        u'blogengine.category': {
+            'Meta': {'unique_together': "(('site', 'slug'),)", 'object_name': 'Category'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'post_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'default': '1', 'to': u"orm['sites.Site']"}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '40', 'null': 'True', 'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'blogengine.post': {
+            'Meta': {'ordering': "['-pub_date']", 'unique_together': "(('site', 'slug'),)", 'object_name': 'Post', 'index_together': "[('site', 'pub_date')]"},
+            'author': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"}),
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['blogengine.Category']", 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'pub_date': ('django.db.models.fields.DateTimeField', [], {}),
+            'rendered_text': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'renderer_version': ('django.db.models.fields.CharField', [], {'max_length': '100', 'blank': 'True'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'default': '1', 'to': u"orm['sites.Site']"}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '40'}),
+            'tags': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'to': u"orm['blogengine.Tag']", 'null': 'True', 'blank': 'True'}),
+            'taxonomy': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'text': ('django.db.models.fields.TextField', [], {}),
+            'text_hash': ('django.db.models.fields.CharField', [], {'max_length': '40', 'blank': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'blogengine.tag': {
+            'Meta': {'unique_together': "(('site', 'slug'),)", 'object_name': 'Tag'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'post_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'site': ('django.db.models.fields.related.ForeignKey', [], {'default': '1', 'to': u"orm['sites.Site']"}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '40', 'null': 'True', 'blank': 'True'}),
+            'updated_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'sites.site': {
+            'Meta': {'ordering': "(u'domain',)", 'object_name': 'Site', 'db_table': "u'django_site'"},
+            'domain': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['blogengine']
\ No newline at end of file
@@ -1,14 +1,52 @@
-from django.db import models
-from django.db.models.signals import post_save
+from collections import Counter
+from datetime import datetime, timedelta
+import json
+import sys
+import threading
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connection, models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, post_syncdb, pre_delete, pre_save
 from django.contrib.auth.models import User
+from django.contrib.flatpages.models import FlatPage
 from django.contrib.sites.models import Site
-from django.core.cache import cache
+from django.utils import timezone
+from django.utils.timezone import utc
+from django.utils.functional import cached_property
 from django.utils.text import slugify
+from blogengine.caching import dependency, invalidate
+from blogengine.rendering import get_pool, render_later, render_markdown, renderer_version, source_hash
+from blogengine.search import get_backend as get_search_backend
+
+def default_site_id():
+    return settings.SITE_ID
+
+class SiteQuerySet(models.query.QuerySet):
+    def for_site(self, site):
+        '''Only the rows of one site, given as a Site or its id'''
+        return self.filter(site=site)
+
+class SiteManager(models.Manager):
+    '''Manager of models with a site, which every view scopes them to'''
+    queryset_class = SiteQuerySet
+
+    def get_queryset(self):
+        return self.queryset_class(self.model, using=self._db)
+
+    def for_site(self, site):
+        return self.get_queryset().for_site(site)
 
 class Tag(models.Model):
+    site = models.ForeignKey(Site, default=default_site_id)
     name = models.CharField(max_length=200)
     description = models.TextField()
-    slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
+    slug = models.SlugField(max_length=40, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Kept by signals, see recount_tags()
+    post_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = SiteManager()
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -21,10 +59,19 @@ class Tag(models.Model):
     def __unicode__(self):
         return self.name
 
+    class Meta:
+        unique_together = ('site', 'slug')
+
 class Category(models.Model):
+    site = models.ForeignKey(Site, default=default_site_id)
     name = models.CharField(max_length=200)
     description = models.TextField()
-    slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
+    slug = models.SlugField(max_length=40, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Kept by signals, see recount_categories()
+    post_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = SiteManager()
 
     def save(self, *args, **kwargs):
         # If slug is not set, create slug using slugify
@@ -40,16 +87,136 @@ class Category(models.Model):
 
     class Meta:
         verbose_name_plural = 'categories'
+        unique_together = ('site', 'slug')
+
+def denormalize_taxonomy():
+    '''Whether posts keep their category and tags in Post.taxonomy'''
+    return getattr(settings, 'BLOGENGINE_DENORMALIZE_TAXONOMY', False)
+
+class Label(object):
+    '''Slug and name of a category or tag, as shown on a post'''
+    def __init__(self, kind, slug, name):
+        self.kind = kind
+        self.slug = slug
+        self.name = name
+
+    def get_absolute_url(self):
+        return "/%s/%s/" % (self.kind, self.slug)
+
+    def __unicode__(self):
+        return self.name
+
+class PostQuerySet(SiteQuerySet):
+    def for_listing(self):
+        '''Newest first, with the category and tags listings show'''
+        if denormalize_taxonomy():
+            # Stored on the posts
+            return self.order_by('-pub_date', '-pk')
+        return self.select_related('category').prefetch_related('tags').order_by('-pub_date', '-pk')
+
+class PostManager(SiteManager):
+    queryset_class = PostQuerySet
+
+    def for_listing(self):
+        return self.get_queryset().for_listing()
 
 class Post(models.Model):
     title = models.CharField(max_length=200)
     pub_date = models.DateTimeField()
     text = models.TextField()
-    slug = models.SlugField(max_length=40, unique=True)
+    slug = models.SlugField(max_length=40)
     author = models.ForeignKey(User)
-    site = models.ForeignKey(Site)
+    site = models.ForeignKey(Site, default=default_site_id)
     category = models.ForeignKey(Category, blank=True, null=True)
     tags = models.ManyToManyField(Tag, blank=True, null=True)
+    # Bumped on every save and when tags are added or removed
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Markdown rendered at save time so views and feeds don't have to
+    rendered_text = models.TextField(blank=True, editable=False)
+    text_hash = models.CharField(max_length=40, blank=True, editable=False)
+    renderer_version = models.CharField(max_length=100, blank=True, editable=False)
+
+    # Category and tags as JSON, kept with BLOGENGINE_DENORMALIZE_TAXONOMY
+    # so listings don't join them
+    taxonomy = models.TextField(blank=True, editable=False)
+
+    objects = PostManager()
+
+    def is_render_stale(self):
+        return (self.text_hash != source_hash(self.text) or
+                self.renderer_version != renderer_version())
+
+    def render_text(self, force=False):
+        '''Re-render the stored HTML if the text or renderer changed.
+        Returns True if the render was refreshed.'''
+        if not force and not self.is_render_stale():
+            return False
+        self.rendered_text = render_markdown(self.text)
+        self.text_hash = source_hash(self.text)
+        self.renderer_version = renderer_version()
+        return True
+
+    def get_rendered_text(self):
+        '''The post text as HTML, rendering on the fly if not yet stored'''
+        if self.is_render_stale():
+            return render_markdown(self.text)
+        return self.rendered_text
+
+    @cached_property
+    def labels(self):
+        '''Category and tags, from Post.taxonomy when it is kept'''
+        if denormalize_taxonomy() and self.taxonomy:
+            data = json.loads(self.taxonomy)
+        else:
+            data = json.loads(taxonomy_json(
+                self.category and (self.category.slug, self.category.name),
+                [(tag.slug, tag.name) for tag in self.tags.all()]))
+        category = data['category'] and Label('category', *data['category'])
+        return category, [Label('tag', slug, name) for slug, name in data['tags']]
+
+    @property
+    def category_label(self):
+        return self.labels[0]
+
+    @property
+    def tag_labels(self):
+        return self.labels[1]
+
+    def queue_render(self):
+        '''Render the saved text in the background, storing the HTML once done'''
+        pk, text_hash = self.pk, self.text_hash
+
+        def store(html):
+            self.rendered_text = html
+            self.renderer_version = renderer_version()
+            # Unless the text was edited again meanwhile
+            Post.objects.filter(pk=pk, text_hash=text_hash, renderer_version='').update(
+                rendered_text=html, renderer_version=self.renderer_version)
+
+        render_later(self.text, store)
+
+    def save(self, *args, **kwargs):
+        '''
+        With render=False the text is rendered in the background, once the
+        request has finished if saved in a transaction. Until then the empty
+        renderer_version makes pages render it on the fly.
+        '''
+        render = kwargs.pop('render', True)
+        pending = False
+        if render:
+            self.render_text()
+        elif self.is_render_stale():
+            self.text_hash = source_hash(self.text)
+            self.renderer_version = ''
+            pending = True
+        super(Post, self).save(*args, **kwargs)
+        if pending:
+            if get_pool() is not None and transaction.get_connection().in_atomic_block:
+                # The pool's connection can't see the row until it is committed
+                defer_render(self)
+            else:
+                self.queue_render()
 
     def get_absolute_url(self):
         return "/%s/%s/%s/" % (self.pub_date.year, self.pub_date.month, self.slug)
@@ -59,11 +226,327 @@ class Post(models.Model):
 
     class Meta:
         ordering = ["-pub_date"]
+        # Slugs are per site. Date archives seek a site's posts by pub_date
+        unique_together = ('site', 'slug')
+        index_together = [('site', 'pub_date')]
+
+# Posts of this thread's request saved inside a transaction, e.g. by the
+# admin, whose renders are queued once the request has finished
+_deferred = threading.local()
+
+def defer_render(post):
+    if not hasattr(_deferred, 'posts'):
+        _deferred.posts = []
+    _deferred.posts.append(post)
+
+def queue_deferred_renders(sender, **kwargs):
+    '''Gets called when a request finishes, after its transaction committed'''
+    posts, _deferred.posts = getattr(_deferred, 'posts', []), []
+    for post in posts:
+        post.queue_render()
+
+def taxonomy_json(category, tags):
+    '''Post.taxonomy for a (slug, name) category, or None, and tags'''
+    return json.dumps({'category': category and list(category),
+                       'tags': sorted([slug, name] for slug, name in tags)},
+                      separators=(',', ':'))
+
+def build_taxonomies(post_pks):
+    '''Post.taxonomy of each post, from its category and tags, by pk'''
+    rows = Post.objects.filter(pk__in=post_pks).values_list('pk', 'category__slug', 'category__name')
+    tags = {}
+    for post_pk, slug, name in Post.tags.through.objects.filter(post_id__in=post_pks).values_list(
+            'post_id', 'tag__slug', 'tag__name'):
+        tags.setdefault(post_pk, []).append((slug, name))
+    return dict((pk, taxonomy_json(slug and (slug, name), tags.get(pk, [])))
+                for pk, slug, name in rows)
+
+def chunks(items, size=500):
+    '''Lists of at most size of items, as SQLite limits the number of query parameters'''
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def batches_by_pk(queryset, batch_size):
+    '''
+    Lists of at most batch_size rows of queryset, walking the table in
+    primary key order so each batch is one cheap query. values_list()
+    rows must start with the pk.
+    '''
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last = batch[-1]
+        last_pk = last[0] if isinstance(last, tuple) else last.pk
+
+def update_posts(fields_by_pk):
+    '''Write fields to each post, with update() rather than save() so no post_save signals fire'''
+    for pk, fields in fields_by_pk.items():
+        Post.objects.filter(pk=pk).update(**fields)
+
+def refresh_taxonomies(post_pks):
+    '''Store the category and tags of posts on them, where they changed'''
+    for chunk in chunks(post_pks):
+        stored = dict(Post.objects.filter(pk__in=chunk).values_list('pk', 'taxonomy'))
+        update_posts(dict((pk, {'taxonomy': taxonomy})
+                          for pk, taxonomy in build_taxonomies(chunk).items()
+                          if stored.get(pk) != taxonomy))
+
+class ArchiveMonth(models.Model):
+    '''Number of posts a site published in a month, kept by signals'''
+    site = models.ForeignKey(Site)
+    year = models.PositiveIntegerField()
+    month = models.PositiveIntegerField()
+    post_count = models.PositiveIntegerField(default=0)
+
+    def get_absolute_url(self):
+        return "/archive/%s/%s/" % (self.year, self.month)
+
+    def __unicode__(self):
+        return '%04d-%02d' % (self.year, self.month)
+
+    class Meta:
+        unique_together = ('site', 'year', 'month')
+        ordering = ['-year', '-month']
+
+def month_of(post):
+    '''(site id, year, month) a post is archived under, in UTC like the archives'''
+    pub_date = post.pub_date
+    # Forms give dates in the current time zone
+    if timezone.is_aware(pub_date):
+        pub_date = timezone.localtime(pub_date, utc)
+    return (post.site_id, pub_date.year, pub_date.month)
+
+def _recount(model, column, pks=None):
+    '''Set post_count of some rows of model, or all, from the posts pointing at them'''
+    if model is Tag:
+        posts_table = Post.tags.through._meta.db_table
+    else:
+        posts_table = Post._meta.db_table
+    table = model._meta.db_table
+    sql = 'UPDATE %s SET post_count = (SELECT COUNT(*) FROM %s WHERE %s.%s = %s.id)' % (
+        table, posts_table, posts_table, column, table)
+    cursor = connection.cursor()
+    if pks is None:
+        cursor.execute(sql)
+        return
+    for chunk in chunks(set(pk for pk in pks if pk is not None)):
+        cursor.execute(sql + ' WHERE id IN (%s)' % ', '.join(['%s'] * len(chunk)), chunk)
+
+def recount_tags(pks=None):
+    '''Count the posts of some tags, or all of them, with one UPDATE'''
+    _recount(Tag, 'tag_id', pks)
+
+def recount_categories(pks=None):
+    '''Count the posts of some categories, or all of them, with one UPDATE'''
+    _recount(Category, 'category_id', pks)
+
+def month_range(year, month):
+    '''Start and end of a month in UTC, which post URLs use'''
+    return (datetime(year, month, 1, tzinfo=utc),
+            datetime(year + month // 12, month % 12 + 1, 1, tzinfo=utc))
+
+def date_range(year, month=None, day=None):
+    '''Start and end of a year, month or day in UTC, like month_range'''
+    if day is not None:
+        start = datetime(year, month, day, tzinfo=utc)
+        return start, start + timedelta(days=1)
+    if month is not None:
+        return month_range(year, month)
+    return datetime(year, 1, 1, tzinfo=utc), datetime(year + 1, 1, 1, tzinfo=utc)
+
+def recount_months(months):
+    '''Count the posts of some (site id, year, month)s'''
+    for site_id, year, month in set(months):
+        start, end = month_range(year, month)
+        count = Post.objects.filter(site_id=site_id, pub_date__gte=start, pub_date__lt=end).count()
+        archive = ArchiveMonth.objects.filter(site_id=site_id, year=year, month=month)
+        if not count:
+            archive.delete()
+        elif not archive.update(post_count=count):
+            ArchiveMonth.objects.create(site_id=site_id, year=year, month=month, post_count=count)
+
+def rebuild_archive():
+    '''Recount every month of every site in one pass over the posts'''
+    counts = Counter((site_id, pub_date.year, pub_date.month) for site_id, pub_date in
+                     Post.objects.values_list('site_id', 'pub_date').iterator())
+    with transaction.atomic():
+        ArchiveMonth.objects.all().delete()
+        ArchiveMonth.objects.bulk_create([
+            ArchiveMonth(site_id=site_id, year=year, month=month, post_count=count)
+            for (site_id, year, month), count in counts.items()])
+
+def rebuild_counts():
+    '''Recount the posts of every tag, category and month'''
+    recount_tags()
+    recount_categories()
+    rebuild_archive()
 
 # Define signals
-def new_post(sender, instance, created, **kwargs):
-    '''Gets called when new post is created or saved'''
-    cache.clear()
+def post_changed(sender, instance, **kwargs):
+    '''Gets called when a post is saved or deleted'''
+    deps = [dependency('post', instance.pk), dependency('posts', instance.site_id)]
+    previous = getattr(instance, '_counted', None)
+    if previous is not None and previous[1][0] != instance.site_id:
+        # Moved from another site
+        deps.append(dependency('posts', previous[1][0]))
+    invalidate(*deps)
+
+def post_saved(sender, instance, **kwargs):
+    '''Gets called when a post is saved'''
+    get_search_backend().index_post(instance)
+    if denormalize_taxonomy():
+        refresh_taxonomies([instance.pk])
+
+def post_deleted(sender, instance, **kwargs):
+    '''Gets called when a post is deleted'''
+    get_search_backend().remove_post(instance.pk)
+    recount_tags(getattr(instance, '_counted_tag_pks', []))
+    recount_categories([instance.category_id])
+    recount_months([month_of(instance)])
+
+def post_saving(sender, instance, raw, **kwargs):
+    '''Gets called before a post is saved'''
+    # Where the post was counted before, to move it
+    instance._counted = None
+    if instance.pk and not raw:
+        instance._counted = next(((category_id, (site_id, pub_date.year, pub_date.month))
+                                  for category_id, site_id, pub_date in
+                                  Post.objects.filter(pk=instance.pk).values_list(
+                                      'category_id', 'site_id', 'pub_date')), None)
+
+def post_counted(sender, instance, created, raw, **kwargs):
+    '''Gets called when a post is saved, to keep the post counts'''
+    counted = (instance.category_id, month_of(instance))
+    previous = getattr(instance, '_counted', None)
+    if raw or counted == previous:
+        return
+    categories, months = [counted[0]], [counted[1]]
+    if previous is not None:
+        categories.append(previous[0])
+        months.append(previous[1])
+    recount_categories(categories)
+    recount_months(months)
+
+def post_deleting(sender, instance, **kwargs):
+    '''Gets called before a post is deleted'''
+    # Its tags can't be looked up once it's gone
+    instance._counted_tag_pks = list(instance.tags.values_list('pk', flat=True))
+
+def posts_flushed(sender, **kwargs):
+    '''Gets called after syncdb and flush, which may empty the post table'''
+    get_search_backend().purge()
+
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''Gets called when tags are added to or removed from posts'''
+    # clear() doesn't say which posts or tags there were afterwards
+    if action == 'pre_clear' and reverse:
+        instance._cleared_pks = list(instance.post_set.values_list('pk', flat=True))
+    elif action == 'pre_clear':
+        instance._cleared_pks = list(instance.tags.values_list('pk', flat=True))
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Changed from the tag side: tag.post_set.add(post)
+        post_pks = pk_set or getattr(instance, '_cleared_pks', [])
+        tag_pks = [instance.pk]
+    else:
+        post_pks = [instance.pk]
+        tag_pks = pk_set or getattr(instance, '_cleared_pks', [])
+    # update() so no post_save signals fire again
+    Post.objects.filter(pk__in=post_pks).update(updated_at=timezone.now())
+    recount_tags(tag_pks)
+    if denormalize_taxonomy():
+        refresh_taxonomies(post_pks)
+    deps = [dependency('tag', pk) for pk in tag_pks]
+    deps.extend(dependency('post', pk) for pk in post_pks)
+    # Posts and their tags are on the same site
+    invalidate(dependency('posts', instance.site_id), *deps)
+
+def category_changed(sender, instance, **kwargs):
+    '''Gets called when a category is saved or deleted'''
+    # Listings show the category of each post
+    invalidate(dependency('category', instance.pk), dependency('posts', instance.site_id))
+
+def category_saved(sender, instance, **kwargs):
+    '''Gets called when a category is saved'''
+    # save() wrote back the post count it was loaded with
+    recount_categories([instance.pk])
+    if denormalize_taxonomy():
+        refresh_taxonomies(instance.post_set.values_list('pk', flat=True))
+
+def tag_changed(sender, instance, **kwargs):
+    '''Gets called when a tag is saved or deleted'''
+    invalidate(dependency('tag', instance.pk), dependency('posts', instance.site_id))
+    # save() wrote back the post count it was loaded with
+    recount_tags([instance.pk])
+    if denormalize_taxonomy():
+        refresh_taxonomies(getattr(instance, '_deleted_post_pks', None) or
+                           instance.post_set.values_list('pk', flat=True))
+
+def tag_deleting(sender, instance, **kwargs):
+    '''Gets called before a tag is deleted'''
+    if denormalize_taxonomy():
+        # Its posts can't be looked up once it's gone
+        instance._deleted_post_pks = list(instance.post_set.values_list('pk', flat=True))
+
+def flatpage_changed(sender, instance, **kwargs):
+    '''Gets called when a flat page is saved or deleted'''
+    # Every page of its sites lists the flat pages in its navigation
+    site_pks = getattr(instance, '_site_pks', None)
+    if site_pks is None:
+        site_pks = instance.sites.values_list('pk', flat=True)
+    invalidate(dependency('flatpage', instance.pk),
+               *[dependency('flatpages', pk) for pk in site_pks])
+
+def flatpage_deleting(sender, instance, **kwargs):
+    '''Gets called before a flat page is deleted'''
+    # Its sites can't be looked up once it's gone
+    instance._site_pks = list(instance.sites.values_list('pk', flat=True))
+
+def flatpage_sites_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''Gets called when a flat page is added to or removed from sites'''
+    # clear() doesn't say which sites there were afterwards
+    if action == 'pre_clear' and not reverse:
+        instance._cleared_pks = list(instance.sites.values_list('pk', flat=True))
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # Changed from the site side: site.flatpage_set.add(flatpage)
+        site_pks = [instance.pk]
+    else:
+        site_pks = pk_set or getattr(instance, '_cleared_pks', [])
+    invalidate(*[dependency('flatpages', pk) for pk in site_pks])
+
+def site_changed(sender, instance, **kwargs):
+    '''Gets called when a site is saved or deleted'''
+    # Hosts are resolved to sites from a cached list of their domains
+    invalidate(dependency('sites'))
 
-# Setup signals: connect to post save signal
-post_save.connect(new_post, sender=Post)
\ No newline at end of file
+# Setup signals: only expire cached pages built from what changed. Counts
+# and stored data are updated first so pages built after the expiry see them
+pre_save.connect(post_saving, sender=Post)
+post_save.connect(post_counted, sender=Post)
+pre_delete.connect(post_deleting, sender=Post)
+post_delete.connect(post_deleted, sender=Post)
+post_save.connect(post_saved, sender=Post)
+post_save.connect(post_changed, sender=Post)
+post_delete.connect(post_changed, sender=Post)
+post_syncdb.connect(posts_flushed, sender=sys.modules[__name__])
+m2m_changed.connect(post_tags_changed, sender=Post.tags.through)
+post_save.connect(category_changed, sender=Category)
+post_delete.connect(category_changed, sender=Category)
+post_save.connect(category_saved, sender=Category)
+post_save.connect(tag_changed, sender=Tag)
+pre_delete.connect(tag_deleting, sender=Tag)
+post_delete.connect(tag_changed, sender=Tag)
+post_save.connect(flatpage_changed, sender=FlatPage)
+pre_delete.connect(flatpage_deleting, sender=FlatPage)
+post_delete.connect(flatpage_changed, sender=FlatPage)
+m2m_changed.connect(flatpage_sites_changed, sender=FlatPage.sites.through)
+post_save.connect(site_changed, sender=Site)
+post_delete.connect(site_changed, sender=Site)
+request_finished.connect(queue_deferred_renders)
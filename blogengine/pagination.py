@@ -0,0 +1,171 @@
+'''
+Pagination for post listings.
+
+Page numbers (/2/, ?page=2) use OFFSET/LIMIT, which gets slower the deeper
+the page. Keyset pagination instead continues from the (pub_date, id) of
+the last post shown: ?after=<cursor> for older posts, ?before=<cursor> for
+newer ones. It is used when BLOGENGINE_KEYSET_PAGINATION is on and the
+request doesn't ask for a page number, or whenever a cursor is given.
+
+Either way the total used for the page-number widget is counted once and
+cached until a post of the site changes.
+'''
+import calendar
+import hashlib
+from datetime import datetime
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.http import Http404
+from django.utils import timezone
+from django.utils.encoding import smart_str
+from blogengine import caching
+from blogengine.hosts import current_site_id
+
+def cached_count(queryset, site_id=None):
+    '''Number of rows in queryset, cached until a post of the site changes'''
+    if queryset.query.is_empty():
+        return 0
+    key = 'blogengine:count:%s' % hashlib.md5(smart_str(queryset.query)).hexdigest()
+    deps = [caching.dependency('posts', site_id or settings.SITE_ID)]
+    versions = caching.get_versions(deps)
+    count = caching.fetch(key)
+    if count is None:
+        count = queryset.count()
+        caching.store(key, count, deps, versions=versions)
+    return count
+
+def encode_cursor(post, number):
+    '''Cursor pointing at post, which is shown on page number'''
+    stamp = calendar.timegm(post.pub_date.utctimetuple()) * 1000000 + post.pub_date.microsecond
+    return '%d.%d.%d' % (stamp, post.pk, number)
+
+def decode_cursor(cursor):
+    '''The (pub_date, pk, page number) a cursor points at'''
+    try:
+        stamp, pk, number = [int(part) for part in cursor.split('.')]
+        pub_date = datetime.utcfromtimestamp(stamp // 1000000).replace(microsecond=stamp % 1000000)
+    except (ValueError, OverflowError, OSError):
+        # Not three numbers, or a timestamp out of datetime's range
+        raise Http404('Invalid cursor')
+    if settings.USE_TZ:
+        pub_date = timezone.make_aware(pub_date, timezone.utc)
+    return pub_date, pk, number
+
+
+class CachedCountPaginator(Paginator):
+    '''Paginator that counts the object list once until a post of the site changes'''
+    def __init__(self, object_list, per_page, site_id=None, **kwargs):
+        super(CachedCountPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.site_id = site_id
+
+    def _get_count(self):
+        if self._count is None:
+            if hasattr(self.object_list, 'query'):
+                self._count = cached_count(self.object_list, self.site_id)
+            else:
+                self._count = len(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+class KeysetPage(object):
+    '''A page of posts found by seeking from a cursor'''
+    def __init__(self, object_list, number, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return max(self.number - 1, 1)
+
+    @property
+    def next_query(self):
+        return '?after=%s' % encode_cursor(self.object_list[-1], self.number + 1)
+
+    @property
+    def previous_query(self):
+        return '?before=%s' % encode_cursor(self.object_list[0], self.number - 1)
+
+
+class KeysetPaginator(CachedCountPaginator):
+    '''Pages through posts newest first, seeking on (pub_date, id)'''
+    def page_after(self, cursor=None):
+        '''The page of posts older than cursor, or the first page'''
+        posts = self.object_list.order_by('-pub_date', '-pk')
+        number = 1
+        if cursor:
+            pub_date, pk, number = decode_cursor(cursor)
+            posts = posts.filter(Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=pk))
+        posts = list(posts[:self.per_page + 1])
+        if cursor and not posts:
+            # Nothing older any more, e.g. after deletes
+            return self.page_after()
+        return KeysetPage(posts[:self.per_page], number, self,
+                          has_previous=bool(cursor), has_next=len(posts) > self.per_page)
+
+    def page_before(self, cursor):
+        '''The page of posts newer than cursor'''
+        pub_date, pk, number = decode_cursor(cursor)
+        posts = self.object_list.order_by('pub_date', 'pk').filter(
+            Q(pub_date__gt=pub_date) | Q(pub_date=pub_date, pk__gt=pk))
+        posts = list(posts[:self.per_page + 1])
+        if not posts:
+            # Nothing newer any more, e.g. after deletes
+            return self.page_after()
+        has_previous = len(posts) > self.per_page
+        posts = posts[:self.per_page]
+        posts.reverse()
+        return KeysetPage(posts, max(number, 1), self,
+                          has_previous=has_previous, has_next=True)
+
+
+class KeysetPaginationMixin(object):
+    '''
+    For ListViews of posts: pages with cursors when enabled, and falls back
+    to page numbers so existing URLs keep working.
+    '''
+    paginator_class = CachedCountPaginator
+
+    def use_keyset(self):
+        params = self.request.GET
+        if 'after' in params or 'before' in params:
+            return True
+        if self.kwargs.get('page') or params.get('page'):
+            return False
+        return getattr(settings, 'BLOGENGINE_KEYSET_PAGINATION', False)
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        kwargs.setdefault('site_id', current_site_id(self.request))
+        return super(KeysetPaginationMixin, self).get_paginator(queryset, per_page, **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_keyset():
+            return super(KeysetPaginationMixin, self).paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size, site_id=current_site_id(self.request))
+        if 'before' in self.request.GET:
+            page = paginator.page_before(self.request.GET['before'])
+        else:
+            page = paginator.page_after(self.request.GET.get('after'))
+        return (paginator, page, page.object_list, page.has_other_pages())
@@ -0,0 +1,176 @@
+'''
+Markdown rendering, optionally in a pool of processes.
+
+With BLOGENGINE_MARKDOWN_PROCESSES set, texts of at least
+BLOGENGINE_MARKDOWN_POOL_MIN_LENGTH characters are rendered by a pool of that
+many processes, so rendering long, code heavy posts is bounded and runs
+outside the worker's interpreter. A request waits BLOGENGINE_MARKDOWN_TIMEOUT seconds
+for the pool, then renders the text itself. Admin saves queue the render
+and store it when done; render_many() renders batches across the pool.
+
+Each process keeps up to BLOGENGINE_MARKDOWN_INSTANCES markdown2.Markdown
+objects set up with BLOGENGINE_MARKDOWN_EXTRAS, and lends them to one
+render at a time, rather than building one, and compiling its regexes, for
+every text. Code blocks go through blogengine.highlighting's cache before
+Pygments, or whatever set_highlight_hook() installs.
+'''
+from contextlib import contextmanager
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+
+import markdown2
+
+from django.conf import settings
+from django.db import connection
+from django.utils.encoding import force_unicode, smart_str
+from blogengine import highlighting, instrumentation
+
+logger = logging.getLogger('blogengine.rendering')
+
+# Bump whenever the HTML produced for the same source text changes, e.g.
+# after upgrading markdown2, so stored renders get picked up by
+# ./manage.py rendermarkdown
+RENDERER_VERSION = 1
+
+# Default for BLOGENGINE_MARKDOWN_EXTRAS: a list of markdown2 extras, or a
+# dict of extras and their options
+MARKDOWN_EXTRAS = ['fenced-code-blocks']
+
+def get_extras():
+    return getattr(settings, 'BLOGENGINE_MARKDOWN_EXTRAS', MARKDOWN_EXTRAS)
+
+def renderer_version():
+    '''Identifies the renderer and the extras it runs with'''
+    extras = get_extras()
+    version = '%s:%s' % (RENDERER_VERSION, ','.join(sorted(extras)))
+    options = sorted(item for item in getattr(extras, 'items', list)() if item[1])
+    if options:
+        version += ':' + hashlib.md5(repr(options)).hexdigest()[:8]
+    return version
+
+def source_hash(text):
+    '''Hash of the markdown source, used to detect stale renders'''
+    return hashlib.sha1(smart_str(text)).hexdigest()
+
+# Code blocks seen before are served from the highlight cache
+_highlight_hook = highlighting.cache.highlight
+
+def set_highlight_hook(hook):
+    '''
+    Have code blocks highlighted by hook(codeblock, lexer, formatter_opts,
+    highlight) instead of highlight(codeblock, lexer, **formatter_opts),
+    which runs Pygments. None to remove it.
+    '''
+    global _highlight_hook
+    _highlight_hook = hook
+
+
+class BlogMarkdown(markdown2.Markdown):
+    def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
+        highlight = super(BlogMarkdown, self)._color_with_pygments
+        if _highlight_hook is None:
+            return highlight(codeblock, lexer, **formatter_opts)
+        return _highlight_hook(codeblock, lexer, formatter_opts, highlight)
+
+
+_instances = []
+_instances_extras = None
+_instances_lock = threading.Lock()
+
+@contextmanager
+def markdown_instance():
+    '''Borrow a Markdown object set up with the configured extras'''
+    global _instances_extras
+    extras = get_extras()
+    with _instances_lock:
+        if extras != _instances_extras:
+            # The settings changed
+            del _instances[:]
+            _instances_extras = extras
+        instance = _instances.pop() if _instances else None
+    if instance is None:
+        instance = BlogMarkdown(extras=extras)
+    yield instance
+    with _instances_lock:
+        if extras == _instances_extras and len(_instances) < getattr(settings, 'BLOGENGINE_MARKDOWN_INSTANCES', 8):
+            _instances.append(instance)
+
+def _render(text):
+    # convert() resets what the instance kept from the last text
+    with markdown_instance() as instance:
+        return instance.convert(force_unicode(text))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    '''This process's render pool, or None when rendering inline'''
+    global _pool, _pool_pid
+    processes = getattr(settings, 'BLOGENGINE_MARKDOWN_PROCESSES', 0)
+    if not processes:
+        return None
+    with _pool_lock:
+        # A forked worker can't use its parent's pool
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(processes, maxtasksperchild=1000)
+            _pool_pid = os.getpid()
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.terminate()
+            _pool.join()
+        _pool = None
+
+def use_pool(text):
+    return len(text) >= getattr(settings, 'BLOGENGINE_MARKDOWN_POOL_MIN_LENGTH', 10000)
+
+def render_markdown(text):
+    '''Render markdown text to HTML'''
+    with instrumentation.timed('markdown_ms'):
+        pool = get_pool()
+        if pool is not None and use_pool(text):
+            timeout = getattr(settings, 'BLOGENGINE_MARKDOWN_TIMEOUT', 2.0)
+            try:
+                return pool.apply_async(_render, (text,)).get(timeout)
+            except multiprocessing.TimeoutError:
+                logger.warning('Rendering %d characters in the pool timed out', len(text))
+        return _render(text)
+
+def render_many(texts):
+    '''Render a list of markdown texts, across the pool if there is one'''
+    pool = get_pool()
+    with instrumentation.timed('markdown_ms'):
+        if pool is None or len(texts) < 2:
+            return [_render(text) for text in texts]
+        processes = settings.BLOGENGINE_MARKDOWN_PROCESSES
+        return pool.map(_render, texts, chunksize=max(1, len(texts) // (4 * processes)))
+
+def render_later(text, callback):
+    '''
+    Render text in the pool and call callback with the HTML once done, on
+    the pool's result thread. Renders inline when there is no pool.
+    '''
+    pool = get_pool()
+    if pool is None:
+        callback(_render(text))
+        return
+
+    def done(html):
+        # An exception here would kill the pool's result thread, and every
+        # render after it would wait for its timeout
+        try:
+            callback(html)
+        except Exception:
+            logger.exception('Storing a render from the pool failed')
+        finally:
+            # The result thread's own connection
+            connection.close()
+
+    pool.apply_async(_render, (text,), callback=done)
@@ -0,0 +1,211 @@
+'''
+Full-text search over posts.
+
+The backend is picked from the BLOGENGINE_SEARCH_BACKEND setting, or from
+the database vendor when that isn't set: Postgres searches a tsvector
+column kept up to date by a trigger, SQLite an FTS5 table kept up to date
+by signals, and anything else falls back to icontains scans.
+'''
+import hashlib
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.encoding import force_unicode, smart_str
+from django.utils.html import escape
+from django.utils.module_loading import import_by_path
+from blogengine import caching
+from blogengine.hosts import site_ids_by_domain
+
+# Placed around matches by the database, swapped for <mark> after escaping
+START_MARK = u'\x02'
+STOP_MARK = u'\x03'
+
+def mark_matches(snippet):
+    '''Escape a snippet and highlight the matches the database marked'''
+    snippet = escape(force_unicode(snippet))
+    return snippet.replace(START_MARK, u'<mark>').replace(STOP_MARK, u'</mark>')
+
+
+class BaseSearchBackend(object):
+    def search(self, query):
+        '''Ids of the posts matching query, best match first'''
+        raise NotImplementedError
+
+    def highlight(self, query, pks):
+        '''Highlighted snippets of the given posts, keyed by post id'''
+        return {}
+
+    def index_post(self, post):
+        '''Called when a post is saved'''
+        pass
+
+    def remove_post(self, pk):
+        '''Called when a post is deleted'''
+        pass
+
+    def rebuild(self):
+        '''Reindex every post'''
+        pass
+
+    def purge(self):
+        '''Drop index entries of posts that no longer exist'''
+        pass
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    '''Searches with icontains: needs no index, works on every database'''
+    def search(self, query):
+        from django.db.models import Q
+        from blogengine.models import Post
+        results = Post.objects.filter(Q(text__icontains=query) | Q(title__icontains=query))
+        return list(results.values_list('pk', flat=True))
+
+    def highlight(self, query, pks):
+        from blogengine.models import Post
+        pattern = re.compile(re.escape(query), re.IGNORECASE | re.UNICODE)
+        snippets = {}
+        for pk, text in Post.objects.filter(pk__in=pks).values_list('pk', 'text'):
+            match = pattern.search(text)
+            if match is None:
+                continue
+            start = max(match.start() - 60, 0)
+            snippet = pattern.sub(lambda m: START_MARK + m.group(0) + STOP_MARK,
+                                  text[start:match.end() + 60])
+            snippets[pk] = mark_matches(snippet)
+        return snippets
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    '''Searches the search_vector column, ranked with ts_rank_cd'''
+    config = 'pg_catalog.english'
+
+    def search(self, query):
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT id FROM blogengine_post, plainto_tsquery(%s, %s) query '
+            'WHERE search_vector @@ query '
+            'ORDER BY ts_rank_cd(search_vector, query) DESC, pub_date DESC',
+            [self.config, query])
+        return [row[0] for row in cursor.fetchall()]
+
+    def highlight(self, query, pks):
+        if not pks:
+            return {}
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT id, ts_headline(%s, text, plainto_tsquery(%s, %s), %s) '
+            'FROM blogengine_post WHERE id IN (' + ', '.join(['%s'] * len(pks)) + ')',
+            [self.config, self.config, query,
+             'StartSel=%s, StopSel=%s, MaxFragments=2' % (START_MARK, STOP_MARK)] + list(pks))
+        return dict((pk, mark_matches(snippet)) for pk, snippet in cursor.fetchall())
+
+    def rebuild(self):
+        # The trigger recomputes the vector on update
+        connection.cursor().execute('UPDATE blogengine_post SET title = title')
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    '''Searches the blogengine_post_fts FTS5 table, ranked with bm25'''
+    table = 'blogengine_post_fts'
+
+    def _match(self, query):
+        # Quote each word so user input can't use FTS5 syntax, and match
+        # word prefixes as icontains used to
+        words = re.findall(r'\w+', force_unicode(query), re.UNICODE)
+        return u' '.join(u'"%s"*' % word for word in words)
+
+    def search(self, query):
+        match = self._match(query)
+        if not match:
+            return []
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT rowid FROM %s WHERE %s MATCH %%s '
+            'ORDER BY bm25(%s, 10.0, 1.0)' % (self.table, self.table, self.table),
+            [match])
+        return [row[0] for row in cursor.fetchall()]
+
+    def highlight(self, query, pks):
+        match = self._match(query)
+        if not match or not pks:
+            return {}
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT rowid, snippet(%s, 1, %%s, %%s, '...', 32) FROM %s "
+            "WHERE %s MATCH %%s AND rowid IN (%s)" % (
+                self.table, self.table, self.table, ', '.join(['%s'] * len(pks))),
+            [START_MARK, STOP_MARK, match] + list(pks))
+        return dict((pk, mark_matches(snippet)) for pk, snippet in cursor.fetchall())
+
+    def index_post(self, post):
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.table, [post.pk])
+        cursor.execute('INSERT INTO %s (rowid, title, text) VALUES (%%s, %%s, %%s)' % self.table,
+                       [post.pk, post.title, post.text])
+
+    def remove_post(self, pk):
+        connection.cursor().execute('DELETE FROM %s WHERE rowid = %%s' % self.table, [pk])
+
+    def rebuild(self):
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s' % self.table)
+        cursor.execute('INSERT INTO %s (rowid, title, text) '
+                       'SELECT id, title, text FROM blogengine_post' % self.table)
+
+    def purge(self):
+        connection.cursor().execute(
+            'DELETE FROM %s WHERE rowid NOT IN (SELECT id FROM blogengine_post)' % self.table)
+
+
+def _sqlite_index_exists():
+    cursor = connection.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s",
+                   [SQLiteSearchBackend.table])
+    return cursor.fetchone() is not None
+
+_backend = None
+
+def get_backend():
+    '''The configured search backend, created on first use'''
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'BLOGENGINE_SEARCH_BACKEND', None)
+        if path:
+            _backend = import_by_path(path)()
+        elif connection.vendor == 'postgresql':
+            _backend = PostgresSearchBackend()
+        elif connection.vendor == 'sqlite':
+            if not _sqlite_index_exists():
+                # Not migrated yet, or no FTS5: check again next time
+                return SimpleSearchBackend()
+            _backend = SQLiteSearchBackend()
+        else:
+            _backend = SimpleSearchBackend()
+    return _backend
+
+def search_posts(query, site_id=None):
+    '''
+    Ids of the posts of a site matching query, best match first. The list
+    is cached until a post of the site changes, so paging through results
+    doesn't search again. A blank query matches nothing here; the search
+    view lists every post for it.
+    '''
+    from blogengine.models import Post
+    site_id = site_id or settings.SITE_ID
+    posts = Post.objects.for_site(site_id)
+    query = query.strip()
+    if not query:
+        return []
+    key = 'blogengine:search:%s:%s' % (site_id, hashlib.md5(smart_str(query)).hexdigest())
+    deps = [caching.dependency('posts', site_id)]
+    versions = caching.get_versions(deps)
+    pks = caching.fetch(key)
+    if pks is None:
+        pks = get_backend().search(query)
+        # Backends index the posts of every site
+        if len(site_ids_by_domain()) > 1:
+            on_site = set(posts.values_list('pk', flat=True))
+            pks = [pk for pk in pks if pk in on_site]
+        caching.store(key, pks, deps, versions=versions)
+    return pks
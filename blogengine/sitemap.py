@@ -1,21 +1,131 @@
+import hashlib
+
 from django.contrib.flatpages.models import FlatPage
 from django.contrib.sitemaps import Sitemap
+from django.contrib.sitemaps.views import sitemap, x_robots_tag
+from django.contrib.sites.models import RequestSite
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db.models import Max
+from django.http import Http404, HttpResponse
+from django.template.response import TemplateResponse
+from django.views.decorators.http import condition
+from blogengine import caching
+from blogengine.hosts import current_site_id
 from blogengine.models import Post
 
-class PostSitemap(Sitemap):
-    changefreq = 'always'
+class CachedSitemap(Sitemap):
+    '''
+    Sitemap whose pages are cached until one of the objects on them
+    changes. Items are ordered by primary key, so adding objects only
+    changes the last page. Only lists the site the request is for, with
+    URLs on the host it was made to.
+    '''
+    dependency_kind = None
+
+    def __init__(self, request=None):
+        self.site_id = current_site_id(request)
+        self.request_site = request and RequestSite(request)
+
+    def get_urls(self, page=1, site=None, protocol=None):
+        # get_current_site() only knows SITE_ID
+        return super(CachedSitemap, self).get_urls(page, self.request_site or site, protocol)
+
+    def page_pks(self, page):
+        '''Primary keys of the items on a page'''
+        try:
+            page = int(page)
+        except (TypeError, ValueError):
+            raise Http404("No page '%s'" % page)
+        start = (page - 1) * self.limit
+        pks = list(self.items().values_list('pk', flat=True)[start:start + self.limit])
+        if page < 1 or (page > 1 and not pks):
+            raise Http404("Page %s empty" % page)
+        return pks
+
+    def page_dependencies(self, pks):
+        return [caching.dependency(self.dependency_kind, pk) for pk in pks]
+
+    def page_last_modified(self, pks):
+        '''When the newest of the items was changed, if known'''
+        return None
+
+
+class PostSitemap(CachedSitemap):
+    changefreq = 'weekly'
     priority = 0.5
+    limit = 1000
+    dependency_kind = 'post'
 
     def items(self):
-        return Post.objects.all()
+        # Only the columns the URL and date are built from
+        return (Post.objects.for_site(self.site_id).only('slug', 'pub_date', 'site', 'updated_at')
+                .order_by('pk'))
 
     def lastmod(self, obj):
-        return obj.pub_date
+        return obj.updated_at
 
+    def page_last_modified(self, pks):
+        return Post.objects.filter(pk__in=pks).aggregate(Max('updated_at'))['updated_at__max']
 
-class FlatpageSitemap(Sitemap):
-    changefreq = 'always'
+
+class FlatpageSitemap(CachedSitemap):
+    changefreq = 'monthly'
     priority = 0.5
+    limit = 1000
+    dependency_kind = 'flatpage'
 
     def items(self):
-        return FlatPage.objects.all()
\ No newline at end of file
+        return FlatPage.objects.filter(sites=self.site_id).only('url').order_by('pk')
+
+
+def cached_sitemap(request, sitemaps, section):
+    '''
+    One page of one section of the sitemap. The ETag and cache key come
+    from the versions of the objects on the page, so crawlers get a 304
+    and everyone else the cached XML until one of those objects changes.
+    Last-Modified is the newest of their updated_at, where they have one.
+    '''
+    if section not in sitemaps:
+        raise Http404("No sitemap available for section: %r" % section)
+    page = request.GET.get('p', 1)
+    site_map = sitemaps[section](request)
+    pks = site_map.page_pks(page)
+    deps = site_map.page_dependencies(pks)
+    last_modified = site_map.page_last_modified(pks)
+    versions = sorted(caching.get_versions(deps).items())
+    etag = hashlib.md5('%s:%s:%s:%s:%s' % (section, page, request.get_host(),
+                                           request.is_secure(), versions)).hexdigest()
+
+    @condition(etag_func=lambda request, *args, **kwargs: etag,
+               last_modified_func=lambda request, *args, **kwargs: last_modified)
+    def render(request):
+        key = 'blogengine:sitemap:%s' % etag
+        content = cache.get(key)
+        if content is None:
+            response = sitemap(request, {section: site_map}, section)
+            content = response.render().content
+            cache.set(key, content)
+        response = HttpResponse(content, content_type='application/xml')
+        response['X-Robots-Tag'] = 'noindex, noodp, noarchive'
+        return response
+
+    return render(request)
+
+
+@x_robots_tag
+def sitemap_index(request, sitemaps, sitemap_url_name):
+    '''
+    Django's sitemap index, listing the pages of the sections for the site
+    and host the request is for
+    '''
+    protocol = 'https' if request.is_secure() else 'http'
+    urls = []
+    for section, site_map in sorted(sitemaps.items()):
+        site_map = site_map(request)
+        url = '%s://%s%s' % (protocol, request.get_host(),
+                             reverse(sitemap_url_name, kwargs={'section': section}))
+        urls.append(url)
+        urls.extend('%s?p=%s' % (url, page) for page in range(2, site_map.paginator.num_pages + 1))
+    return TemplateResponse(request, 'sitemap_index.xml', {'sitemaps': urls},
+                            content_type='application/xml')
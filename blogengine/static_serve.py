@@ -0,0 +1,118 @@
+'''
+WSGI middleware serving STATIC_ROOT in front of Django.
+
+Picks the .br or .gz sibling storage.CompressedManifestStaticFilesStorage
+wrote when the client accepts it, hands the open file to the server's
+wsgi.file_wrapper so it can use sendfile, and marks content hashed names
+as immutable for a year. Everything outside STATIC_URL goes to the
+wrapped application.
+'''
+import calendar
+import mimetypes
+import os
+import re
+import stat
+from email.utils import formatdate, parsedate
+
+from django.conf import settings
+
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^/.]+$')
+
+# Preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+BLOCK_SIZE = 64 * 1024
+
+def accepted_encodings(header):
+    '''Content codings an Accept-Encoding header allows'''
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if params in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticFilesApplication(object):
+    def __init__(self, application, root=None, prefix=None):
+        self.application = application
+        self.root = os.path.abspath(root or settings.STATIC_ROOT)
+        self.prefix = prefix or settings.STATIC_URL
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        # STATIC_URL may be on another host
+        if '://' in self.prefix or not path.startswith(self.prefix):
+            return self.application(environ, start_response)
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD'),
+                                                     ('Content-Length', '0')])
+            return []
+        return self.serve(environ, start_response, path[len(self.prefix):])
+
+    def find(self, name):
+        '''Absolute path of name in the root, or None'''
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            return None
+        if not os.path.isfile(path):
+            return None
+        return path
+
+    def cache_control(self, name):
+        if HASHED_NAME.search(name):
+            return 'public, max-age=31536000, immutable'
+        return 'public, max-age=%d' % getattr(settings, 'BLOGENGINE_STATIC_MAX_AGE', 60)
+
+    def not_found(self, start_response):
+        start_response('404 Not Found', [('Content-Type', 'text/plain'),
+                                         ('Content-Length', '9')])
+        return ['Not Found']
+
+    def serve(self, environ, start_response, name):
+        path = self.find(name)
+        if path is None:
+            return self.not_found(start_response)
+
+        content_type, encoding = mimetypes.guess_type(path)
+        headers = [
+            ('Content-Type', content_type or 'application/octet-stream'),
+            ('Cache-Control', self.cache_control(name)),
+            ('Vary', 'Accept-Encoding'),
+        ]
+        # Files the browser decompresses itself (.gz downloads) are sent as is
+        if encoding is None:
+            accepted = accepted_encodings(environ.get('HTTP_ACCEPT_ENCODING', ''))
+            for coding, suffix in ENCODINGS:
+                if coding in accepted and os.path.isfile(path + suffix):
+                    path += suffix
+                    headers.append(('Content-Encoding', coding))
+                    break
+
+        mtime = os.stat(path)[stat.ST_MTIME]
+        headers.append(('Last-Modified', formatdate(mtime, usegmt=True)))
+        since = parsedate(environ.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if since and mtime <= calendar.timegm(since):
+            start_response('304 Not Modified', headers)
+            return []
+
+        f = open(path, 'rb')
+        headers.append(('Content-Length', str(os.fstat(f.fileno()).st_size)))
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            f.close()
+            return []
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            # Lets the server sendfile() it
+            return file_wrapper(f, BLOCK_SIZE)
+        return read_blocks(f)
+
+def read_blocks(f):
+    try:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            yield block
+    finally:
+        f.close()
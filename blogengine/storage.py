@@ -0,0 +1,129 @@
+'''
+Static files storage writing content hashed, precompressed copies.
+
+collectstatic builds the bundles of blogengine.bundles, then saves every
+file a second time under a name carrying a hash of its content
+(css/custom.3f2a9c1b7d0e.css), rewrites the url()s in CSS to point at the
+hashed names, and writes .gz and, if the brotli module is installed, .br
+siblings of everything compressible. The original to hashed
+name mapping is kept in staticfiles.json in STATIC_ROOT, so {% static %}
+needs neither the cache nor to read the files at runtime.
+'''
+import gzip
+import json
+from io import BytesIO
+
+from django.contrib.staticfiles.storage import CachedFilesMixin, StaticFilesStorage
+from django.core.files.base import ContentFile
+from blogengine import bundles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST_NAME = 'staticfiles.json'
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.html', '.txt', '.xml', '.json',
+                '.map', '.eot', '.ttf', '.otf', '.ico')
+
+def gzip_compress(data):
+    buf = BytesIO()
+    # mtime=0 so the same file always compresses to the same bytes
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class StaticManifest(object):
+    '''
+    Stands in for the cache CachedFilesMixin keeps hashed names in,
+    backed by a JSON file in the storage
+    '''
+    def __init__(self, storage):
+        self.storage = storage
+        self._names = None
+
+    @property
+    def names(self):
+        if self._names is None:
+            try:
+                with open(self.storage.path(MANIFEST_NAME)) as f:
+                    self._names = json.load(f)
+            except (IOError, ValueError):
+                self._names = {}
+        return self._names
+
+    def exists(self):
+        return bool(self.names)
+
+    def get(self, name, default=None):
+        return self.names.get(name, default)
+
+    def set(self, name, hashed_name, timeout=None):
+        self.names[name] = hashed_name
+
+    def set_many(self, names, timeout=None):
+        self.names.update(names)
+        with open(self.storage.path(MANIFEST_NAME), 'w') as f:
+            json.dump(self.names, f, indent=0, sort_keys=True)
+
+
+class CompressedManifestStaticFilesStorage(CachedFilesMixin, StaticFilesStorage):
+    def __init__(self, *args, **kwargs):
+        super(CompressedManifestStaticFilesStorage, self).__init__(*args, **kwargs)
+        self.cache = StaticManifest(self)
+
+    def cache_key(self, name):
+        # Readable keys in staticfiles.json
+        return name
+
+    def url(self, name, force=False):
+        # Plain names until collectstatic has written the hashed copies
+        if not force and not self.cache.exists():
+            return StaticFilesStorage.url(self, name)
+        try:
+            return super(CompressedManifestStaticFilesStorage, self).url(name, force)
+        except ValueError:
+            return StaticFilesStorage.url(self, name)
+
+    def compress(self, name):
+        '''Write .gz and .br siblings of a file, where they are smaller'''
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        compressors = [('.gz', gzip_compress)]
+        if brotli is not None:
+            compressors.append(('.br', brotli.compress))
+        for suffix, compressor in compressors:
+            compressed = compressor(data)
+            if len(compressed) < len(data) * 0.95:
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+
+    def build_bundles(self, paths):
+        '''Save the bundles whose sources were all collected, adding them to paths'''
+        for name, sources in bundles.get_bundles().items():
+            if not all(source in paths for source in sources):
+                continue
+            path = bundles.bundle_path(name)
+            content = bundles.build_bundle(name, sources, self.open)
+            if self.exists(path):
+                self.delete(path)
+            self._save(path, ContentFile(content))
+            paths[path] = (self, path)
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            self.build_bundles(paths)
+        hashed_names = []
+        for name, hashed_name, processed in super(CompressedManifestStaticFilesStorage, self).post_process(
+                paths, dry_run, **options):
+            if hashed_name:
+                hashed_names.append(hashed_name)
+            yield name, hashed_name, processed
+        if dry_run:
+            return
+        for name in list(paths) + hashed_names:
+            if name.lower().endswith(COMPRESSIBLE):
+                self.compress(name)
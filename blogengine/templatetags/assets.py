@@ -0,0 +1,59 @@
+'''
+Tags linking the bundles of blogengine.bundles and inlining critical CSS.
+
+    {% inline_css 'blogengine/css/critical.css' %}
+    {% bundle 'site.css' defer=True %}
+    <link rel="preload" href="{% bundle_url 'site.css' %}" as="style">
+
+A deferred stylesheet is loaded without blocking the first paint, which the
+inlined critical CSS covers; a deferred script runs once the page is parsed.
+'''
+import logging
+
+from django import template
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.utils.html import format_html_join
+from django.utils.safestring import mark_safe
+from blogengine import bundles
+
+logger = logging.getLogger('blogengine.assets')
+
+register = template.Library()
+
+_inlined = {}
+
+@register.simple_tag
+def bundle_url(name):
+    '''Like {% static %}, for a bundle'''
+    return staticfiles_storage.url(bundles.bundle_path(name))
+
+@register.simple_tag
+def bundle(name, defer=False):
+    '''Tags linking a bundle, or its sources while it isn't built'''
+    urls = [(url,) for url in bundles.bundle_urls(name, staticfiles_storage)]
+    if name.endswith('.js'):
+        tag = '<script src="{0}" defer></script>' if defer else '<script src="{0}"></script>'
+    elif defer:
+        tag = ('<link rel="stylesheet" href="{0}" media="print" onload="this.media=\'all\'">'
+               '<noscript><link rel="stylesheet" href="{0}"></noscript>')
+    else:
+        tag = '<link rel="stylesheet" href="{0}">'
+    return format_html_join('\n', tag, urls)
+
+@register.simple_tag
+def inline_css(path):
+    '''A static stylesheet minified into a <style> tag, read once per process'''
+    if path not in _inlined:
+        found = finders.find(path)
+        if found is None:
+            # Pages still work on the deferred stylesheet, just later
+            logger.warning('Stylesheet %s to inline not found', path)
+            _inlined[path] = ''
+        else:
+            with open(found) as f:
+                _inlined[path] = bundles.minify_css(f.read())
+    if not _inlined[path]:
+        return ''
+    # Our own file, and escaping would break it: <style> isn't parsed as HTML
+    return mark_safe('<style>%s</style>' % _inlined[path])
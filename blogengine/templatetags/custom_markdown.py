@@ -1,16 +1,16 @@
-import markdown2
-
 from django import template
 from django.template.defaultfilters import stringfilter
-from django.utils.encoding import force_unicode
 from django.utils.safestring import mark_safe
+from blogengine.rendering import render_markdown
 
 register = template.Library()
 
 @register.filter(is_safe=True)
 @stringfilter
 def custom_markdown(value):
-    extras = ['fenced-code-blocks']
+    return mark_safe(render_markdown(value))
 
-    return mark_safe(markdown2.markdown(force_unicode(value),
-                                        extras = extras))
+@register.filter(is_safe=True)
+def post_markdown(post):
+    '''Render a post's text, using the HTML stored on the post'''
+    return mark_safe(post.get_rendered_text())
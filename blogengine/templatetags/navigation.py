@@ -0,0 +1,29 @@
+'''
+The flatpages navigation every page shows, without querying for it.
+
+The pages are kept in each process and in the cache under the version of
+the 'flatpages' dependency of the site, which saving or deleting one of its
+flat pages bumps, so
+a warm worker only checks that version (itself usually in the local tier
+of TwoTierCache) and an invalidated one reads the list back from the cache.
+'''
+from django import template
+from django.contrib.flatpages.models import FlatPage
+from blogengine import caching
+from blogengine.hosts import current_site_id
+
+register = template.Library()
+
+def get_navigation_pages(site_id):
+    '''URL and title of the public flat pages of a site, as get_flatpages orders them'''
+    def build():
+        return [{'url': url, 'title': title} for url, title in
+                FlatPage.objects.filter(sites__id=site_id, registration_required=False)
+                                .values_list('url', 'title')]
+    return caching.memoize('blogengine:navigation:%s' % site_id,
+                           [caching.dependency('flatpages', site_id)], build)
+
+@register.assignment_tag(takes_context=True)
+def get_navigation(context):
+    '''Cached stand in for {% get_flatpages as flatpages %}'''
+    return get_navigation_pages(current_site_id(context.get('request')))
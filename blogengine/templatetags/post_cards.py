@@ -0,0 +1,58 @@
+'''
+Cached "post cards", the block each post gets on the index, category, tag
+and search pages.
+
+A card's cache key is the post id plus a hash of everything shown on it,
+so editing the post, renaming its category or changing its tags gives it
+a new key and the old card is never read again. All the cards of a page
+are fetched with one get_many().
+'''
+import hashlib
+
+from django import template
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.encoding import smart_str
+from django.utils.safestring import mark_safe
+from blogengine import instrumentation
+
+register = template.Library()
+
+# Bump when post_card.html changes
+CARD_VERSION = 2
+
+def card_key(post):
+    '''Cache key of a post's card, changing whenever anything on it does'''
+    category, tags = post.labels
+    stamp = [CARD_VERSION, post.title, post.slug, post.pub_date.isoformat(),
+             post.text_hash, post.renderer_version]
+    if category is not None:
+        stamp.append((category.name, category.slug))
+    stamp.extend((tag.name, tag.slug) for tag in tags)
+    return 'blogengine:card:%s:%s' % (post.pk, hashlib.md5(smart_str(repr(stamp))).hexdigest())
+
+def render_cards(posts):
+    '''HTML of each post's card, from the cache where possible'''
+    keys = [card_key(post) for post in posts]
+    cards = cache.get_many(keys)
+    instrumentation.add('cache_hits', len(cards))
+    missing = {}
+    for post, key in zip(posts, keys):
+        if key not in cards:
+            missing[key] = cards[key] = render_to_string('blogengine/includes/post_card.html',
+                                                         {'post': post})
+    if missing:
+        instrumentation.add('cache_misses', len(missing))
+        cache.set_many(missing)
+    return [mark_safe(cards[key]) for key in keys]
+
+@register.assignment_tag
+def get_post_cards(posts):
+    '''
+    Pairs of (post, card HTML) for a list of posts:
+
+        {% get_post_cards object_list as cards %}
+        {% for post, card in cards %}{{ card }}{% endfor %}
+    '''
+    posts = list(posts)
+    return zip(posts, render_cards(posts))
@@ -0,0 +1,72 @@
+'''
+Tag cloud, category list and archive months for sidebars.
+
+They read the post counts signals keep on Tag, Category and ArchiveMonth,
+memoized under the 'posts' dependency of the site, which every change to
+its posts, categories and tags bumps, so a warm worker renders them
+without queries:
+
+    {% load widgets %}
+    {% get_tag_cloud as tags %}
+    {% for tag in tags %}
+        <a href="{{ tag.url }}" class="tag-{{ tag.weight }}">{{ tag.name }}</a>
+    {% endfor %}
+'''
+import math
+
+from django import template
+from blogengine import caching
+from blogengine.hosts import current_site_id
+from blogengine.models import ArchiveMonth, Category, Tag
+
+register = template.Library()
+
+# Tag cloud font sizes go from 1 to this
+CLOUD_WEIGHTS = 5
+
+def tag_cloud(site_id):
+    '''Tags of a site with posts, by name, weighted by their number of posts'''
+    def build():
+        tags = list(Tag.objects.for_site(site_id).filter(post_count__gt=0)
+                               .order_by('name').values('name', 'slug', 'post_count'))
+        most = max([tag['post_count'] for tag in tags] or [1])
+        for tag in tags:
+            tag['url'] = Tag(slug=tag['slug']).get_absolute_url()
+            # Logarithmic, so a few busy tags don't shrink all the others
+            tag['weight'] = 1 + int(round((CLOUD_WEIGHTS - 1) * math.log(tag['post_count']) /
+                                          math.log(most))) if most > 1 else 1
+        return tags
+    return caching.memoize('blogengine:widgets:tags:%s' % site_id,
+                           [caching.dependency('posts', site_id)], build)
+
+def category_list(site_id):
+    '''Categories of a site with posts, by name'''
+    def build():
+        categories = list(Category.objects.for_site(site_id).filter(post_count__gt=0)
+                                          .order_by('name').values('name', 'slug', 'post_count'))
+        for category in categories:
+            category['url'] = Category(slug=category['slug']).get_absolute_url()
+        return categories
+    return caching.memoize('blogengine:widgets:categories:%s' % site_id,
+                           [caching.dependency('posts', site_id)], build)
+
+def archive_months(site_id):
+    '''Months a site published posts in, newest first'''
+    def build():
+        return [{'year': archive.year, 'month': archive.month, 'post_count': archive.post_count,
+                 'url': archive.get_absolute_url()}
+                for archive in ArchiveMonth.objects.filter(site_id=site_id)]
+    return caching.memoize('blogengine:widgets:months:%s' % site_id,
+                           [caching.dependency('posts', site_id)], build)
+
+@register.assignment_tag(takes_context=True)
+def get_tag_cloud(context):
+    return tag_cloud(current_site_id(context.get('request')))
+
+@register.assignment_tag(takes_context=True)
+def get_categories(context):
+    return category_list(current_site_id(context.get('request')))
+
+@register.assignment_tag(takes_context=True)
+def get_archive_months(context):
+    return archive_months(current_site_id(context.get('request')))
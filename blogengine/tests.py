@@ -1,13 +1,43 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+from StringIO import StringIO
+import os
+import shutil
+import tempfile
+import time
 from django.contrib.auth.models import User
 from django.contrib.flatpages.models import FlatPage
 from django.contrib.sites.models import Site
-from django.core.urlresolvers import reverse
-from django.test import TestCase, LiveServerTestCase, Client
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.signals import request_finished
+from django.core.urlresolvers import resolve, reverse
+from django.db import connection, transaction
+from django.template import Context, Template
+from django.test import TestCase, LiveServerTestCase, Client, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
-from blogengine.models import Post, Category, Tag
+from django.views.generic.detail import SingleObjectMixin
+from blogengine import bundles, caching, highlighting, hosts, instrumentation, models, rendering
+from blogengine import middleware
+from blogengine.cache_backends import TwoTierCache
+from blogengine.middleware import FetchFromCacheMiddleware, should_refresh_early
+from blogengine.models import ArchiveMonth, Post, Category, Tag
+from blogengine.sitemap import PostSitemap
+from blogengine.static_serve import StaticFilesApplication
+from blogengine.storage import CompressedManifestStaticFilesStorage
+from blogengine.templatetags.assets import inline_css
+from blogengine.templatetags.post_cards import card_key, render_cards
+from blogengine.search import SimpleSearchBackend, get_backend as get_search_backend
 import factory.django
 import feedparser
 import markdown2 as markdown
+from pygments.lexers import PythonLexer
+
+_acquire_lock = FetchFromCacheMiddleware.__dict__['acquire_lock']
+_rebuild = FetchFromCacheMiddleware.__dict__['rebuild']
 
 # Factories
 class SiteFactory(factory.django.DjangoModelFactory):
@@ -149,12 +179,373 @@ class PostTest(TestCase):
         self.assertEquals(only_post_tag, tag)
         self.assertEquals(only_post_tag.name, 'python')
         self.assertEquals(only_post_tag.description, 'The Python programming language')
-    
+
+    def test_updated_at(self):
+        post = PostFactory() # Create the post
+        first = Post.objects.get(pk=post.pk).updated_at
+
+        # Adding a tag counts as changing the post
+        post.tags.add(TagFactory())
+        self.assertTrue(Post.objects.get(pk=post.pk).updated_at > first)
+
+        # So does saving it
+        second = Post.objects.get(pk=post.pk).updated_at
+        post.save()
+        self.assertTrue(Post.objects.get(pk=post.pk).updated_at > second)
+
+    def test_post_rendered_text(self):
+        post = PostFactory(text='This is my *first* blog post') # Create the post
+
+        # Check the markdown was rendered on save
+        only_post = Post.objects.all()[0]
+        self.assertEquals(only_post.rendered_text, markdown.markdown(post.text))
+        self.assertEquals(only_post.get_rendered_text(), markdown.markdown(post.text))
+        self.assertFalse(only_post.is_render_stale())
+
+        # Change the text without saving: render happens on the fly
+        only_post.text = 'This is my *edited* blog post'
+        self.assertTrue(only_post.is_render_stale())
+        self.assertTrue('<em>edited</em>' in only_post.get_rendered_text())
+
+        # Saving stores the new render
+        only_post.save()
+        self.assertTrue('<em>edited</em>' in Post.objects.all()[0].rendered_text)
+
+    def test_rendermarkdown_command(self):
+        post = PostFactory(text='This is my *first* blog post') # Create the post
+
+        # Simulate a post rendered by an older renderer
+        Post.objects.filter(pk=post.pk).update(rendered_text='', renderer_version='0:old')
+
+        # Re-render stale posts
+        call_command('rendermarkdown', batch_size=1, stdout=StringIO())
+
+        only_post = Post.objects.all()[0]
+        self.assertFalse(only_post.is_render_stale())
+        self.assertEquals(only_post.rendered_text, markdown.markdown(post.text))
+
+    @override_settings(BLOGENGINE_DENORMALIZE_TAXONOMY=True)
+    def test_denormalized_taxonomy(self):
+        post = PostFactory() # Create the post
+        tag = TagFactory() # Create a tag
+        post.tags.add(tag)
+        stored = lambda: json.loads(Post.objects.get(pk=post.pk).taxonomy)
+
+        # Check the category and tags are stored on the post
+        self.assertEquals(stored(), {'category': ['python', 'python'], 'tags': [['python', 'python']]})
+
+        # Check the labels are read from it
+        only_post = Post.objects.get(pk=post.pk)
+        with self.assertNumQueries(0):
+            self.assertEquals(only_post.category_label.get_absolute_url(), '/category/python/')
+            self.assertEquals([label.name for label in only_post.tag_labels], ['python'])
+
+        # Renaming the category or tag updates it
+        category = post.category
+        category.name = 'Python'
+        category.save()
+        tag.name = 'Django'
+        tag.save()
+        self.assertEquals(stored(), {'category': ['python', 'Python'], 'tags': [['python', 'Django']]})
+
+        # So does changing the tags from either side, or deleting the tag
+        tag.post_set.clear()
+        self.assertEquals(stored()['tags'], [])
+        tag.post_set.add(post)
+        self.assertEquals(len(stored()['tags']), 1)
+        tag.delete()
+        self.assertEquals(stored()['tags'], [])
+
+    @override_settings(BLOGENGINE_DENORMALIZE_TAXONOMY=True)
+    def test_rebuildtaxonomy_command(self):
+        post = PostFactory() # Create the post
+        post.tags.add(TagFactory())
+
+        # Simulate drift
+        Post.objects.filter(pk=post.pk).update(taxonomy='')
+
+        # Check it is reported, then repaired
+        self.assertRaises(CommandError, call_command, 'rebuildtaxonomy', check=True, stdout=StringIO())
+        call_command('rebuildtaxonomy', batch_size=1, stdout=StringIO())
+        call_command('rebuildtaxonomy', check=True, stdout=StringIO())
+        self.assertTrue('python' in Post.objects.get(pk=post.pk).taxonomy)
+
+    def test_post_counts(self):
+        post = PostFactory() # Create the post
+        tag = TagFactory() # Create a tag
+        post.tags.add(tag)
+        count = lambda model, obj: model.objects.get(pk=obj.pk).post_count
+        month = lambda: dict(((archive.year, archive.month), archive.post_count)
+                             for archive in ArchiveMonth.objects.all())
+
+        # Check the post is counted in its category, tag and month
+        self.assertEquals(count(Category, post.category), 1)
+        self.assertEquals(count(Tag, tag), 1)
+        self.assertEquals(month(), {(post.pub_date.year, post.pub_date.month): 1})
+
+        # Check saving a tag loaded before doesn't undo its count
+        stale_tag = Tag.objects.get(pk=tag.pk)
+        other_post = PostFactory(title='My second post', slug='my-second-post')
+        other_post.tags.add(tag)
+        stale_tag.save()
+        self.assertEquals(count(Tag, tag), 2)
+
+        # Check moving a post to another category and month moves its counts
+        other_category = CategoryFactory(name='django', slug='django')
+        other_post.category = other_category
+        other_post.pub_date = other_post.pub_date - timedelta(days=62)
+        other_post.save()
+        self.assertEquals(count(Category, post.category), 1)
+        self.assertEquals(count(Category, other_category), 1)
+        self.assertEquals(len(month()), 2)
+
+        # Check removing tags from either side
+        post.tags.clear()
+        self.assertEquals(count(Tag, tag), 1)
+        tag.post_set.clear()
+        self.assertEquals(count(Tag, tag), 0)
+
+        # Check deleting a post
+        other_post.tags.add(tag)
+        other_post.delete()
+        self.assertEquals(count(Tag, tag), 0)
+        self.assertEquals(count(Category, other_category), 0)
+        self.assertEquals(month(), {(post.pub_date.year, post.pub_date.month): 1})
+
+    def test_post_counted_in_utc_month(self):
+        # Create a post on March 31st in Los Angeles, which is April in UTC
+        pub_date = timezone.make_aware(datetime(2014, 3, 31, 20, 0), timezone.get_default_timezone())
+        post = PostFactory(pub_date=pub_date)
+
+        # Check it is counted in April, where the archives list it
+        archives = ArchiveMonth.objects.filter(site=post.site)
+        self.assertEquals([(archive.year, archive.month, archive.post_count) for archive in archives],
+                          [(2014, 4, 1)])
+
+        # Check moving it back into March in UTC moves its count
+        post.pub_date = pub_date - timedelta(hours=12)
+        post.save()
+        self.assertEquals([(archive.year, archive.month) for archive in archives.filter(post_count=1)],
+                          [(2014, 3)])
+
+    def test_rebuildcounts_command(self):
+        post = PostFactory() # Create the post
+        post.tags.add(TagFactory())
+
+        # Simulate drift
+        Tag.objects.update(post_count=5)
+        Category.objects.update(post_count=5)
+        ArchiveMonth.objects.all().delete()
+
+        call_command('rebuildcounts', stdout=StringIO())
+        self.assertEquals(Tag.objects.get().post_count, 1)
+        self.assertEquals(Category.objects.get().post_count, 1)
+        self.assertEquals(ArchiveMonth.objects.get().post_count, 1)
+
+    def test_widgets(self):
+        for number in range(3):
+            post = PostFactory(title='Post %d' % number, slug='post-%d' % number)
+            post.tags.add(TagFactory())
+        post.tags.add(TagFactory(name='django', slug='django'))
+        widgets = Template('{% load widgets %}{% get_tag_cloud as tags %}{% get_categories as categories %}'
+                           '{% get_archive_months as months %}'
+                           '{% for tag in tags %}{{ tag.name }}:{{ tag.weight }} {% endfor %}'
+                           '{% for category in categories %}{{ category.name }}:{{ category.post_count }} {% endfor %}'
+                           '{% for month in months %}{{ month.url }}:{{ month.post_count }}{% endfor %}')
+
+        # Check the counts, with the busiest tag the biggest
+        pub_date = Post.objects.all()[0].pub_date
+        self.assertEquals(widgets.render(Context()), 'django:1 python:5 python:3 /archive/%d/%d/:3' % (
+            pub_date.year, pub_date.month))
+
+        # Check warm workers don't query
+        with self.assertNumQueries(0):
+            widgets.render(Context())
+
+        # Check a new post shows
+        PostFactory(title='Post 4', slug='post-4')
+        self.assertTrue('python:4' in widgets.render(Context()))
+
+    def test_background_render(self):
+        queued = []
+        def render_later(text, callback):
+            queued.append((text, callback))
+        models.render_later, original = render_later, models.render_later
+        try:
+            # Save as the admin does: the render is queued
+            post = PostFactory.build(text='This is my *first* blog post', author=AuthorFactory(),
+                                     site=SiteFactory(), category=CategoryFactory())
+            post.save(render=False)
+            self.assertEquals(len(queued), 1)
+
+            # Check pages render it on the fly meanwhile
+            only_post = Post.objects.all()[0]
+            self.assertTrue(only_post.is_render_stale())
+            self.assertEquals(only_post.get_rendered_text(), markdown.markdown(post.text))
+
+            # Check the render is stored once done
+            text, callback = queued[0]
+            callback(markdown.markdown(text))
+            only_post = Post.objects.all()[0]
+            self.assertFalse(only_post.is_render_stale())
+            self.assertEquals(only_post.rendered_text, markdown.markdown(post.text))
+        finally:
+            models.render_later = original
+
+    def test_background_render_after_commit(self):
+        queued = []
+        models.render_later, render_later = lambda text, callback: queued.append(text), models.render_later
+        models.get_pool, get_pool = lambda: object(), models.get_pool
+        try:
+            # Save as the admin does, in a transaction, with a render pool
+            post = PostFactory.build(text='This is my *first* blog post', author=AuthorFactory(),
+                                     site=SiteFactory(), category=CategoryFactory())
+            with transaction.atomic():
+                post.save(render=False)
+
+            # Check the render waits for the request to finish
+            self.assertEquals(queued, [])
+            request_finished.send(sender=None)
+            self.assertEquals(queued, [post.text])
+            request_finished.send(sender=None)
+            self.assertEquals(len(queued), 1)
+        finally:
+            models.render_later = render_later
+            models.get_pool = get_pool
+
+
+class RenderingTest(TestCase):
+    def tearDown(self):
+        rendering.close_pool()
+
+    @override_settings(BLOGENGINE_MARKDOWN_PROCESSES=2, BLOGENGINE_MARKDOWN_POOL_MIN_LENGTH=0)
+    def test_pool(self):
+        texts = ['This is post *%d*' % number for number in range(10)]
+
+        # Check the pool renders as rendering inline does
+        self.assertTrue(rendering.get_pool() is not None)
+        self.assertEquals(rendering.render_markdown(texts[0]), markdown.markdown(texts[0]))
+        self.assertEquals(rendering.render_many(texts), [markdown.markdown(text) for text in texts])
+
+        # Check render_later calls back with the HTML
+        done = []
+        rendering.render_later(texts[0], done.append)
+        for attempt in range(100):
+            if done:
+                break
+            time.sleep(0.05)
+        self.assertEquals(done, [markdown.markdown(texts[0])])
+
+        # Check a failing callback doesn't stop the pool's next callbacks
+        def fail(html):
+            raise ValueError(html)
+        rendering.render_later(texts[1], fail)
+        rendering.render_later(texts[2], done.append)
+        for attempt in range(100):
+            if len(done) > 1:
+                break
+            time.sleep(0.05)
+        self.assertEquals(done[1:], [markdown.markdown(texts[2])])
+
+    @override_settings(BLOGENGINE_MARKDOWN_PROCESSES=1, BLOGENGINE_MARKDOWN_POOL_MIN_LENGTH=0,
+                       BLOGENGINE_MARKDOWN_TIMEOUT=0.01)
+    def test_timeout(self):
+        # Keep the only process busy
+        rendering.get_pool().apply_async(time.sleep, (1,))
+
+        # Check the request renders the text itself instead of waiting
+        start = time.time()
+        self.assertEquals(rendering.render_markdown('*Hello*'), markdown.markdown('*Hello*'))
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_instances_reused(self):
+        # Check a render returns its Markdown object for the next one
+        rendering.render_markdown('*a*')
+        with rendering.markdown_instance() as first:
+            pass
+        rendering.render_markdown('*b*')
+        with rendering.markdown_instance() as second:
+            self.assertTrue(second is first)
+
+        # Check nothing of one text leaks into the next
+        rendering.render_markdown('[a]: http://example.com/\n')
+        self.assertEquals(rendering.render_markdown('[a][]'), markdown.markdown('[a][]'))
+
+    @override_settings(BLOGENGINE_MARKDOWN_EXTRAS=['fenced-code-blocks', 'header-ids'])
+    def test_extras_from_settings(self):
+        # Check the extras are used, and change the renderer version
+        self.assertTrue('id="title"' in rendering.render_markdown('# Title'))
+        self.assertTrue('header-ids' in rendering.renderer_version())
+
+    def test_highlight_hook(self):
+        calls = []
+        def hook(codeblock, lexer, formatter_opts, highlight):
+            calls.append(codeblock)
+            return highlight(codeblock, lexer, **formatter_opts)
+        rendering.set_highlight_hook(hook)
+        try:
+            html = rendering.render_markdown('```python\nprint "hello"\n```')
+        finally:
+            rendering.set_highlight_hook(highlighting.cache.highlight)
+
+        # Check code blocks go through the hook to Pygments
+        self.assertEquals(calls, ['print "hello"'])
+        self.assertTrue('class="codehilite"' in html)
+
+    def test_highlight_cache(self):
+        highlighting.cache.clear()
+        text = '```python\nprint "hello"\n```'
+
+        # Check the second render of a code block comes from the cache
+        html = rendering.render_markdown(text)
+        self.assertEquals(rendering.render_markdown(text), html)
+        self.assertEquals(highlighting.cache.stats()['hits'], 1)
+        self.assertEquals(highlighting.cache.stats()['misses'], 1)
+
+        # Check another language is another entry
+        rendering.render_markdown('```ruby\nprint "hello"\n```')
+        self.assertEquals(highlighting.cache.stats()['entries'], 2)
+
+    def test_highlight_cache_eviction(self):
+        cache = highlighting.HighlightCache(max_bytes=100)
+        lexer = PythonLexer()
+        highlight = lambda codeblock, lexer, **options: codeblock * 2
+
+        # Check the least recently used entries go once over the size
+        cache.highlight('a' * 20, lexer, {}, highlight)
+        cache.highlight('b' * 20, lexer, {}, highlight)
+        cache.highlight('a' * 20, lexer, {}, highlight)
+        cache.highlight('c' * 20, lexer, {}, highlight)
+        self.assertEquals(cache.stats()['entries'], 2)
+        self.assertEquals(cache.stats()['bytes'], 80)
+        cache.highlight('a' * 20, lexer, {}, highlight)
+        self.assertEquals(cache.stats()['hits'], 2)
+
+        # Check formatter options are part of the key
+        cache.highlight('a' * 20, lexer, {'linenos': True}, highlight)
+        self.assertEquals(cache.stats()['misses'], 4)
+
+    def test_without_pool(self):
+        # Check rendering is inline by default
+        self.assertTrue(rendering.get_pool() is None)
+        self.assertEquals(rendering.render_many(['*a*', '*b*']),
+                          [markdown.markdown('*a*'), markdown.markdown('*b*')])
+
 
 class BaseAcceptanceTest(LiveServerTestCase):
     def setUp(self):
         self.client = Client()
 
+    @contextmanager
+    def assertMaxQueries(self, num):
+        '''Fail if the block runs more than num queries'''
+        context = CaptureQueriesContext(connection)
+        with context:
+            yield context
+        executed = len(context)
+        self.assertTrue(executed <= num, '%d queries executed, at most %d expected:\n%s' % (
+            executed, num, '\n'.join(query['sql'] for query in context.captured_queries)))
+
 
 class AdminTest(BaseAcceptanceTest):
     fixtures = ['users.json']
@@ -303,6 +694,32 @@ class AdminTest(BaseAcceptanceTest):
         all_categories = Category.objects.all()
         self.assertEquals(len(all_categories), 1)
 
+    def test_create_duplicate_category(self):
+        category = CategoryFactory() # Create the category
+
+        # Log in
+        self.client.login(username='zelda', password="password")
+
+        # Add another with the same slug, given or made from the name
+        for data in ({'name': 'Python', 'slug': category.slug},
+                     {'name': 'python'}):
+            data['description'] = 'The Python programming language'
+            response = self.client.post('/admin/blogengine/category/add/', data)
+            self.assertEquals(response.status_code, 200)
+
+            # Check the form says so instead of failing
+            self.assertTrue('already exists on this site' in response.content)
+        self.assertEquals(Category.objects.count(), 1)
+
+        # Check the same slug can still be used on another site
+        site = Site.objects.create(domain='other.example.org', name='other')
+        response = self.client.post('/admin/blogengine/category/add/', {
+            'name': 'python',
+            'description': 'The Python programming language'
+            }, HTTP_HOST='other.example.org', follow=True)
+        self.assertTrue('added successfully' in response.content)
+        self.assertEquals(Category.objects.for_site(site).count(), 1)
+
     def test_edit_category(self):
         category = CategoryFactory() # Create the category
 
@@ -485,6 +902,53 @@ class PostViewTest(BaseAcceptanceTest):
         # Check the correct template was used
         self.assertTemplateUsed(response, 'blogengine/post_list.html')
 
+    def test_date_archives(self):
+        # Create posts either side of midnight UTC at the end of May
+        may = PostFactory(pub_date=datetime(2014, 5, 31, 23, 30, tzinfo=timezone.utc))
+        june = PostFactory(title='My second post', slug='my-second-post',
+                           pub_date=datetime(2014, 6, 1, 2, 0, tzinfo=timezone.utc))
+
+        # Check the year has both
+        response = self.client.get('/archive/2014/')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(may.title in response.content)
+        self.assertTrue(june.title in response.content)
+        self.assertTemplateUsed(response, 'blogengine/date_post_list.html')
+
+        # Check months and days split in UTC, like the post URLs
+        self.assertTrue(june.get_absolute_url().startswith('/2014/6/'))
+        response = self.client.get('/archive/2014/06/')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('June 2014' in response.content)
+        self.assertTrue(june.title in response.content)
+        self.assertFalse(may.title in response.content)
+        response = self.client.get('/archive/2014/5/31/')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('May 31, 2014' in response.content)
+        self.assertTrue(may.title in response.content)
+        self.assertFalse(june.title in response.content)
+
+        # Check the posts and index pages are still found
+        self.assertEquals(self.client.get(may.get_absolute_url()).status_code, 200)
+        self.assertEquals(resolve('/2014/').url_name, 'index')
+        self.assertEquals(resolve('/2014/').kwargs, {'page': '2014'})
+
+        # Check empty and invalid dates aren't found
+        self.assertEquals(self.client.get('/archive/2013/').status_code, 404)
+        self.assertEquals(self.client.get('/archive/2014/7/').status_code, 404)
+        self.assertEquals(self.client.get('/archive/2014/13/').status_code, 404)
+        self.assertEquals(self.client.get('/archive/2014/2/30/').status_code, 404)
+
+        # Check the archive pages
+        for number in range(6):
+            PostFactory(title='Post %d' % number, slug='post-%d' % number,
+                        pub_date=datetime(2014, 5, 1 + number, tzinfo=timezone.utc))
+        response = self.client.get('/archive/2014/5/')
+        self.assertTrue('?page=2' in response.content)
+        response = self.client.get('/archive/2014/5/?page=2')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Post 0' in response.content)
+
     def test_post_page(self):
         # Create the post: author, site, category
         post = PostFactory(text='This is [my first blog post](http://127.0.0.1:8000/)')
@@ -640,7 +1104,658 @@ class PostViewTest(BaseAcceptanceTest):
         self.assertTrue('my second blog post' in response.content)
         
 
+    def test_post_page_conditional_get(self):
+        post = PostFactory() # Create a post
+        tag = TagFactory() # Create a tag
+
+        # Get the post page
+        response = self.client.get(post.get_absolute_url())
+        self.assertEquals(response.status_code, 200)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        # Ask again: not modified, by either validator
+        response = self.client.get(post.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        response = self.client.get(post.get_absolute_url(), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEquals(response.status_code, 304)
+
+        # Tag the post and ask again
+        post.tags.add(tag)
+        response = self.client.get(post.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('python' in response.content)
+
+    def test_index_conditional_get(self):
+        post = PostFactory() # Create a post
+
+        # Get the index
+        response = self.client.get(reverse('blogengine:index'))
+        etag = response['ETag']
+
+        # Check no date is sent: deleting a post wouldn't move it
+        self.assertFalse(response.has_header('Last-Modified'))
+        response = self.client.get(reverse('blogengine:index'),
+                                   HTTP_IF_MODIFIED_SINCE='Sat, 01 Jan 2050 00:00:00 GMT')
+        self.assertEquals(response.status_code, 200)
+
+        # Ask again: not modified
+        response = self.client.get(reverse('blogengine:index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+        # Delete the post and ask again
+        post.delete()
+        response = self.client.get(reverse('blogengine:index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('No posts found' in response.content)
+
+
+class KeysetPaginationTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(KeysetPaginationTest, self).setUp()
+        # Create more posts than fit on a page, all with the same date
+        for number in range(7):
+            PostFactory(title='Post %d' % number, slug='post-%d' % number)
+
+    def get_link(self, response, name):
+        # Pull the cursor link out of the pager
+        start = response.content.index('?%s=' % name)
+        return response.content[start:response.content.index('"', start)]
+
+    @override_settings(BLOGENGINE_KEYSET_PAGINATION=True)
+    def test_index(self):
+        # Fetch the first page: newest posts first
+        response = self.client.get(reverse('blogengine:index'))
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Post 6' in response.content)
+        self.assertTrue('Post 2' in response.content)
+        self.assertTrue('Post 1' not in response.content)
+
+        # Follow the link to older posts
+        response = self.client.get(reverse('blogengine:index') + self.get_link(response, 'after'))
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Post 1' in response.content)
+        self.assertTrue('Post 0' in response.content)
+        self.assertTrue('Post 2' not in response.content)
+
+        # Follow the link back to newer posts
+        response = self.client.get(reverse('blogengine:index') + self.get_link(response, 'before'))
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Post 6' in response.content)
+        self.assertTrue('Post 2' in response.content)
+        self.assertTrue('Post 1' not in response.content)
+
+    @override_settings(BLOGENGINE_KEYSET_PAGINATION=True)
+    def test_page_numbers_still_work(self):
+        response = self.client.get(reverse('blogengine:index', kwargs={'page': 2}))
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('Post 1' in response.content)
+        self.assertTrue('Post 2' not in response.content)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/category/python/?after=blah')
+        self.assertEquals(response.status_code, 404)
+
+        # A timestamp out of range is just as invalid
+        response = self.client.get('/?after=99999999999999999999.1.1')
+        self.assertEquals(response.status_code, 404)
+        response = self.client.get('/?before=-99999999999999999999.1.1')
+        self.assertEquals(response.status_code, 404)
+
+
+class QueryCountTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(QueryCountTest, self).setUp()
+        # Create a full page of tagged posts
+        tag = TagFactory()
+        for number in range(5):
+            post = PostFactory(title='Post %d' % number, slug='post-%d' % number)
+            post.tags.add(tag)
+        # Measure rendering, not the page cache or resolving the host
+        cache.clear()
+        hosts.site_ids_by_domain()
+
+    def test_index(self):
+        with self.assertMaxQueries(5):
+            response = self.client.get(reverse('blogengine:index'))
+        self.assertEquals(response.status_code, 200)
+
+    @override_settings(BLOGENGINE_DENORMALIZE_TAXONOMY=True)
+    def test_index_denormalized(self):
+        call_command('rebuildtaxonomy', stdout=StringIO())
+
+        # The category and tags are stored on the posts, so not queried
+        with self.assertMaxQueries(4):
+            response = self.client.get(reverse('blogengine:index'))
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('label-success' in response.content)
+
+    def test_category_page(self):
+        with self.assertMaxQueries(7):
+            response = self.client.get('/category/python/')
+        self.assertEquals(response.status_code, 200)
+
+    def test_tag_page(self):
+        with self.assertMaxQueries(7):
+            response = self.client.get('/tag/python/')
+        self.assertEquals(response.status_code, 200)
+
+    def test_search(self):
+        with self.assertMaxQueries(5):
+            response = self.client.get(reverse('blogengine:search') + '?q=post')
+        self.assertEquals(response.status_code, 200)
+
+    def test_date_archive(self):
+        post = Post.objects.all()[0]
+        with self.assertMaxQueries(7):
+            response = self.client.get('/archive/%d/%d/' % (post.pub_date.year, post.pub_date.month))
+        self.assertEquals(response.status_code, 200)
+
+    def test_date_archive_index(self):
+        if connection.vendor != 'sqlite':
+            return
+        # Check archives seek the (site, pub_date) index rather than scan
+        post = Post.objects.all()[0]
+        start, end = models.date_range(post.pub_date.year, post.pub_date.month)
+        posts = Post.objects.filter(site=post.site_id, pub_date__gte=start, pub_date__lt=end)
+        for queryset in (posts.for_listing(), posts.order_by()):
+            sql, params = queryset.query.sql_with_params()
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+            self.assertTrue('USING INDEX' in plan, plan)
+            self.assertTrue('site_id=? AND pub_date>? AND pub_date<?' in plan, plan)
+
+    def test_post_page(self):
+        post = Post.objects.all()[0]
+        with self.assertMaxQueries(3):
+            response = self.client.get(post.get_absolute_url())
+        self.assertEquals(response.status_code, 200)
+
+
+class CacheInvalidationTest(BaseAcceptanceTest):
+    def test_unrelated_keys_survive_post_save(self):
+        cache.set('unrelated', 'value') # Something not built from posts
+        PostFactory() # Create the post: author, site, category
+
+        # Check the key was not cleared
+        self.assertEquals(cache.get('unrelated'), 'value')
+
+    def test_delete_post(self):
+        post = PostFactory() # Create the post: author, site, category
+
+        # Fetch the index
+        response = self.client.get(reverse('blogengine:index'))
+        self.assertTrue(post.title in response.content)
+
+        # Delete the post and fetch the index again
+        post.delete()
+        response = self.client.get(reverse('blogengine:index'))
+        self.assertTrue('No posts found' in response.content)
+
+    def test_add_tag(self):
+        post = PostFactory() # Create the post: author, site, category
+
+        # Fetch the post
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('label-success' not in response.content)
+
+        # Tag the post from the tag side and fetch it again
+        tag = TagFactory()
+        tag.post_set.add(post)
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue(tag.name in response.content)
+
+    def test_edit_category(self):
+        post = PostFactory() # Create the post: author, site, category
+
+        # Fetch the index
+        response = self.client.get(reverse('blogengine:index'))
+        self.assertTrue('python' in response.content)
+
+        # Rename the category and fetch the index again
+        category = post.category
+        category.name = 'perl'
+        category.save()
+        response = self.client.get(reverse('blogengine:index'))
+        self.assertTrue('perl' in response.content)
+
+    def test_other_post_keeps_cached_page(self):
+        post = PostFactory() # Create the post: author, site, category
+
+        # Fetch the post so its page is cached
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('This is my first blog post' in response.content)
+
+        # Change the text behind the cache's back, then save another post
+        Post.objects.filter(pk=post.pk).update(text='Changed', rendered_text='Changed')
+        PostFactory(title='My second post', slug='my-second-post')
+
+        # Check the first post is still served from the cache
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('This is my first blog post' in response.content)
+
+
+class MultiSiteTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(MultiSiteTest, self).setUp()
+        # Create a post on each of two sites, with the same slugs
+        self.post = PostFactory()
+        self.other_site = Site.objects.create(domain='other.example.org', name='other')
+        other_category = CategoryFactory(site=self.other_site, name='perl', slug='python')
+        self.other_post = PostFactory(site=self.other_site, category=other_category,
+                                      title='My other post')
+
+    def get(self, url, host='example.com'):
+        return self.client.get(url, HTTP_HOST=host)
+
+    def test_resolve_host(self):
+        self.assertEquals(hosts.site_id_for_host('example.com'), self.post.site_id)
+        self.assertEquals(hosts.site_id_for_host('Other.Example.org:8000'), self.other_site.pk)
+
+        # Check unknown hosts get SITE_ID
+        self.assertEquals(hosts.site_id_for_host('unknown.example.net'), 1)
+
+        # Check changing a domain is seen
+        self.other_site.domain = 'blog.example.org'
+        self.other_site.save()
+        self.assertEquals(hosts.site_id_for_host('blog.example.org'), self.other_site.pk)
+
+    def test_pages(self):
+        # Check each site lists its own posts
+        response = self.get('/')
+        self.assertTrue(self.post.title in response.content)
+        self.assertFalse(self.other_post.title in response.content)
+        response = self.get('/', 'other.example.org')
+        self.assertTrue(self.other_post.title in response.content)
+        self.assertFalse(self.post.title in response.content)
+
+        # Check the same slugs find the post and category of the site
+        response = self.get(self.other_post.get_absolute_url(), 'other.example.org')
+        self.assertTrue(self.other_post.title in response.content)
+        response = self.get('/category/python/', 'other.example.org')
+        self.assertTrue(self.other_post.title in response.content)
+        self.assertFalse(self.post.title in response.content)
+
+        # Check searches and feeds only find the posts of the site
+        response = self.get(reverse('blogengine:search') + '?q=post', 'other.example.org')
+        self.assertTrue(self.other_post.title in response.content)
+        self.assertFalse(self.post.title in response.content)
+        feed = ''.join(self.get(reverse('blogengine:feed')).streaming_content)
+        self.assertTrue(self.post.title in feed)
+        self.assertFalse(self.other_post.title in feed)
+
+    def test_feed_links(self):
+        # Check the feed of the other site links to the other site
+        feed = ''.join(self.get(reverse('blogengine:feed'), 'other.example.org').streaming_content)
+        self.assertTrue('<link>http://other.example.org%s</link>' % self.other_post.get_absolute_url()
+                        in feed)
+        self.assertTrue('<link>http://other.example.org/</link>' in feed)
+        self.assertFalse('example.com' in feed)
+
+        # Check category feeds too
+        feed = ''.join(self.get('/feeds/posts/category/python/', 'other.example.org').streaming_content)
+        self.assertTrue('http://other.example.org/category/python/' in feed)
+        self.assertFalse('example.com' in feed)
+
+    def test_sitemap(self):
+        page = FlatPageFactory() # Create a flat page on the first site
+        page.sites.add(self.post.site)
+
+        response = self.get('/sitemap-posts.xml', 'other.example.org')
+        self.assertTrue('http://other.example.org%s' % self.other_post.get_absolute_url()
+                        in response.content)
+        self.assertFalse('example.com' in response.content)
+        response = self.get('/sitemap-pages.xml', 'other.example.org')
+        self.assertFalse('/about/' in response.content)
+        response = self.get('/sitemap.xml', 'other.example.org')
+        self.assertTrue('http://other.example.org/sitemap-posts.xml' in response.content)
+
+    def test_cache_partitioned(self):
+        # Fetch the index of each site, which caches them
+        self.get('/')
+        self.get('/', 'other.example.org')
+
+        # Edit the post on the other site
+        self.other_post.title = 'My edited post'
+        self.other_post.save()
+
+        # Check the first site is still served from the cache
+        with self.assertMaxQueries(0):
+            response = self.get('/')
+        self.assertTrue(self.post.title in response.content)
+
+        # Check the other site shows the edit
+        response = self.get('/', 'other.example.org')
+        self.assertTrue('My edited post' in response.content)
+
+
+class StampedeTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(StampedeTest, self).setUp()
+        # Pages of other tests' posts may share these posts' URLs
+        cache.clear()
+
+    def hold_locks(self):
+        '''Make every page lock taken by another worker'''
+        self.held = []
+        def acquire_lock(fetch_middleware, cache_key):
+            _acquire_lock(fetch_middleware, cache_key)
+            self.held.append(middleware.lock_key(cache_key))
+            return False
+        FetchFromCacheMiddleware.acquire_lock = acquire_lock
+
+    def release_locks(self):
+        '''Let the other worker finish'''
+        FetchFromCacheMiddleware.acquire_lock = _acquire_lock
+        cache.delete_many(getattr(self, 'held', []))
+
+    def tearDown(self):
+        self.release_locks()
+
+    def test_stale_page_served_while_rebuilt(self):
+        post = PostFactory() # Create the post
+
+        # Fetch the post so its page is cached
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('This is my first blog post' in response.content)
+
+        # Edit the post while another worker is rebuilding its page
+        post.text = 'This is my edited blog post'
+        post.save()
+        self.hold_locks()
+
+        # Check the old page is served meanwhile
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('This is my first blog post' in response.content)
+
+        # Once the lock is free, the page is rebuilt
+        self.release_locks()
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('This is my edited blog post' in response.content)
+
+    @override_settings(BLOGENGINE_CACHE_LOCK_WAIT=0.1)
+    def test_missing_page_built_after_waiting(self):
+        post = PostFactory() # Create the post
+
+        # Cache the page's headers, then drop the page
+        self.client.get(post.get_absolute_url())
+        for key in list(cache._cache.keys()):
+            if 'cache_page' in key:
+                cache.delete(key.split(':', 2)[-1])
+
+        # Nothing to serve and the lock taken: wait, then build it anyway
+        self.hold_locks()
+        start = time.time()
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('This is my first blog post' in response.content)
+
+    @contextmanager
+    def clock_moved(self, seconds):
+        '''Make the cache and middleware think seconds have passed'''
+        real_time = time.time
+        time.time = lambda: real_time() + seconds
+        try:
+            yield
+        finally:
+            time.time = real_time
+
+    def count_rebuilds(self):
+        '''List getting an entry for each page built'''
+        rebuilds = []
+        def rebuild(middleware, request, cache_key):
+            rebuilds.append(request.path)
+            return _rebuild(middleware, request, cache_key)
+        FetchFromCacheMiddleware.rebuild = rebuild
+        self.addCleanup(setattr, FetchFromCacheMiddleware, 'rebuild', _rebuild)
+        return rebuilds
+
+    @override_settings(CACHE_MIDDLEWARE_SECONDS=300, BLOGENGINE_CACHE_STALE_SECONDS=60)
+    def test_expired_page_rebuilt_once(self):
+        post = PostFactory() # Create the post
+
+        # Fetch the post so its page is cached
+        self.client.get(post.get_absolute_url())
+        rebuilds = self.count_rebuilds()
+
+        with self.clock_moved(330):
+            # The page has expired and another worker is rebuilding it
+            self.hold_locks()
+            for i in range(3):
+                response = self.client.get(post.get_absolute_url())
+                self.assertTrue('This is my first blog post' in response.content)
+            self.assertEquals(rebuilds, [])
+
+            # Once the lock is free, one request rebuilds it
+            self.release_locks()
+            for i in range(3):
+                self.client.get(post.get_absolute_url())
+            self.assertEquals(rebuilds, [post.get_absolute_url()])
+
+    @override_settings(BLOGENGINE_CACHE_LOCK_WAIT=0.1)
+    def test_uncached_page_locked_on_url(self):
+        post = PostFactory() # Create the post
+
+        # Never cached and another worker building it: wait for its page
+        self.hold_locks()
+        start = time.time()
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertEquals(response.status_code, 200)
+
+    @override_settings(BLOGENGINE_CACHE_LOCK_WAIT=2.0)
+    def test_overlapping_feed_requests(self):
+        PostFactory() # Create a post
+        key_prefix = FetchFromCacheMiddleware().key_prefix
+        def feed_lock(url):
+            request = RequestFactory().get(url)
+            return middleware.lock_key(middleware.url_key(
+                request, middleware.site_key_prefix(key_prefix, request)))
+
+        # Another request is building the feed, and finishes while this one waits
+        locked = feed_lock('/feeds/posts/?first')
+        cache.add(locked, 1)
+        sleep = time.sleep
+        def finish(seconds):
+            cache.delete(locked)
+            sleep(seconds)
+        time.sleep = finish
+        try:
+            start = time.time()
+            response = self.client.get('/feeds/posts/?first')
+        finally:
+            time.sleep = sleep
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(time.time() - start < 1)
+
+        # The feed streams so is never stored: once built, check requests
+        # overlapping the next one building it don't wait
+        self.client.get('/feeds/posts/')
+        locked = feed_lock('/feeds/posts/')
+        cache.add(locked, 1)
+        start = time.time()
+        response = self.client.get('/feeds/posts/')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(time.time() - start < 1)
+        cache.delete(locked)
+
+    def test_post_edited_while_page_built(self):
+        post = PostFactory() # Create the post
+
+        # Edit the post right after the view loaded it
+        get_object = SingleObjectMixin.get_object
+        def get_object_then_edit(view, queryset=None):
+            obj = get_object(view, queryset)
+            edited = Post.objects.get(pk=post.pk)
+            edited.text = 'This is my edited blog post'
+            edited.save()
+            return obj
+        SingleObjectMixin.get_object = get_object_then_edit
+        try:
+            response = self.client.get(post.get_absolute_url())
+            self.assertTrue('This is my first blog post' in response.content)
+        finally:
+            SingleObjectMixin.get_object = get_object
+
+        # Check the page built from the old post isn't served as current
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('This is my edited blog post' in response.content)
+
+    def test_dependency_versions_read_before_build(self):
+        dep = caching.dependency('posts', 1)
+
+        # Invalidated while the value was built
+        def build():
+            caching.invalidate(dep)
+            return 'old'
+        self.assertEquals(caching.memoize('blogengine:test:memoized', [dep], build), 'old')
+
+        # Check the value is built again
+        self.assertEquals(caching.memoize('blogengine:test:memoized', [dep], lambda: 'new'), 'new')
+
+    @override_settings(BLOGENGINE_CACHE_BACKGROUND_REFRESH=True)
+    def test_background_refresh(self):
+        post = PostFactory() # Create the post
+        self.client.get(post.get_absolute_url())
+
+        # Run refreshes right away: a thread can't see the in-memory test database
+        refreshes = []
+        class Thread(object):
+            def __init__(self, target):
+                self.target = target
+            def start(self):
+                self.target()
+                refreshes.append(self)
+        threading = middleware.threading
+        middleware.threading = type('threading', (), {'Thread': Thread})
+        try:
+            # Edit the post: the old page is served while it is rebuilt
+            post.text = 'This is my edited blog post'
+            post.save()
+            response = self.client.get(post.get_absolute_url())
+            self.assertTrue('This is my first blog post' in response.content)
+            self.assertEquals(len(refreshes), 1)
+        finally:
+            middleware.threading = threading
+
+        # Check the rebuilt page is served next
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('This is my edited blog post' in response.content)
+
+    def test_early_expiry(self):
+        # Far from expiry: not refreshed early
+        self.assertFalse(should_refresh_early(expires=1000, delta=0.1, beta=1.0, now=900, rand=0.5))
+        # Close to expiry after a slow build: refreshed early
+        self.assertTrue(should_refresh_early(expires=1000, delta=5, beta=1.0, now=999, rand=0.5))
+        # Disabled
+        self.assertFalse(should_refresh_early(expires=1000, delta=5, beta=0, now=999, rand=0.5))
+
+
+class TwoTierCacheTest(TestCase):
+    def make_cache(self, **options):
+        '''A worker's cache, in front of the shared default cache'''
+        options.setdefault('GENERATION_INTERVAL', 0)
+        return TwoTierCache('default', {'OPTIONS': options})
+
+    def setUp(self):
+        cache.clear()
+
+    def test_local_tier(self):
+        worker = self.make_cache()
+        worker.set('key', 'value')
+
+        # Check the value is kept locally: gone from the shared cache, still served
+        cache.delete('key')
+        self.assertEquals(worker.get('key'), 'value')
+        self.assertEquals(worker.hits, 1)
+
+        # Check other workers go to the shared cache
+        self.assertEquals(self.make_cache().get('key'), None)
+
+    def test_invalidation_reaches_other_workers(self):
+        first, second = self.make_cache(), self.make_cache()
+        first.set('version', 1)
+        self.assertEquals(second.get('version'), 1)
+
+        # Check an incr() on one worker is seen by the other
+        first.incr('version')
+        self.assertEquals(second.get('version'), 2)
+
+        # Check clear() is too
+        second.get_many(['version'])
+        first.clear()
+        self.assertEquals(second.get('version'), None)
+
+    def test_byte_budget(self):
+        worker = self.make_cache(MAX_BYTES=1000)
+        for number in range(10):
+            worker.set('key%d' % number, 'x' * 200)
+
+        # Check the oldest were dropped locally but are still shared
+        self.assertTrue(worker._bytes <= 1000)
+        cache.delete('key9')
+        self.assertEquals(worker.get('key9'), 'x' * 200)
+        self.assertEquals(worker.get('key0'), 'x' * 200)
+        self.assertEquals(worker.hits, 1)
+
+    def test_local_timeout(self):
+        worker = self.make_cache(LOCAL_TIMEOUT=0.05)
+        worker.set('key', 'value')
+        cache.set('key', 'changed')
+
+        # Check the local copy expires
+        self.assertEquals(worker.get('key'), 'value')
+        time.sleep(0.06)
+        self.assertEquals(worker.get('key'), 'changed')
+
+
+class PostCardTest(BaseAcceptanceTest):
+    def test_cards_cached(self):
+        post = PostFactory() # Create a post
+        tag = TagFactory() # Create a tag
+        post.tags.add(tag)
+
+        # Render the cards of a page
+        posts = list(Post.objects.for_listing())
+        cards = render_cards(posts)
+        self.assertTrue('My first post' in cards[0])
+        self.assertEquals(cache.get(card_key(posts[0])), cards[0])
+
+        # The same card is used by other pages
+        post_cards_template = 'blogengine/includes/post_card.html'
+        response = self.client.get(reverse('blogengine:tag', kwargs={'slug': 'python'}))
+        self.assertTrue(post_cards_template not in [t.name for t in response.templates])
+        self.assertTrue(cards[0] in response.content)
+
+    def test_cards_follow_changes(self):
+        post = PostFactory() # Create a post
+        tag = TagFactory() # Create a tag
+        post.tags.add(tag)
+        key = card_key(Post.objects.for_listing()[0])
+
+        # Rename the tag: the card gets a new key
+        tag.name = 'perl'
+        tag.save()
+        only_post = Post.objects.for_listing()[0]
+        self.assertTrue(card_key(only_post) != key)
+        self.assertTrue('perl' in render_cards([only_post])[0])
+
+        # Edit the post: the card gets a new key
+        key = card_key(only_post)
+        only_post.title = 'My edited post'
+        only_post.save()
+        only_post = Post.objects.for_listing()[0]
+        self.assertTrue(card_key(only_post) != key)
+        self.assertTrue('My edited post' in render_cards([only_post])[0])
+
+
 class FeedTest(BaseAcceptanceTest):
+    def get_content(self, response):
+        # Feeds are streamed
+        return ''.join(response.streaming_content)
+
     def test_all_post_feed(self):
         # Create the post: author, site, category
         post = PostFactory(text='This is my *first* blog post')
@@ -658,7 +1773,8 @@ class FeedTest(BaseAcceptanceTest):
         self.assertEquals(response.status_code, 200)
 
         # Parse the feed
-        feed = feedparser.parse(response.content)
+        content = self.get_content(response)
+        feed = feedparser.parse(content)
 
         # Check length
         self.assertEquals(len(feed.entries), 1)
@@ -685,7 +1801,8 @@ class FeedTest(BaseAcceptanceTest):
         self.assertEquals(response.status_code, 200)
 
         # Parse the feed
-        feed = feedparser.parse(response.content)
+        content = self.get_content(response)
+        feed = feedparser.parse(content)
 
         # Check length
         self.assertEquals(len(feed.entries), 1)
@@ -696,7 +1813,7 @@ class FeedTest(BaseAcceptanceTest):
         self.assertTrue('This is my <em>first</em> blog post' in feed_post.description)
 
         # Check other post is not in this feed
-        self.assertTrue('This is my <em>second</em> blog post' not in response.content)
+        self.assertTrue('This is my <em>second</em> blog post' not in content)
 
     def test_tag_feed(self):
         # Create a post
@@ -715,7 +1832,8 @@ class FeedTest(BaseAcceptanceTest):
         self.assertEquals(response.status_code, 200)
 
         # Parse the feed
-        feed = feedparser.parse(response.content)
+        content = self.get_content(response)
+        feed = feedparser.parse(content)
 
         # Check length
         self.assertEquals(len(feed.entries), 1)
@@ -726,9 +1844,80 @@ class FeedTest(BaseAcceptanceTest):
         self.assertTrue('This is my <em>first</em> blog post' in feed_post.description)
 
         # Check other post is not in this feed
-        self.assertTrue('This is my <em>second</em> blog post' not in response.content)
+        self.assertTrue('This is my <em>second</em> blog post' not in content)
+
+    def test_item_limit(self):
+        # Create more posts than the feed holds
+        for number in range(3):
+            PostFactory(title='Post %d' % number, slug='post-%d' % number)
+
+        # Fetch the feed
+        with self.settings(BLOGENGINE_FEED_ITEMS=2):
+            response = self.client.get('/feeds/posts/')
+        self.assertEquals(response.status_code, 200)
+
+        # Check only the limit was included
+        feed = feedparser.parse(self.get_content(response))
+        self.assertEquals(len(feed.entries), 2)
+
+    def test_conditional_get(self):
+        post = PostFactory() # Create a post
+
+        # Fetch the feed
+        response = self.client.get('/feeds/posts/')
+        self.assertEquals(response.status_code, 200)
+        etag = response['ETag']
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        # Poll again with the ETag: nothing changed
+        response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+        # Edit the post and poll again
+        post.text = 'This is my edited blog post'
+        post.save()
+        response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('edited' in self.get_content(response))
+
+
+class PerformanceTest(BaseAcceptanceTest):
+    fixtures = ['users.json']
+
+    def test_performance_stats(self):
+        post = PostFactory() # Create a post
+        instrumentation.reset()
+
+        # Get the index twice, the second time from the cache
+        self.client.get(reverse('blogengine:index'))
+        self.client.get(reverse('blogengine:index'))
+        self.client.get(post.get_absolute_url())
+
+        # Check the stats are for staff only
+        response = self.client.get('/performance.json')
+        self.assertEquals(response.status_code, 403)
+        self.client.login(username='zelda', password='password')
+        response = self.client.get('/performance.json')
+        self.assertEquals(response.status_code, 200)
+
+        # Check both views were recorded
+        stats = json.loads(response.content)['views']
+        self.assertEquals(stats['index']['total_ms']['count'], 2)
+        self.assertEquals(stats['post']['total_ms']['count'], 1)
+        self.assertTrue(stats['post']['queries']['sum'] > 0)
+        self.assertTrue(stats['post']['query_ms']['sum'] > 0)
+        self.assertTrue(stats['post']['template_ms']['sum'] > 0)
+
+        # Check queries are counted without the debug cursor keeping them
+        connection.queries = []
+        self.client.get(post.get_absolute_url() + '?uncached')
+        self.assertFalse(connection.use_debug_cursor)
+        self.assertEquals(connection.queries, [])
+        self.assertTrue(stats['index']['cache_hits']['max'] > 0)
+        self.assertTrue(stats['index']['cache_misses']['max'] > 0)
+        self.assertTrue('performance' not in stats)
+
 
-        
 class FlatPageViewTest(BaseAcceptanceTest):
     def test_create_flat_page(self):
         page = FlatPageFactory() # Create flat page
@@ -759,6 +1948,31 @@ class FlatPageViewTest(BaseAcceptanceTest):
         self.assertTrue('About me' in response.content)
         self.assertTrue('All about me' in response.content)
 
+    def test_navigation(self):
+        page = FlatPageFactory() # Create flat page
+        page.sites.add(Site.objects.all()[0])
+        nav = Template('{% load navigation %}{% get_navigation as pages %}'
+                       '{% for page in pages %}<a href="{{ page.url }}">{{ page.title }}</a>{% endfor %}')
+
+        # Check the page is listed
+        self.assertEquals(nav.render(Context()), '<a href="/about/">About me</a>')
+
+        # Check the list is then kept in the process and in the cache
+        with self.assertNumQueries(0):
+            nav.render(Context())
+        caching._memoized.clear()
+        with self.assertNumQueries(0):
+            nav.render(Context())
+
+        # Check editing the page updates it
+        page.title = 'About us'
+        page.save()
+        self.assertEquals(nav.render(Context()), '<a href="/about/">About us</a>')
+
+        # Check deleting it removes it
+        page.delete()
+        self.assertEquals(nav.render(Context()), '')
+
 
 class SearchViewTest(BaseAcceptanceTest):
     def test_search(self):
@@ -789,6 +2003,61 @@ class SearchViewTest(BaseAcceptanceTest):
         # Check the second post is contained in the results
         self.assertTrue('My second post' in response.content)
 
+    def test_empty_search(self):
+        # Create the posts
+        for i in range(7):
+            PostFactory(title='My post %d' % i, slug='my-post-%d' % i)
+
+        # Search for nothing: posts are paged in the database, not every id loaded
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('blogengine:search') + '?q=+')
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse(any('SELECT "blogengine_post"."id" FROM' in query['sql']
+                             for query in queries.captured_queries))
+
+        # Check every post is listed across the pages
+        self.assertEquals(response.content.count('My post'), 5)
+        response = self.client.get(reverse('blogengine:search') + '?q=&page=2')
+        self.assertEquals(response.content.count('My post'), 2)
+
+    def test_search_ranking(self):
+        # Mention the word in the text of one post, and the title of another
+        post = PostFactory(text='Learning about fossils today')
+        post2 = PostFactory(title='Fossils',
+                            text='Looking for fossils on the beach',
+                            slug='fossils')
+
+        # Search for the word
+        response = self.client.get(reverse('blogengine:search') + '?q=fossils')
+        self.assertEquals(response.status_code, 200)
+
+        # Check the title match is listed first, with the match highlighted
+        self.assertTrue(response.content.index('Looking for') < response.content.index('Learning about'))
+        self.assertTrue('<mark>fossils</mark>' in response.content)
+
+    def test_search_index_follows_edits(self):
+        post = PostFactory() # Create a post
+        backend = get_search_backend()
+        self.assertEquals(backend.search('first'), [post.pk])
+
+        # Edit the post
+        post.text = 'This is my edited blog post'
+        post.title = 'My edited post'
+        post.save()
+        self.assertEquals(backend.search('first'), [])
+        self.assertEquals(backend.search('edited'), [post.pk])
+
+        # Delete the post
+        post.delete()
+        self.assertEquals(backend.search('edited'), [])
+
+    def test_simple_backend(self):
+        post = PostFactory() # Create a post
+        backend = SimpleSearchBackend()
+
+        self.assertEquals(backend.search('FIRST'), [post.pk])
+        self.assertTrue('<mark>first</mark>' in backend.highlight('first', [post.pk])[post.pk])
+
     def test_failing_search(self):
         # Search for something that is not present
         response = self.client.get(reverse('blogengine:search') + '?q=iamerror')
@@ -805,13 +2074,430 @@ class SitemapTest(BaseAcceptanceTest):
     def test_sitemap(self):
         post = PostFactory() # Create a post
         page = FlatPageFactory() # Create a flat page
+        page.sites.add(Site.objects.all()[0])
 
-        # Get sitemap
+        # Get sitemap index
         response = self.client.get('/sitemap.xml')
         self.assertEquals(response.status_code, 200)
 
-        # Check post is present in sitemap
+        # Check it links to each section
+        self.assertTrue('/sitemap-posts.xml' in response.content)
+        self.assertTrue('/sitemap-pages.xml' in response.content)
+
+        # Check post is present in posts sitemap
+        response = self.client.get('/sitemap-posts.xml')
+        self.assertEquals(response.status_code, 200)
         self.assertTrue('my-first-post' in response.content)
 
-        # Check page is present in sitemap
-        self.assertTrue('/about/' in response.content)
\ No newline at end of file
+        # Check page is present in pages sitemap
+        response = self.client.get('/sitemap-pages.xml')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('/about/' in response.content)
+
+    def test_sitemap_pages(self):
+        # Create more posts than fit in one sitemap page
+        for number in range(3):
+            PostFactory(title='Post %d' % number, slug='post-%d' % number)
+
+        PostSitemap.limit = 2
+        try:
+            # Check the index lists the second page
+            response = self.client.get('/sitemap.xml')
+            self.assertTrue('/sitemap-posts.xml?p=2' in response.content)
+
+            # Check the second page holds the newest post only
+            response = self.client.get('/sitemap-posts.xml?p=2')
+            self.assertEquals(response.status_code, 200)
+            self.assertTrue('post-2' in response.content)
+            self.assertTrue('post-1' not in response.content)
+
+            # Check pages past the end don't exist
+            response = self.client.get('/sitemap-posts.xml?p=3')
+            self.assertEquals(response.status_code, 404)
+        finally:
+            PostSitemap.limit = 1000
+
+    def test_sitemap_conditional_get(self):
+        post = PostFactory() # Create a post
+
+        # Get the posts sitemap
+        response = self.client.get('/sitemap-posts.xml')
+        self.assertEquals(response.status_code, 200)
+        etag = response['ETag']
+
+        # Ask again with the ETag: nothing changed
+        response = self.client.get('/sitemap-posts.xml', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+        # Change the post and ask again
+        post.slug = 'my-edited-post'
+        post.save()
+        response = self.client.get('/sitemap-posts.xml', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('my-edited-post' in response.content)
+
+        # Check lastmod is the time of the edit
+        updated_at = Post.objects.get(pk=post.pk).updated_at
+        self.assertTrue('<lastmod>%s</lastmod>' % updated_at.strftime('%Y-%m-%d') in response.content)
+        self.assertTrue(response.has_header('Last-Modified'))
+
+
+class ExportStaticTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(ExportStaticTest, self).setUp()
+        self.output = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def export(self):
+        '''Export the blog, returning the number of pages rendered'''
+        stdout = StringIO()
+        call_command('exportstatic', self.output, processes=1, stdout=stdout)
+        return int(stdout.getvalue().split()[1])
+
+    def read(self, path):
+        with open(os.path.join(self.output, path)) as f:
+            return f.read()
+
+    def test_export(self):
+        post = PostFactory() # Create a post
+        tag = TagFactory() # Create a tag
+        post.tags.add(tag)
+        page = FlatPageFactory() # Create a flat page
+        page.sites.add(Site.objects.all()[0])
+
+        # Export everything
+        self.export()
+
+        # Check every kind of page was written
+        self.assertTrue('My first post' in self.read('index.html'))
+        self.assertTrue('My first post' in self.read(post.get_absolute_url().lstrip('/') + 'index.html'))
+        self.assertTrue('My first post' in self.read('category/python/index.html'))
+        self.assertTrue('My first post' in self.read('tag/python/index.html'))
+        pub_date = timezone.localtime(post.pub_date, timezone.utc)
+        self.assertTrue('My first post' in self.read('archive/%d/%d/%d/index.html' % (
+            pub_date.year, pub_date.month, pub_date.day)))
+        self.assertTrue('All about me' in self.read('about/index.html'))
+        self.assertTrue('My first post' in self.read('feeds/posts/index.xml'))
+        self.assertTrue('My first post' in self.read('feeds/posts/tag/python/index.xml'))
+        self.assertTrue('sitemap-posts.xml' in self.read('sitemap.xml'))
+        self.assertTrue('my-first-post' in self.read('sitemap-posts.xml'))
+
+    def test_export_skips_page_cache(self):
+        post = PostFactory() # Create a post
+
+        # Cache its page, then change the row without expiring it
+        self.client.get(post.get_absolute_url())
+        Post.objects.filter(pk=post.pk).update(title='My edited post')
+
+        # Check the page is rendered from the database
+        self.export()
+        self.assertTrue('My edited post' in self.read(post.get_absolute_url().lstrip('/') + 'index.html'))
+
+    def test_incremental_export(self):
+        post = PostFactory() # Create a post
+        other_post = PostFactory(title='My second post', slug='my-second-post')
+
+        # The first export renders every page, the second nothing
+        total = self.export()
+        self.assertEquals(self.export(), 0)
+
+        # Edit a post: its page and the listings are rendered again, not the other post
+        post.text = 'This is my edited blog post'
+        post.save()
+        rendered = self.export()
+        self.assertTrue(0 < rendered < total)
+        self.assertTrue('edited' in self.read(post.get_absolute_url().lstrip('/') + 'index.html'))
+
+        # Delete a post: its page is removed
+        path = os.path.join(self.output, other_post.get_absolute_url().lstrip('/'), 'index.html')
+        self.assertTrue(os.path.exists(path))
+        other_post.delete()
+        self.export()
+        self.assertFalse(os.path.exists(path))
+
+
+class StaticFilesTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'css'))
+        with open(os.path.join(self.root, 'css', 'site.css'), 'w') as f:
+            f.write('body { background: url("logo.png"); }\n' * 100)
+        with open(os.path.join(self.root, 'css', 'logo.png'), 'wb') as f:
+            f.write('\x89PNG' + '\x00' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def collect(self, names=('css/site.css', 'css/logo.png')):
+        '''Post process the files as collectstatic does'''
+        storage = CompressedManifestStaticFilesStorage(location=self.root, base_url='/static/')
+        paths = dict((name, (storage, name)) for name in names)
+        list(storage.post_process(paths))
+        return CompressedManifestStaticFilesStorage(location=self.root, base_url='/static/')
+
+    def request(self, path, **environ):
+        environ.setdefault('REQUEST_METHOD', 'GET')
+        environ['PATH_INFO'] = path
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+        body = StaticFilesApplication(lambda environ, start_response: ['django'],
+                                      root=self.root, prefix='/static/')(environ, start_response)
+        return response.get('status'), response.get('headers'), ''.join(body)
+
+    def test_storage(self):
+        storage = self.collect()
+
+        # Check the hashed names are in the manifest and used for URLs
+        url = storage.url('css/site.css')
+        self.assertTrue(url.startswith('/static/css/site.'))
+        self.assertTrue(url != '/static/css/site.css')
+        hashed = url[len('/static/'):]
+        self.assertTrue(os.path.exists(os.path.join(self.root, hashed)))
+
+        # Check the CSS points at the hashed image
+        with open(os.path.join(self.root, hashed)) as f:
+            self.assertTrue(storage.url('css/logo.png').split('/')[-1] in f.read())
+
+        # Check the CSS was compressed, and the image wasn't
+        self.assertTrue(os.path.exists(os.path.join(self.root, hashed + '.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'css', 'logo.png.gz')))
+
+    def test_storage_without_manifest(self):
+        # Check plain names are used until collectstatic has run
+        storage = CompressedManifestStaticFilesStorage(location=self.root, base_url='/static/')
+        self.assertEquals(storage.url('css/site.css'), '/static/css/site.css')
+
+    @override_settings(BLOGENGINE_BUNDLES={'all.css': ['css/site.css', 'css/extra.css']})
+    def test_bundles(self):
+        with open(os.path.join(self.root, 'css', 'extra.css'), 'w') as f:
+            f.write('/* Comment */\na > b {\n    content: "a  ,  b";\n}\n')
+
+        # Check sources are linked until the bundle is built
+        storage = CompressedManifestStaticFilesStorage(location=self.root, base_url='/static/')
+        self.assertEquals(bundles.bundle_urls('all.css', storage),
+                          ['/static/css/site.css', '/static/css/extra.css'])
+
+        # Check the bundle is linked once built
+        storage = self.collect(('css/site.css', 'css/extra.css', 'css/logo.png'))
+        urls = bundles.bundle_urls('all.css', storage)
+        self.assertEquals(len(urls), 1)
+        self.assertTrue(urls[0].startswith('/static/blogengine/bundles/all.'))
+
+        # Check it is both files, minified, with the image URL still working
+        with open(os.path.join(self.root, urls[0][len('/static/'):])) as f:
+            content = f.read()
+        self.assertTrue('a>b{content:"a  ,  b"}' in content)
+        self.assertFalse('Comment' in content)
+        self.assertTrue('url("../../css/logo.' in content)
+
+    def test_base_template(self):
+        response = self.client.get(reverse('blogengine:index'))
+
+        # Check the critical CSS is inlined and the bundles deferred
+        self.assertTrue('<style>' in response.content)
+        self.assertTrue('media="print" onload=' in response.content)
+        self.assertTrue('defer></script>' in response.content)
+        self.assertFalse('code.jquery.com' in response.content)
+
+        # Check modernizr still runs in <head>, before the first paint
+        head = response.content.split('</head>')[0]
+        self.assertTrue('modernizr-2.6.2.min.js"></script>' in head)
+
+        # Check a missing critical stylesheet doesn't break pages
+        self.assertEquals(inline_css('blogengine/css/missing.css'), '')
+
+    def test_serve(self):
+        hashed = self.collect().url('css/site.css')
+
+        # Check a hashed file is immutable, and compressed when the client accepts it
+        status, headers, body = self.request(hashed, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEquals(status, '200 OK')
+        self.assertEquals(headers['Content-Encoding'], 'gzip')
+        self.assertEquals(headers['Content-Type'], 'text/css')
+        self.assertEquals(headers['Vary'], 'Accept-Encoding')
+        self.assertTrue('immutable' in headers['Cache-Control'])
+        self.assertEquals(int(headers['Content-Length']), len(body))
+
+        # Check clients that don't accept gzip get it uncompressed
+        status, headers, body = self.request(hashed, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertTrue(body.startswith('body {'))
+
+        # Check unhashed names get a short lifetime
+        status, headers, body = self.request('/static/css/site.css')
+        self.assertFalse('immutable' in headers['Cache-Control'])
+
+        # Check If-Modified-Since
+        status, headers, body = self.request(hashed, HTTP_IF_MODIFIED_SINCE=headers['Last-Modified'])
+        self.assertEquals(status, '304 Not Modified')
+
+        # Check the server's file wrapper is used
+        wrapped = []
+        def file_wrapper(f, block_size):
+            wrapped.append(f)
+            return iter([f.read()])
+        status, headers, body = self.request(hashed, **{'wsgi.file_wrapper': file_wrapper})
+        self.assertEquals(len(wrapped), 1)
+
+    def test_serve_outside_root(self):
+        # Check missing files and files outside the root are not found
+        self.assertEquals(self.request('/static/css/missing.css')[0], '404 Not Found')
+        self.assertEquals(self.request('/static/../tests.py')[0], '404 Not Found')
+
+        # Check other URLs go to Django
+        self.assertEquals(self.request('/about/')[2], 'django')
+
+
+class BenchmarkTest(TestCase):
+    def test_benchmark(self):
+        from blogengine.management.commands.benchmark import Command
+        command = Command()
+        command.stdout = StringIO()
+        cache.set('blogengine:live', 'kept')
+
+        # Generate a small corpus and benchmark it
+        results = command.benchmark([30], requests=2, warm_cache=False, seed=1)
+
+        # Check the configured cache was neither cleared nor filled
+        self.assertEquals(cache.get('blogengine:live'), 'kept')
+        self.assertTrue(caching.cache is cache)
+
+        # Check posts were created with tags, and counted
+        self.assertEquals(Post.objects.count(), 30)
+        self.assertTrue(Post.tags.through.objects.count() > 0)
+        for tag in Tag.objects.all():
+            self.assertEquals(tag.post_count, tag.post_set.count())
+        self.assertEquals(sum(ArchiveMonth.objects.values_list('post_count', flat=True)), 30)
+
+        # Check every kind of page was measured
+        urls = results['30']['urls']
+        for name in ('index', 'category', 'tag', 'feed', 'search', 'sitemap_posts', 'post_1'):
+            self.assertTrue(urls[name]['p50_ms'] > 0)
+            self.assertTrue(urls[name]['queries'] > 0)
+
+
+class ImportPostsTest(TestCase):
+    def setUp(self):
+        self.author = AuthorFactory() # Create the author
+        self.site = SiteFactory() # Create the site
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'posts')
+        os.mkdir(self.source)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, content):
+        with open(os.path.join(self.source, name), 'w') as f:
+            f.write(content)
+
+    def import_posts(self, source=None, **options):
+        output = StringIO()
+        options.setdefault('author', 'testuser')
+        call_command('importposts', source or self.source, stdout=output, **options)
+        return output.getvalue()
+
+    def test_import_markdown(self):
+        self.write('01-first.md', '---\ntitle: My first post\ndate: 2014-05-01 10:00\n'
+                                  'category: python\ntags: [django, testing]\n---\n'
+                                  'This is [my first blog post](http://127.0.0.1:8000/)\n')
+        self.write('02-second.markdown', '---\ntitle: My second post\nslug: second\n'
+                                         'date: 2014-06-02\ntags: django\n---\nMore\n')
+        self.write('notes.txt', 'Not a post')
+
+        output = self.import_posts()
+        self.assertTrue('Imported 2 posts (2 new, 0 updated)' in output)
+        self.assertTrue('posts/s' in output)
+
+        # Check the posts, rendered, with their category and tags
+        post = Post.objects.get(slug='my-first-post')
+        self.assertEquals(post.title, 'My first post')
+        self.assertEquals(post.site, self.site)
+        self.assertEquals(post.author, self.author)
+        self.assertEquals(post.category.name, 'python')
+        self.assertEquals(sorted(tag.name for tag in post.tags.all()), ['django', 'testing'])
+        self.assertTrue('<a href="http://127.0.0.1:8000/">my first blog post</a>' in post.rendered_text)
+        self.assertFalse(post.is_render_stale())
+        self.assertEquals(Post.objects.get(slug='second').category, None)
+
+        # Check the counts and search index were brought up to date
+        self.assertEquals(Tag.objects.get(slug='django').post_count, 2)
+        self.assertEquals(Category.objects.get(slug='python').post_count, 1)
+        self.assertEquals(ArchiveMonth.objects.count(), 2)
+        self.assertEquals(get_search_backend().search('blog'), [post.pk])
+
+        # Check importing again updates the posts instead of adding them
+        self.write('02-second.markdown', '---\ntitle: My edited post\nslug: second\n'
+                                         'date: 2014-06-02\n---\nEdited\n')
+        output = self.import_posts()
+        self.assertTrue('Imported 2 posts (0 new, 2 updated)' in output)
+        self.assertEquals(Post.objects.count(), 2)
+        self.assertEquals(Post.objects.get(slug='second').title, 'My edited post')
+        self.assertEquals(Tag.objects.get(slug='django').post_count, 1)
+
+    def test_import_json_lines(self):
+        source = os.path.join(self.root, 'posts.jsonl')
+        with open(source, 'w') as f:
+            for number in range(5):
+                f.write(json.dumps({'title': 'Post %d' % number, 'pub_date': '2014-05-0%dT10:00:00Z' % (number + 1),
+                                    'text': 'Post number %d' % number, 'category': 'python'}) + '\n')
+
+        # Check batches are reported, and nothing fires per post
+        with CaptureQueriesContext(connection) as context:
+            output = self.import_posts(source, batch_size=2)
+        self.assertTrue('4 posts imported' in output)
+        self.assertEquals(Post.objects.count(), 5)
+        self.assertEquals(Post.objects.get(slug='post-0').pub_date.day, 1)
+        self.assertEquals(Category.objects.get().post_count, 5)
+        self.assertTrue(len(context.captured_queries) < 60)
+
+        # Check the checkpoint is gone once done
+        self.assertFalse(os.path.exists(source + '.checkpoint'))
+
+    def test_duplicate_tags_and_bad_slugs(self):
+        # Tags differing only in case are one tag
+        self.write('01-first.md', '---\ntitle: My first post\ndate: 2014-05-01\n'
+                                  'tags: Python, python\n---\nText\n')
+        self.import_posts()
+        post = Post.objects.get(slug='my-first-post')
+        self.assertEquals([tag.slug for tag in post.tags.all()], ['python'])
+
+        # Check slugs that are too long or wouldn't be found by their URL
+        for slug in ('a' * 41, 'my first post', 'my_post'):
+            self.write('02-second.md', '---\ntitle: My second post\nslug: %s\n'
+                                       'date: 2014-05-02\n---\nText\n' % slug)
+            with self.assertRaises(CommandError) as context:
+                self.import_posts()
+            self.assertTrue('02-second.md' in str(context.exception))
+
+        # Check categories and tags with no slug fail instead of being merged
+        for labels in ('category: "!!!"', 'tags: "???, C_sharp"'):
+            self.write('02-second.md', '---\ntitle: My second post\ndate: 2014-05-02\n'
+                                       '%s\n---\nText\n' % labels)
+            with self.assertRaises(CommandError) as context:
+                self.import_posts()
+            self.assertTrue('02-second.md' in str(context.exception))
+        self.assertEquals(Post.objects.count(), 1)
+
+    def test_resume(self):
+        for number in range(3):
+            self.write('%02d.md' % number, '---\ntitle: Post %d\ndate: 2014-05-01\n---\nText\n' % number)
+        with open(self.source + '.checkpoint', 'w') as f:
+            json.dump({'done': 2, 'updated': []}, f)
+
+        # Check only the posts after the checkpoint are imported
+        output = self.import_posts()
+        self.assertTrue('Resuming after 2 posts' in output)
+        self.assertEquals(list(Post.objects.values_list('slug', flat=True)), ['post-2'])
+
+        # Check a broken post stops the import where it is
+        self.write('03.md', 'No front matter')
+        self.write('04.md', '---\ntitle: Post 4\ndate: 2014-05-01\n---\nText\n')
+        with open(self.source + '.checkpoint', 'w') as f:
+            json.dump({'done': 3, 'updated': []}, f)
+        self.assertRaises(CommandError, self.import_posts)
+        self.assertEquals(Post.objects.count(), 1)
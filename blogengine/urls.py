@@ -1,9 +1,7 @@
 from django.conf.urls import patterns, url
-from django.contrib.sitemaps.views import sitemap
-from django.views.generic import ListView, DetailView
-from blogengine.models import Post, Category, Tag
-from blogengine.sitemap import PostSitemap, FlatpageSitemap
-from blogengine.views import CategoryListView, TagListView, PostsFeed, CategoryPostsFeed, TagPostsFeed, getSearchResults
+from blogengine.models import Category, Tag
+from blogengine.sitemap import PostSitemap, FlatpageSitemap, cached_sitemap, sitemap_index
+from blogengine.views import PostListView, CategoryListView, DateArchiveView, TagListView, PostDetailView, PostsFeed, CategoryPostsFeed, TagPostsFeed, getSearchResults, performance
 
 # Define sitemaps
 sitemaps = {
@@ -13,12 +11,23 @@ sitemaps = {
 
 urlpatterns = patterns('',
         # Index
-        url(r'^(?P<page>\d+)?/?$', ListView.as_view(model=Post, paginate_by=5,),
-                                                    name='index'),
+        url(r'^(?P<page>\d+)?/?$', PostListView.as_view(paginate_by=5,),
+                                                        name='index'),
+
+        # Year, month and day archives, under their own prefix so they
+        # never take index page numbers or post slugs
+        url(r'^archive/(?P<year>\d{4})/?$', DateArchiveView.as_view(paginate_by=5,),
+                                                                name='year'),
+        url(r'^archive/(?P<year>\d{4})/(?P<month>\d{1,2})/?$', DateArchiveView.as_view(
+            paginate_by=5,),
+            name='month'),
+        url(r'^archive/(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/?$',
+            DateArchiveView.as_view(paginate_by=5,),
+            name='day'),
 
         # Individual post
         url(r'^(?P<pub_date__year>\d{4})/(?P<pub_date__month>\d{1,2})'
-            r'/(?P<slug>[a-zA-Z0-9-]+)/?$', DetailView.as_view(model=Post,),
+            r'/(?P<slug>[a-zA-Z0-9-]+)/?$', PostDetailView.as_view(),
                                                                name='post'),
 
         # Categories
@@ -34,18 +43,27 @@ urlpatterns = patterns('',
             name='tag'),
 
         # post RSS feed
-        url(r'^feeds/posts/$', PostsFeed()),
+        url(r'^feeds/posts/$', PostsFeed(), name='feed'),
 
         # Category RSS feed
-        url(r'^feeds/posts/category/(?P<slug>[a-zA-Z0-9-]+)/?$', CategoryPostsFeed()),
+        url(r'^feeds/posts/category/(?P<slug>[a-zA-Z0-9-]+)/?$', CategoryPostsFeed(), name='category_feed'),
 
         # Tag RSS feed
-        url(r'^feeds/posts/tag/(?P<slug>[a-zA-Z0-9-]+)/?$', TagPostsFeed()),
+        url(r'^feeds/posts/tag/(?P<slug>[a-zA-Z0-9-]+)/?$', TagPostsFeed(), name='tag_feed'),
+
+        # Performance histograms, staff only
+        url(r'^performance\.json$', performance, name='performance'),
 
         # Search posts
         url(r'^search', getSearchResults, name='search'),
 
-        # Sitemap
-        url(r'^sitemap\.xml$', sitemap, {'sitemaps': sitemaps},
+        # Sitemap index
+        url(r'^sitemap\.xml$', sitemap_index, {
+            'sitemaps': sitemaps,
+            'sitemap_url_name': 'blogengine:django.contrib.sitemaps.views.sitemap'},
+            name='django.contrib.sitemaps.views.index'),
+
+        # Sitemap sections, paginated with ?p=
+        url(r'^sitemap-(?P<section>[a-z]+)\.xml$', cached_sitemap, {'sitemaps': sitemaps},
             name='django.contrib.sitemaps.views.sitemap'),
 )
\ No newline at end of file
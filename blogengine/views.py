@@ -1,74 +1,183 @@
-from django.contrib.syndication.views import Feed
+import datetime
+import json
+
+from django.core.exceptions import PermissionDenied
 from django.core.paginator import Paginator, EmptyPage
-from django.db.models import Q
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404, render_to_response
-from django.views.generic import ListView
-from django.utils.encoding import force_unicode
+from django.template import RequestContext
+from django.views.generic import DetailView, ListView
 from django.utils.safestring import mark_safe
-from blogengine.models import Category, Post, Tag
-import markdown2
+from django.views.decorators.cache import never_cache
+from blogengine import highlighting, instrumentation
+from blogengine.caching import add_dependencies, dependency, post_dependencies
+from blogengine.conditional import ConditionalGetMixin, latest, make_etag
+from blogengine.feeds import StreamingFeed
+from blogengine.hosts import current_site_id
+from blogengine.models import Category, Post, Tag, date_range
+from blogengine.pagination import CachedCountPaginator, KeysetPaginationMixin
+from blogengine.search import get_backend as get_search_backend, search_posts
 
-class CategoryListView(ListView):
-    template_name = 'blogengine/category_post_list.html'
+class SiteListMixin(object):
+    '''For lists of the posts of the site the request is for'''
+    def get_site_id(self):
+        return current_site_id(self.request)
+
+    def get_etag(self):
+        # Changes when any post, category or tag of the site is saved or deleted
+        site_id = self.get_site_id()
+        return make_etag(deps=[dependency('posts', site_id)], site_id=site_id)
+
+    def get_context_data(self, **kwargs):
+        context = super(SiteListMixin, self).get_context_data(**kwargs)
+        add_dependencies(self.request, dependency('posts', self.get_site_id()))
+        return context
 
+class PostListView(SiteListMixin, ConditionalGetMixin, KeysetPaginationMixin, ListView):
     def get_queryset(self):
-        slug = self.kwargs['slug']
+        return Post.objects.for_site(self.get_site_id()).for_listing()
+
+class DateArchiveView(PostListView):
+    '''Posts of a site in a year, month or day, in UTC like post URLs'''
+    template_name = 'blogengine/date_post_list.html'
+    allow_empty = False
+
+    def get_date_parts(self):
+        return [int(self.kwargs[part]) for part in ('year', 'month', 'day')
+                if self.kwargs.get(part)]
+
+    def get_posts(self):
+        '''The posts in the range, found through the (site, pub_date) index'''
         try:
-            category = Category.objects.get(slug=slug)
-            return Post.objects.filter(category=category)
-        except Category.DoesNotExist:
+            start, end = date_range(*self.get_date_parts())
+        except ValueError:
+            raise Http404('Invalid date')
+        return Post.objects.for_site(self.get_site_id()).filter(pub_date__gte=start,
+                                                                pub_date__lt=end)
+
+    def get_queryset(self):
+        return self.get_posts().for_listing()
+
+    def get_context_data(self, **kwargs):
+        context = super(DateArchiveView, self).get_context_data(**kwargs)
+        parts = self.get_date_parts()
+        # A date, so the title isn't shifted to the local time zone
+        context['archive_date'] = datetime.date(*(parts + [1, 1])[:3])
+        context['archive_format'] = ('Y', 'F Y', 'F j, Y')[len(parts) - 1]
+        return context
+
+class CategoryListView(SiteListMixin, ConditionalGetMixin, KeysetPaginationMixin, ListView):
+    template_name = 'blogengine/category_post_list.html'
+
+    def get_category(self):
+        '''The category being listed, None if there is no such category'''
+        if not hasattr(self, '_category'):
+            try:
+                self._category = Category.objects.for_site(self.get_site_id()).get(
+                    slug=self.kwargs['slug'])
+            except Category.DoesNotExist:
+                self._category = None
+        return self._category
+
+    def get_queryset(self):
+        category = self.get_category()
+        if category is None:
             return Post.objects.none()
+        return Post.objects.for_listing().filter(category=category)
 
     def get_context_data(self, **kwargs):
         context = super(CategoryListView, self).get_context_data(**kwargs)
-        slug = self.kwargs['slug']
-        try:
-            context['category'] = Category.objects.get(slug=slug)
-        except Category.DoesNotExist:
-            context['category'] = None
+        context['category'] = self.get_category()
+        if context['category'] is not None:
+            add_dependencies(self.request, dependency('category', context['category'].pk))
         return context
 
-class TagListView(ListView):
+class TagListView(SiteListMixin, ConditionalGetMixin, KeysetPaginationMixin, ListView):
     template_name = 'blogengine/tag_post_list.html'
 
+    def get_tag(self):
+        '''The tag being listed, None if there is no such tag'''
+        if not hasattr(self, '_tag'):
+            try:
+                self._tag = Tag.objects.for_site(self.get_site_id()).get(slug=self.kwargs['slug'])
+            except Tag.DoesNotExist:
+                self._tag = None
+        return self._tag
+
     def get_queryset(self):
-        slug = self.kwargs['slug']
-        try:
-            tag = Tag.objects.get(slug=slug)
-            return tag.post_set.all()
-        except Tag.DoesNotExist:
+        tag = self.get_tag()
+        if tag is None:
             return Post.objects.none()
+        return Post.objects.for_listing().filter(tags=tag)
 
     def get_context_data(self, **kwargs):
         context = super(TagListView, self).get_context_data(**kwargs)
-        slug = self.kwargs['slug']
-        try:
-            context['tag'] = Tag.objects.get(slug=slug)
-        except Tag.DoesNotExist:
-            context['tag'] = None
+        context['tag'] = self.get_tag()
+        if context['tag'] is not None:
+            add_dependencies(self.request, dependency('tag', context['tag'].pk))
         return context
 
-class PostsFeed(Feed):
+class PostDetailView(ConditionalGetMixin, DetailView):
+    model = Post
+
+    def get_last_modified(self):
+        # Loads the post for the view too, with its category and tags
+        post = self.get_object()
+        return latest(post.updated_at, post.category and post.category.updated_at,
+                      *[tag.updated_at for tag in post.tags.all()])
+
+    def get_etag(self):
+        # Saving the post, its category or tags or changing its tags all
+        # move the last modified date
+        return make_etag(self.kwargs['slug'], self.get_last_modified(),
+                         site_id=current_site_id(self.request))
+
+    def get_queryset(self):
+        # select_related() calls don't chain yet, so no for_listing() here
+        return (Post.objects.for_site(current_site_id(self.request))
+                .select_related('category', 'site').prefetch_related('tags'))
+
+    def get_object(self, queryset=None):
+        if not hasattr(self, '_object'):
+            self._object = super(PostDetailView, self).get_object(queryset)
+        # Only expire this page when the post, its category or tags change
+        add_dependencies(self.request, *post_dependencies(self._object))
+        return self._object
+
+class PostsFeed(StreamingFeed):
     title = "RSS feed - posts"
     link = "/"
     description = "RSS feed - blog posts"
 
-    def items(self):
-        return Post.objects.order_by('-pub_date')
+    def get_object(self, request):
+        # The id of the site whose posts are listed
+        return current_site_id(request)
+
+    def get_site_id(self, obj):
+        return obj
+
+    def get_dependencies(self, obj):
+        return [dependency('posts', self.get_site_id(obj))]
+
+    def get_posts(self, obj):
+        return Post.objects.for_site(obj)
+
+    def items(self, obj):
+        return self.get_posts(obj).order_by('-pub_date')[:self.get_item_limit()]
 
     def item_title(self, item):
         return item.title
 
     def item_description(self, item):
-        extras = ['fenced-code-blocks']
-        # Render description as markdown
-        content = mark_safe(markdown2.markdown(force_unicode(item.text),
-                                               extras = extras))
-        return content
+        # Description is the markdown rendered when the post was saved
+        return mark_safe(item.get_rendered_text())
 
 class CategoryPostsFeed(PostsFeed):
     def get_object(self, request, slug):
-        return get_object_or_404(Category, slug=slug)
+        return get_object_or_404(Category.objects.for_site(current_site_id(request)), slug=slug)
+
+    def get_site_id(self, obj):
+        return obj.site_id
 
     def title(self, obj):
         return "RSS feed - blog posts in category %s" % obj.name
@@ -79,12 +188,15 @@ class CategoryPostsFeed(PostsFeed):
     def description(self, obj):
         return "RSS feed - blog posts in category %s" % obj.name
 
-    def items(self, obj):
-        return Post.objects.filter(category=obj).order_by('-pub_date')
+    def get_posts(self, obj):
+        return Post.objects.filter(category=obj)
 
 class TagPostsFeed(PostsFeed):
     def get_object(self, request, slug):
-        return get_object_or_404(Tag, slug=slug)
+        return get_object_or_404(Tag.objects.for_site(current_site_id(request)), slug=slug)
+
+    def get_site_id(self, obj):
+        return obj.site_id
 
     def title(self, obj):
         return "RSS feed - blog posts tagged  %s" % obj.name
@@ -95,10 +207,9 @@ class TagPostsFeed(PostsFeed):
     def description(self, obj):
         return "RSS feed - blog posts tagged %s" % obj.name
 
-    def items(self, obj):
+    def get_posts(self, obj):
         # Remember tags use a many-to-many relationship
-        tag = Tag.objects.get(slug=obj.slug)
-        return tag.post_set.all()
+        return obj.post_set.all()
 
 
 def getSearchResults(request):
@@ -107,11 +218,15 @@ def getSearchResults(request):
     query = request.GET.get('q', '')
     page = request.GET.get('page', 1) # defaults to 1 anyway
 
-    # Query the database
-    results = Post.objects.filter(Q(text__icontains=query) | Q(title__icontains=query))
-
-    # Add pagination: use paginator to manually paginate results
-    pages = Paginator(results, 5)
+    site_id = current_site_id(request)
+    if query.strip():
+        # Ranked ids of the matching posts, cached until a post changes
+        pages = Paginator(search_posts(query, site_id), 5)
+    else:
+        # Every post matches: page through them in the database instead
+        # of loading every id
+        pages = CachedCountPaginator(Post.objects.for_site(site_id).for_listing(), 5,
+                                     site_id=site_id)
 
     # Get specified page
     try:
@@ -119,8 +234,33 @@ def getSearchResults(request):
     except EmptyPage: # show last page instead
         returned_page = pages.page(pages.num_pages)
 
+    if query.strip():
+        # Only load and highlight the posts on this page
+        page_pks = list(returned_page.object_list)
+        posts = Post.objects.for_listing().in_bulk(page_pks)
+        snippets = get_search_backend().highlight(query, page_pks)
+        object_list = []
+        for pk in page_pks:
+            if pk in posts:
+                posts[pk].search_snippet = snippets.get(pk)
+                object_list.append(posts[pk])
+    else:
+        object_list = list(returned_page.object_list)
+
     # Display the search results
     return render_to_response('blogengine/search_post_list.html',
                               {'page_obj': returned_page,
-                               'object_list': returned_page.object_list,
-                               'search': query})
\ No newline at end of file
+                               'object_list': object_list,
+                               'search': query},
+                              context_instance=RequestContext(request))
+
+@never_cache
+def performance(request):
+    '''Per-view performance histograms of this process, for staff only'''
+    if not request.user.is_staff:
+        raise PermissionDenied
+    if request.GET.get('reset'):
+        instrumentation.reset()
+    stats = instrumentation.performance_stats()
+    stats['highlight_cache'] = highlighting.cache.stats()
+    return HttpResponse(json.dumps(stats, sort_keys=True), content_type='application/json')
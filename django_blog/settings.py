@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.6/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+from django.conf import global_settings
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 # Quick-start development settings - unsuitable for production
@@ -43,15 +44,18 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'blogengine.middleware.PerformanceMiddleware',
+    'blogengine.middleware.SiteMiddleware',
+    'django.middleware.http.ConditionalGetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django.middleware.cache.UpdateCacheMiddleware',
+    'blogengine.middleware.UpdateCacheMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
+    'blogengine.middleware.FetchFromCacheMiddleware',
 )
 
 ROOT_URLCONF = 'django_blog.urls'
@@ -93,9 +97,15 @@ USE_L10N = True
 
 USE_TZ = True
 
-# For sites framework
+# For sites framework. Requests are served by the site whose domain they
+# are for (see blogengine.hosts), this one when none matches
 SITE_ID = 1
 
+# Templates read the site of the request for its navigation and widgets
+TEMPLATE_CONTEXT_PROCESSORS = global_settings.TEMPLATE_CONTEXT_PROCESSORS + (
+    'django.core.context_processors.request',
+)
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.6/howto/static-files/
@@ -105,6 +115,12 @@ TEMPLATE_DIRS = [os.path.join(BASE_DIR, 'templates')]
 
 STATIC_ROOT = 'staticfiles'
 
+# Content hashed names with .gz/.br siblings, served by blogengine.static_serve
+STATICFILES_STORAGE = 'blogengine.storage.CompressedManifestStaticFilesStorage'
+
+# Cache lifetime of static files without a content hash in their name
+BLOGENGINE_STATIC_MAX_AGE = 60
+
 # collectstatic will already collect static files from installed apps
 # The below line is used if there are static files not tied to an app (floating around)
 # STATICFILES_DIRS = (os.path.join(BASE_DIR, 'static'),)
@@ -127,7 +143,19 @@ def get_cache():
         os.environ['MEMCACHE_USERNAME'] = os.environ['MEMCACHIER_USERNAME']
         os.environ['MEMCACHE_PASSWORD'] = os.environ['MEMCACHIER_PASSWORD']
         return {
+            # Hot keys are answered from the worker's memory, see
+            # blogengine/cache_backends.py
             'default': {
+                'BACKEND': 'blogengine.cache_backends.TwoTierCache',
+                'LOCATION': 'memcached',
+                'TIMEOUT': 300,
+                'OPTIONS': {
+                    'MAX_BYTES': 16 * 1024 * 1024,
+                    'LOCAL_TIMEOUT': 10,
+                    'GENERATION_INTERVAL': 1,
+                }
+            },
+            'memcached': {
                 'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
                 'TIMEOUT': 300,
                 'BINARY': True,
@@ -148,6 +176,54 @@ CACHE_MIDDLEWARE_ALIAS = 'default' # cache alias to use for storage
 CACHE_MIDDLEWARE_SECONDS = 300 # num of seconds each page should be cached
 CACHE_MIDDLEWARE_KEY_PREFIX = '' # name if cache is shared across multiple sites
 
+# Cache stampede protection: an expired or invalidated page is served for
+# up to BLOGENGINE_CACHE_STALE_SECONDS while the one request holding its
+# lock builds it again. Requests with nothing to serve wait up to
+# BLOGENGINE_CACHE_LOCK_WAIT seconds for that page. Pages are rebuilt a
+# little before they expire, more eagerly the higher the beta (0 disables)
+BLOGENGINE_CACHE_STALE_SECONDS = 60
+BLOGENGINE_CACHE_LOCK_SECONDS = 10
+BLOGENGINE_CACHE_LOCK_WAIT = 2.0
+BLOGENGINE_CACHE_EARLY_EXPIRY_BETA = 1.0
+# Rebuild on a thread and serve the old page to every request meanwhile
+BLOGENGINE_CACHE_BACKGROUND_REFRESH = False
+
+
+# Full-text search backend for the blog. When None, it is picked from the
+# database: Postgres tsvector, SQLite FTS5, or icontains scans otherwise
+BLOGENGINE_SEARCH_BACKEND = None
+
+# Page post listings with ?after=/?before= cursors instead of page numbers
+BLOGENGINE_KEYSET_PAGINATION = False
+
+# Keep the category and tags of each post on it, so listings render them
+# without joins. Run ./manage.py rebuildtaxonomy after turning it on
+BLOGENGINE_DENORMALIZE_TAXONOMY = False
+
+# Number of posts in each RSS feed
+BLOGENGINE_FEED_ITEMS = 20
+
+# Render markdown of at least BLOGENGINE_MARKDOWN_POOL_MIN_LENGTH characters
+# in a pool of this many processes (0 renders inline), and admin saves in
+# the background. Requests render the text themselves when the pool takes
+# longer than BLOGENGINE_MARKDOWN_TIMEOUT seconds
+BLOGENGINE_MARKDOWN_PROCESSES = 0
+BLOGENGINE_MARKDOWN_POOL_MIN_LENGTH = 10000
+BLOGENGINE_MARKDOWN_TIMEOUT = 2.0
+
+# markdown2 extras posts are rendered with, as a list or a dict of options.
+# Changing them marks every post for ./manage.py rendermarkdown
+BLOGENGINE_MARKDOWN_EXTRAS = ['fenced-code-blocks']
+# Markdown objects kept for reuse by each process
+BLOGENGINE_MARKDOWN_INSTANCES = 8
+# Size of each process's cache of highlighted code blocks, 0 to disable it
+BLOGENGINE_HIGHLIGHT_CACHE_BYTES = 4 * 1024 * 1024
+
+# Log the per-view performance histograms as JSON to the
+# blogengine.performance logger at most this often, in seconds. None to
+# only serve them at /performance.json
+BLOGENGINE_PERFORMANCE_LOG_INTERVAL = None
+
 
 # For local production
 try:
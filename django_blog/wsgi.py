@@ -11,6 +11,6 @@ import os
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_blog.settings")
 
 from django.core.wsgi import get_wsgi_application
-from dj_static import Cling
+from blogengine.static_serve import StaticFilesApplication
 
-application = Cling(get_wsgi_application())
+application = StaticFilesApplication(get_wsgi_application())
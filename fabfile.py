@@ -11,4 +11,7 @@ def deploy():
 	local('git push heroku master')
 
 	# Run migrations on Heroku
-	local('heroku run python manage.py migrate')
\ No newline at end of file
+	local('heroku run python manage.py migrate')
+
+	# Render markdown for posts saved with an older renderer
+	local('heroku run python manage.py rendermarkdown')
\ No newline at end of file